@@ -1,20 +1,49 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Response, Cookie
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, Response, Cookie, Query
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from bson.int64 import Int64
+from pymongo import ASCENDING, DESCENDING, CursorType, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
 from pydantic import BaseModel, EmailStr, Field
-from typing import List, Optional, Dict, Any
+from typing import AsyncIterator, List, Optional, Dict, Any, Tuple
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+    # DecompressionBombError لا يرث OSError فيجب التقاطه صراحة
+    IMAGE_DECODE_ERRORS = (Image.DecompressionBombError, UnidentifiedImageError, OSError, ValueError)
+except ImportError:  # Pillow غير مثبت - تُخدم الصورة الأصلية لكل المقاسات
+    Image = None
+    IMAGE_DECODE_ERRORS = (OSError, ValueError)
 from pathlib import Path
 import os
+import asyncio
+import base64
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import json
 import logging
+import random
+import time
 import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 import stripe
 import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
 import httpx
+import io
+import numpy as np
 
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
@@ -35,20 +64,233 @@ JWT_SECRET = os.environ['JWT_SECRET']
 JWT_ALGORITHM = os.environ['JWT_ALGORITHM']
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ['ACCESS_TOKEN_EXPIRE_MINUTES'])
 
+# Authenticated user cache
+USER_CACHE_TTL_SECONDS = float(os.environ.get("USER_CACHE_TTL_SECONDS", "30"))
+USER_CACHE_MAX_SIZE = int(os.environ.get("USER_CACHE_MAX_SIZE", "10000"))
+# يتطلب Replica Set - لإبطال الذاكرة المؤقتة عبر جميع العمليات
+USER_CACHE_CHANGE_STREAM = os.environ.get("USER_CACHE_CHANGE_STREAM", "").lower() in ("1", "true", "yes")
+
+# Platform counters
+COUNTER_RECONCILE_INTERVAL_SECONDS = float(os.environ.get("COUNTER_RECONCILE_INTERVAL_SECONDS", "900"))
+SUBSCRIPTION_SWEEP_INTERVAL_SECONDS = float(os.environ.get("SUBSCRIPTION_SWEEP_INTERVAL_SECONDS", "60"))
+# إعادة حساب أحدث أيام ملخص الإيرادات دورياً - يصحح الأيام التي تخلفت بسبب تحديثات متزامنة
+REVENUE_ROLLUP_REFRESH_INTERVAL_SECONDS = float(os.environ.get("REVENUE_ROLLUP_REFRESH_INTERVAL_SECONDS", "300"))
+REVENUE_ROLLUP_REFRESH_DAYS = int(os.environ.get("REVENUE_ROLLUP_REFRESH_DAYS", "3"))
+# معرف هذه العملية لأقفال المهام الدورية عند تشغيل عدة نسخ
+INSTANCE_ID = str(uuid.uuid4())
+
+# Public catalog response cache
+CATALOG_CACHE_TTL_SECONDS = float(os.environ.get("CATALOG_CACHE_TTL_SECONDS", "300"))
+CATALOG_CLIENT_MAX_AGE = int(os.environ.get("CATALOG_CLIENT_MAX_AGE", "60"))
+CATALOG_INVALIDATE_EVENT = "__catalog_invalidate__"
+# غرفة محجوزة لا ينضم إليها أي عميل - الإبطال يمر عبر sio.emit العادي دون أن يصل للعملاء
+CATALOG_INVALIDATE_ROOM = "__catalog_invalidate__"
+
+# Message attachments (GridFS)
+ATTACHMENT_MAX_BYTES = int(os.environ.get("ATTACHMENT_MAX_BYTES", str(25 * 1024 * 1024)))
+ATTACHMENT_CHUNK_SIZE = 255 * 1024
+attachments_fs = AsyncIOMotorGridFSBucket(db, bucket_name="attachments", chunk_size_bytes=ATTACHMENT_CHUNK_SIZE)
+# مرفق لم تُشر إليه أي رسالة خلال هذه المهلة منذ آخر استخدام يُحذف
+ATTACHMENT_GC_GRACE_SECONDS = float(os.environ.get("ATTACHMENT_GC_GRACE_SECONDS", str(24 * 3600)))
+ATTACHMENT_GC_INTERVAL_SECONDS = float(os.environ.get("ATTACHMENT_GC_INTERVAL_SECONDS", "3600"))
+
+# Profile images
+PROFILE_IMAGE_MAX_BYTES = int(os.environ.get("PROFILE_IMAGE_MAX_BYTES", str(5 * 1024 * 1024)))
+PROFILE_IMAGE_SIZES = (128, 512)
+PROFILE_IMAGE_LIST_SIZE = 128
+PROFILE_IMAGE_DETAIL_SIZE = 512
+# يُستخدم لبناء روابط مطلقة للصور، والافتراضي روابط نسبية تبدأ بـ /api
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "").rstrip("/")
+
+# Socket.IO message bus - مطلوب عند تشغيل أكثر من عامل (worker)
+# redis://... | amqp://... | mongodb (مجموعة محدودة الحجم في نفس القاعدة) | local:// (للاختبارات)
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE", "")
+SOCKETIO_CHANNEL = os.environ.get("SOCKETIO_CHANNEL", "socketio")
+SOCKETIO_BUS_SIZE_BYTES = int(os.environ.get("SOCKETIO_BUS_SIZE_BYTES", str(16 * 1024 * 1024)))
+
+# Socket.IO connections
+SOCKET_MAX_CONNECTIONS_PER_USER = int(os.environ.get("SOCKET_MAX_CONNECTIONS_PER_USER", "5"))
+SOCKET_IDLE_TIMEOUT_SECONDS = float(os.environ.get("SOCKET_IDLE_TIMEOUT_SECONDS", "1800"))
+
 # Stripe Configuration
 stripe.api_key = os.environ['STRIPE_SECRET_KEY']
+# يمكن توجيه الطلبات إلى خادم Stripe وهمي محلي (stripe-mock) لاختبارات الحمل دون اتصال
+if os.environ.get("STRIPE_API_BASE"):
+    stripe.api_base = os.environ["STRIPE_API_BASE"]
+STRIPE_TIMEOUT_SECONDS = float(os.environ.get("STRIPE_TIMEOUT_SECONDS", "10"))
+STRIPE_MAX_RETRIES = int(os.environ.get("STRIPE_MAX_RETRIES", "2"))
+STRIPE_WORKERS = int(os.environ.get("STRIPE_WORKERS", "8"))
+# RequestsClient keeps a pooled requests.Session per worker thread
+stripe.default_http_client = stripe.RequestsClient(timeout=STRIPE_TIMEOUT_SECONDS)
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# تغيير BCRYPT_ROUNDS يؤدي لإعادة تشفير كلمة المرور تلقائياً عند تسجيل الدخول التالي
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "4"))
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get("PASSWORD_HASH_MAX_QUEUE", "64"))
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
 
 # FastAPI app
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 
+# ==================== SOCKET.IO MESSAGE BUS ====================
+
+class SocketMetrics:
+    """زمن كل emit محلياً، وزمن التوصيل عبر الناقل من النشر حتى الاستلام في العامل الآخر"""
+    
+    def __init__(self):
+        self.emit_latency: Dict[str, "LatencyHistogram"] = {}
+        self.delivery_latency: Dict[str, "LatencyHistogram"] = {}
+        self.published = 0
+        self.received = 0
+    
+    def observe(self, table: dict, event: str, seconds: float):
+        if event not in table:
+            table[event] = LatencyHistogram()
+        table[event].observe(max(seconds, 0))
+    
+    def stats(self) -> dict:
+        return {
+            "manager": getattr(sio.manager, "name", "memory"),
+            "published": self.published,
+            "received": self.received,
+            "emit_latency": {event: h.snapshot() for event, h in self.emit_latency.items()},
+            "delivery_latency": {event: h.snapshot() for event, h in self.delivery_latency.items()}
+        }
+
+socket_metrics = SocketMetrics()
+
+class InstrumentedManagerMixin:
+    """يضاف قبل مدير العملاء لقياس كل emit وتوقيت الرسائل المارة عبر الناقل"""
+    
+    async def emit(self, event, data, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().emit(event, data, *args, **kwargs)
+        finally:
+            socket_metrics.observe(socket_metrics.emit_latency, event, time.perf_counter() - started)
+    
+    async def _publish(self, data):
+        socket_metrics.published += 1
+        await super()._publish({**data, "sent_at": time.time()})
+    
+    async def _handle_emit(self, message):
+        if message.get("room") == CATALOG_INVALIDATE_ROOM:
+            # رسالة داخلية بين العمال وليست حدثاً للعملاء، والعامل المرسل أبطل نسخته قبل النشر
+            if message.get("host_id") != self.host_id:
+                catalog_cache.invalidate(*message["data"], broadcast=False)
+            return
+        if "sent_at" in message:
+            socket_metrics.received += 1
+            socket_metrics.observe(socket_metrics.delivery_latency, message["event"], time.time() - message["sent_at"])
+        await super()._handle_emit(message)
+
+class LocalPubSubManager(AsyncPubSubManager):
+    """وسيط داخل العملية يحاكي الناقل - عدة خوادم Socket.IO في نفس العملية تتبادل الرسائل كما لو كانت عمالاً منفصلين"""
+    
+    name = "local"
+    _subscribers: Dict[str, List[asyncio.Queue]] = {}
+    
+    def __init__(self, url: str = "local://", channel: str = "socketio", write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue: asyncio.Queue = asyncio.Queue()
+        if not write_only:
+            self._subscribers.setdefault(channel, []).append(self.queue)
+    
+    async def _publish(self, data):
+        # التسلسل كما في الناقل الحقيقي حتى تظهر أخطاء البيانات غير القابلة للتسلسل في الاختبارات
+        payload = json.dumps(data)
+        for queue in self._subscribers.get(self.channel, []):
+            queue.put_nowait(payload)
+    
+    async def _listen(self):
+        while True:
+            yield await self.queue.get()
+
+class MongoPubSubManager(AsyncPubSubManager):
+    """ناقل عبر مجموعة Mongo محدودة الحجم (capped) ومؤشر tailable - لا يحتاج خدمة إضافية"""
+    
+    name = "mongo"
+    
+    def __init__(self, url: str = "mongodb", channel: str = "socketio", write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.collection_name = f"{channel}_bus"
+        self._collection = None
+    
+    async def _get_collection(self):
+        if self._collection is None:
+            if self.collection_name not in await db.list_collection_names():
+                try:
+                    await db.create_collection(self.collection_name, capped=True, size=SOCKETIO_BUS_SIZE_BYTES)
+                    # مستند أولي حتى لا يموت المؤشر على مجموعة فارغة
+                    await db[self.collection_name].insert_one({"message": None})
+                except OperationFailure:
+                    pass  # أنشأها عامل آخر
+            self._collection = db[self.collection_name]
+        return self._collection
+    
+    async def _publish(self, data):
+        collection = await self._get_collection()
+        await collection.insert_one({"message": json.dumps(data)})
+    
+    async def _tail_marker(self, collection):
+        latest = await collection.find({}, {"_id": 1}).sort("$natural", -1).limit(1).to_list(1)
+        return latest[0]["_id"] if latest else None
+    
+    async def _listen(self):
+        # مؤشر tailable واحد بلا شرط على _id: ترتيب الإدراج ($natural) يحدده الخادم، أما ObjectId
+        # فيولّده كل عامل بنفسه وقد لا يكون مرتباً بين العمال. إعادة الفتح فقط عند الخطأ، ويُتخطى
+        # ما قبل آخر مستند مقروء بالمطابقة لا بالمقارنة
+        collection = await self._get_collection()
+        last_id = await self._tail_marker(collection)
+        while True:
+            if last_id is not None and await collection.find_one({"_id": last_id}, {"_id": 1}) is None:
+                logger.warning("Socket.IO Mongo bus fell behind the capped collection, resuming from its tail")
+                last_id = await self._tail_marker(collection)
+            skipping = last_id is not None
+            cursor = collection.find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+            try:
+                while cursor.alive:
+                    async for doc in cursor:
+                        if skipping:
+                            skipping = doc["_id"] != last_id
+                            continue
+                        last_id = doc["_id"]
+                        if doc.get("message"):
+                            yield doc["message"]
+            except PyMongoError as e:
+                logger.warning(f"Socket.IO Mongo bus cursor lost: {e}")
+            await asyncio.sleep(0.5)
+
+def create_client_manager():
+    """اختيار مدير عملاء Socket.IO حسب SOCKETIO_MESSAGE_QUEUE، مع قياس زمن كل emit"""
+    url = SOCKETIO_MESSAGE_QUEUE
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        base, kwargs = socketio.AsyncRedisManager, {"url": url}
+    elif url.startswith(("amqp://", "amqps://")):
+        base, kwargs = socketio.AsyncAioPikaManager, {"url": url}
+    elif url.startswith("mongodb"):
+        base, kwargs = MongoPubSubManager, {}
+    elif url.startswith("local://"):
+        base, kwargs = LocalPubSubManager, {}
+    else:
+        # عامل واحد - الغرف في ذاكرة العملية
+        return type("InstrumentedAsyncManager", (InstrumentedManagerMixin, socketio.AsyncManager), {})()
+    manager_cls = type(f"Instrumented{base.__name__}", (InstrumentedManagerMixin, base), {})
+    return manager_cls(channel=SOCKETIO_CHANNEL, **kwargs)
+
 # Socket.IO setup
 sio = socketio.AsyncServer(
     async_mode='asgi',
+    client_manager=create_client_manager(),
     cors_allowed_origins='*',
     logger=True,
     engineio_logger=True
@@ -151,7 +393,8 @@ class Message(BaseModel):
     sender_id: Optional[str] = None  # Will be set from token
     recipient_id: str
     message: str
-    attachment: Optional[str] = None  # base64 encoded file
+    attachment: Optional[str] = None  # base64 encoded file (legacy, stored to /attachments on send)
+    attachment_id: Optional[str] = None  # from POST /attachments
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     read: bool = False
 
@@ -556,11 +799,86 @@ class SessionResponse(BaseModel):
 
 # ==================== HELPER FUNCTIONS ====================
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+class LatencyHistogram:
+    """مدرج تكراري بسيط لزمن الاستجابة بالمللي ثانية"""
+    
+    BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+    
+    def observe(self, seconds: float):
+        elapsed_ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, elapsed_ms)] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+    
+    def snapshot(self) -> dict:
+        buckets = {f"le_{bound}": count for bound, count in zip(self.BUCKETS_MS, self.counts)}
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0,
+            "max_ms": round(self.max_ms, 2),
+            "buckets": buckets
+        }
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+class PasswordHasher:
+    """تشغيل bcrypt في مجمع خيوط محدود الحجم حتى لا تتوقف حلقة الأحداث"""
+    
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+    
+    async def _run(self, fn, *args):
+        # Back-pressure: reject instead of queueing without bound
+        if self.pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
+        
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+            self.total_seconds += time.perf_counter() - started
+    
+    async def hash(self, password: str) -> str:
+        return await self._run(pwd_context.hash, password)
+    
+    async def verify_and_update(self, password: str, hashed_password: str):
+        """التحقق من كلمة المرور وإرجاع تشفير جديد إذا تغيرت إعدادات التكلفة"""
+        return await self._run(pwd_context.verify_and_update, password, hashed_password)
+    
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "pending": self.pending,
+            "queue_depth": max(0, self.pending - self.workers),
+            "peak_pending": self.peak_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_ms": round(self.total_seconds / self.completed * 1000, 2) if self.completed else 0
+        }
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE)
+
+async def get_password_hash(password):
+    return await password_hasher.hash(password)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -569,8 +887,182 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+class UserCache:
+    """ذاكرة مؤقتة LRU مع مدة صلاحية لمستندات المستخدمين حسب المعرف"""
+    
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+    
+    def get(self, user_id: str) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(user_id, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return dict(entry[1])
+    
+    def put(self, user_id: str, user: dict):
+        self._entries[user_id] = (time.monotonic() + self.ttl_seconds, user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate(self, user_id: str):
+        if self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+    
+    def clear(self):
+        self._entries.clear()
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions
+        }
+
+user_cache = UserCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL_SECONDS)
+
+class CatalogCache:
+    """استجابات الكتالوج العامة مخزنة كبايتات JSON جاهزة مع ETag، مع رقم إصدار لكل مجموعة يُرفع عند التعديل"""
+    
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._versions: Dict[str, int] = {}
+        self._entries: Dict[Tuple[str, str], tuple] = {}
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+        # يُستدعى بأسماء المجموعات المُبطلة لإبلاغ العمال الآخرين
+        self.on_invalidate = None
+    
+    def version(self, namespace: str) -> int:
+        return self._versions.get(namespace, 0)
+    
+    def get(self, namespace: str, key: str) -> Optional[Tuple[bytes, str]]:
+        entry = self._entries.get((namespace, key))
+        if entry is None or entry[0] < time.monotonic() or entry[1] != self._versions.get(namespace, 0):
+            self._entries.pop((namespace, key), None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[2], entry[3]
+    
+    def put(self, namespace: str, key: str, payload: Any, version: int) -> Tuple[bytes, str]:
+        """version هو إصدار المجموعة قبل بناء payload، فإن أُبطلت أثناء البناء لا تُخدم النسخة القديمة"""
+        body = json.dumps(jsonable_encoder(payload), ensure_ascii=False, separators=(",", ":")).encode()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        self._entries[(namespace, key)] = (time.monotonic() + self.ttl_seconds, version, body, etag)
+        return body, etag
+    
+    def invalidate(self, *namespaces: str, broadcast: bool = True):
+        for namespace in namespaces:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+            self.invalidations += 1
+        stale = [k for k in self._entries if k[0] in namespaces]
+        for k in stale:
+            del self._entries[k]
+        if broadcast and self.on_invalidate is not None:
+            self.on_invalidate(namespaces)
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "not_modified": self.not_modified,
+            "invalidations": self.invalidations,
+            "versions": dict(self._versions)
+        }
+
+catalog_cache = CatalogCache(CATALOG_CACHE_TTL_SECONDS)
+
+def broadcast_catalog_invalidation(namespaces):
+    """نشر الإبطال عبر ناقل Socket.IO حتى لا تبقى نسخ العمال الآخرين قديمة حتى انتهاء TTL"""
+    if isinstance(sio.manager, AsyncPubSubManager):
+        sio.start_background_task(sio.emit, CATALOG_INVALIDATE_EVENT, tuple(namespaces), to=CATALOG_INVALIDATE_ROOM)
+
+catalog_cache.on_invalidate = broadcast_catalog_invalidation
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """هل يطابق If-None-Match الوسم المعطى (قائمة وسوم، مع تجاهل بادئة W/)"""
+    if_none_match = request.headers.get("if-none-match", "")
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+async def catalog_response(request: Request, namespace: str, key: str, build) -> Response:
+    """خدمة استجابة كتالوج من الذاكرة المؤقتة، مع 304 عندما يطابق If-None-Match"""
+    entry = catalog_cache.get(namespace, key)
+    if entry is None:
+        version = catalog_cache.version(namespace)
+        entry = catalog_cache.put(namespace, key, await build(), version)
+    body, etag = entry
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={CATALOG_CLIENT_MAX_AGE}"}
+    
+    if etag_matches(request, etag):
+        catalog_cache.not_modified += 1
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def get_cached_user(user_id: str) -> Optional[dict]:
+    """جلب مستند المستخدم من الذاكرة المؤقتة أو من قاعدة البيانات عند عدم وجوده"""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    user = await db.users.find_one({"_id": user_id})
+    if user is not None:
+        user_cache.put(user_id, user)
+        return dict(user)
+    return None
+
+def invalidate_cached_user(user_id: str):
+    user_cache.invalidate(user_id)
+
+async def watch_user_changes():
+    """إبطال الذاكرة المؤقتة عند أي تغيير على مجموعة المستخدمين (من أي عملية)"""
+    while True:
+        try:
+            async with db.users.watch() as stream:
+                async for change in stream:
+                    user_id = change.get("documentKey", {}).get("_id")
+                    if user_id is not None:
+                        invalidate_cached_user(user_id)
+        except OperationFailure as e:
+            logger.warning(f"User cache change stream unavailable: {e}")
+            return
+        except PyMongoError as e:
+            # Changes may have been missed while disconnected
+            logger.warning(f"User cache change stream interrupted: {e}")
+            user_cache.clear()
+            await asyncio.sleep(5)
+
+background_tasks: List[asyncio.Task] = []
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.append(task)
+    return task
+
+def decode_access_token(token: str) -> str:
+    """التحقق من JWT وإرجاع معرف المستخدم - مشترك بين HTTP و Socket.IO"""
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user_id: str = payload.get("sub")
@@ -578,12 +1070,98 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-    
-    user = await db.users.find_one({"_id": user_id})
+    return user_id
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    user_id = decode_access_token(credentials.credentials)
+    user = await get_cached_user(user_id)
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
     return user
 
+async def fetch_by_ids(collection, ids, projection: Optional[Dict[str, int]] = None, key: str = "_id") -> Dict[Any, dict]:
+    """جلب مستندات مرتبطة بعدة معرفات في استعلام $in واحد بدلاً من find_one لكل صف"""
+    unique_ids = list({i for i in ids if i is not None})
+    if not unique_ids:
+        return {}
+    docs = await collection.find({key: {"$in": unique_ids}}, projection).to_list(len(unique_ids))
+    return {doc[key]: doc for doc in docs}
+
+USER_SUMMARY_PROJECTION = {"full_name": 1, "email": 1, "role": 1, "created_at": 1}
+
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 500
+# بدون limit ولا cursor تعود القائمة بحدها القديم قبل الترقيم حتى لا تُقتطع عند العملاء الحاليين
+UNPAGED_LIMIT = 1000
+
+def encode_cursor(sort_value, doc_id) -> str:
+    """مؤشر صفحة معتم مبني على (قيمة الترتيب، _id)"""
+    value = {"d": sort_value.isoformat()} if isinstance(sort_value, datetime) else {"v": sort_value}
+    raw = json.dumps([value, doc_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, doc_id = json.loads(raw)
+        sort_value = datetime.fromisoformat(value["d"]) if "d" in value else value["v"]
+        return sort_value, doc_id
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def paginate(collection, query: dict, sort_field: str, direction: int = DESCENDING,
+                   limit: Optional[int] = None, cursor: Optional[str] = None,
+                   projection: Optional[Dict[str, int]] = None, unpaged_limit: int = UNPAGED_LIMIT):
+    """ترقيم الصفحات بالمؤشر بدلاً من skip حتى يبقى زمن الاستجابة ثابتاً مع نمو البيانات"""
+    if limit is None:
+        limit = PAGE_SIZE_DEFAULT if cursor else unpaged_limit
+    if cursor:
+        sort_value, doc_id = decode_cursor(cursor)
+        op = "$lt" if direction == DESCENDING else "$gt"
+        query = {"$and": [query, {"$or": [
+            {sort_field: {op: sort_value}},
+            {sort_field: sort_value, "_id": {op: doc_id}}
+        ]}]}
+    
+    docs = await collection.find(query, projection).sort(
+        [(sort_field, direction), ("_id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    next_cursor = encode_cursor(docs[-1].get(sort_field), docs[-1]["_id"]) if has_more else None
+    return docs, next_cursor, has_more
+
+def set_page_headers(response: Response, next_cursor: Optional[str], has_more: bool):
+    """معلومات الصفحة التالية في الترويسات حتى يبقى شكل الاستجابة كما هو"""
+    response.headers["X-Next-Cursor"] = next_cursor or ""
+    response.headers["X-Has-More"] = "true" if has_more else "false"
+
+def has_value(field: str) -> dict:
+    """تعبير إسقاط يحسب في الخادم ما إذا كان الحقل غير فارغ دون إرسال محتواه"""
+    return {"$not": [{"$in": [{"$ifNull": [f"${field}", ""]}, [""]]}]}
+
+def parse_fields(fields: Optional[str], allowed) -> Optional[List[str]]:
+    """تحليل معامل fields= (أسماء مفصولة بفواصل) لعرض جزئي للحقول"""
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = set(requested) - set(allowed)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return requested
+
+def list_projection(list_fields: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    """إسقاط Mongo لعرض القوائم: الحقول الخفيفة فقط، أو ما طلبه العميل منها"""
+    if fields is None:
+        return dict(list_fields)
+    return {k: v for k, v in list_fields.items() if k in fields} or {"_id": 1}
+
+def pick_fields(item: dict, fields: Optional[List[str]]) -> dict:
+    if fields is None:
+        return item
+    return {k: v for k, v in item.items() if k == "id" or k in fields}
+
 async def get_admin_user(current_user: dict = Depends(get_current_user)):
     if current_user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
@@ -594,6 +1172,101 @@ async def get_coach_user(current_user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Coach access required")
     return current_user
 
+# ==================== PLATFORM COUNTERS ====================
+
+# اسم العداد -> (المجموعة، شرط المطابقة، الحقل المجمّع أو None للعدّ)
+COUNTER_DEFINITIONS: Dict[str, Tuple[str, dict, Optional[str]]] = {
+    "users.client": ("users", {"role": "client"}, None),
+    "users.coach": ("users", {"role": "coach"}, None),
+    "bookings.total": ("bookings", {}, None),
+    "bookings.revenue": ("bookings", {"payment_status": "completed"}, "amount_paid"),
+    "subscriptions.active": ("subscriptions", {"status": "active"}, None),
+    "packages.total": ("unified_packages", {}, None),
+    "packages.active": ("unified_packages", {"is_active": True}, None),
+    "packages.private_sessions": ("unified_packages", {"category": "private_sessions"}, None),
+    "packages.self_training": ("unified_packages", {"category": "self_training"}, None),
+    "user_subscriptions.total": ("user_subscriptions", {}, None),
+    "user_subscriptions.active": ("user_subscriptions", {"status": "active"}, None),
+    "self_training.packages.total": ("self_training_packages", {}, None),
+    "self_training.packages.active": ("self_training_packages", {"is_active": True}, None),
+    "self_training.subscriptions.total": ("self_training_subscriptions", {}, None),
+    "self_training.subscriptions.active": ("self_training_subscriptions", {"status": "active"}, None),
+    "self_training.revenue": ("self_training_subscriptions", {"payment_status": "paid"}, "amount_paid"),
+    "self_assessments.total": ("self_assessments", {}, None),
+    "self_assessments.completed": ("self_assessments", {"is_complete": True}, None),
+    "generated_plans.total": ("generated_plans", {}, None),
+}
+
+def _counter_weight(doc: Optional[dict], match: dict, field: Optional[str]):
+    if doc is None or any(doc.get(k) != v for k, v in match.items()):
+        return 0
+    return (doc.get(field) or 0) if field else 1
+
+async def track_counters(collection_name: str, before: Optional[dict], after: Optional[dict], count: int = 1):
+    """تحديث العدادات بالفرق بين حالة المستند قبل الكتابة وبعدها (None للإضافة أو الحذف)
+    
+    count لتطبيق نفس الانتقال على عدة مستندات كتبتها update_many واحدة
+    """
+    ops = []
+    for name, (coll, match, field) in COUNTER_DEFINITIONS.items():
+        if coll != collection_name:
+            continue
+        delta = (_counter_weight(after, match, field) - _counter_weight(before, match, field)) * count
+        if delta:
+            ops.append(UpdateOne({"_id": name}, {"$inc": {"value": delta}}, upsert=True))
+    if ops:
+        await db.counters.bulk_write(ops, ordered=False)
+
+async def read_counters(names: List[str]) -> Dict[str, Any]:
+    docs = await db.counters.find({"_id": {"$in": names}}).to_list(len(names))
+    values = {doc["_id"]: doc.get("value", 0) for doc in docs}
+    return {name: values.get(name, 0) for name in names}
+
+async def reconcile_counters():
+    """إعادة حساب جميع العدادات من المجموعات لتصحيح أي انحراف"""
+    ops = []
+    for name, (coll, match, field) in COUNTER_DEFINITIONS.items():
+        if field:
+            result = await db[coll].aggregate([
+                {"$match": match},
+                {"$group": {"_id": None, "total": {"$sum": f"${field}"}}}
+            ]).to_list(1)
+            value = result[0]["total"] if result else 0
+        else:
+            value = await db[coll].count_documents(match)
+        ops.append(UpdateOne(
+            {"_id": name},
+            {"$set": {"value": value, "reconciled_at": datetime.utcnow()}},
+            upsert=True
+        ))
+    await db.counters.bulk_write(ops, ordered=False)
+
+async def acquire_job_lease(job: str, ttl_seconds: float) -> bool:
+    """قفل مؤقت حتى تعمل المهمة الدورية على نسخة واحدة فقط من الخادم"""
+    now = datetime.utcnow()
+    try:
+        await db.job_locks.find_one_and_update(
+            {"_id": job, "$or": [{"expires_at": {"$lte": now}}, {"owner": INSTANCE_ID}]},
+            {"$set": {"owner": INSTANCE_ID, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def reconcile_counters_periodically():
+    while True:
+        try:
+            if await acquire_job_lease("reconcile_counters", COUNTER_RECONCILE_INTERVAL_SECONDS):
+                await reconcile_counters()
+        except PyMongoError as e:
+            logger.warning(f"Counter reconciliation failed: {e}")
+        await asyncio.sleep(COUNTER_RECONCILE_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_counter_reconciliation():
+    start_background_task(reconcile_counters_periodically())
+
 # ==================== AUTH ENDPOINTS ====================
 
 @api_router.post("/auth/register", response_model=TokenResponse)
@@ -608,13 +1281,14 @@ async def register(user_data: UserCreate):
     user_dict = {
         "_id": user_id,
         "email": user_data.email,
-        "password_hash": get_password_hash(user_data.password),
+        "password_hash": await get_password_hash(user_data.password),
         "full_name": user_data.full_name,
         "role": user_data.role,
         "created_at": datetime.utcnow()
     }
     
     await db.users.insert_one(user_dict)
+    await track_counters("users", None, user_dict)
     
     # Create token
     access_token = create_access_token(data={"sub": user_id})
@@ -637,9 +1311,21 @@ async def login(credentials: UserLogin):
     
     # Try both password field names for compatibility
     password_hash = user.get("password_hash") or user.get("hashed_password")
-    if not password_hash or not verify_password(credentials.password, password_hash):
+    if not password_hash:
         raise HTTPException(status_code=401, detail="Incorrect email or password")
     
+    valid, new_hash = await password_hasher.verify_and_update(credentials.password, password_hash)
+    if not valid:
+        raise HTTPException(status_code=401, detail="Incorrect email or password")
+    
+    # Rehash when the configured bcrypt cost has changed
+    if new_hash:
+        await db.users.update_one(
+            {"_id": user["_id"]},
+            {"$set": {"password_hash": new_hash}, "$unset": {"hashed_password": ""}}
+        )
+        invalidate_cached_user(user["_id"])
+    
     access_token = create_access_token(data={"sub": user["_id"]})
     
     user_response = UserResponse(
@@ -703,6 +1389,7 @@ async def google_auth(session_request: GoogleSessionRequest):
                 "created_at": datetime.now(timezone.utc)
             }
             await db.users.insert_one(user_dict)
+            await track_counters("users", None, user_dict)
         
         # Store session in database
         session_token = google_data.get("session_token", str(uuid.uuid4()))
@@ -786,49 +1473,88 @@ async def save_user_result(result_data: SaveResultRequest, current_user: dict =
     await db.user_results.insert_one(result_dict)
     return {"message": "تم حفظ النتيجة بنجاح", "id": result_dict["_id"]}
 
-@api_router.get("/user-results/my-results")
-async def get_my_results(current_user: dict = Depends(get_current_user)):
-    """الحصول على نتائج المتدرب الحالي"""
-    results = await db.user_results.find({"user_id": current_user["_id"]}).sort("saved_at", -1).to_list(1000)
-    
-    # تنظيم النتائج حسب الركيزة
-    organized = {
-        "physical": [],
-        "mental": [],
-        "social": [],
-        "spiritual": []
-    }
+RESULT_PILLARS = ["physical", "mental", "social", "spiritual"]
+RESULT_TREND_WINDOW = 5
+
+def pillar_results_query(user_id: str, pillar: str) -> dict:
+    # النتائج القديمة بلا ركيزة تُعد من الركيزة الجسدية
+    return {"user_id": user_id, "pillar": {"$in": [pillar, None]} if pillar == "physical" else pillar}
+
+async def pillar_result_stats(user_id: str, pillars: List[str]) -> Dict[str, dict]:
+    """عدد النتائج واتجاهها لكل ركيزة: الأحدث والأدنى والأعلى والمتوسط والمتوسط المتحرك لآخر النتائج"""
+    value = {"$convert": {"input": "$result_value", "to": "double", "onError": None, "onNull": None}}
+    docs = await db.user_results.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$sort": {"saved_at": -1, "_id": -1}},
+        {"$set": {"_value": value}},
+        {"$set": {"_has_value": {"$ne": ["$_value", None]}}},
+        {"$group": {
+            "_id": {"$ifNull": ["$pillar", "physical"]},
+            "count": {"$sum": 1},
+            "latest": {"$first": "$result_value"},
+            "latest_at": {"$first": "$saved_at"},
+            "min": {"$min": "$_value"},
+            "max": {"$max": "$_value"},
+            "average": {"$avg": "$_value"},
+            # آخر القيم الرقمية فقط بحجم النافذة، لا تاريخ الركيزة كله
+            "recent": {"$topN": {
+                "n": RESULT_TREND_WINDOW,
+                "sortBy": {"_has_value": -1, "saved_at": -1, "_id": -1},
+                "output": "$_value"
+            }}
+        }},
+        {"$match": {"_id": {"$in": pillars}}},
+        {"$project": {
+            "count": 1, "latest": 1, "latest_at": 1, "min": 1, "max": 1, "average": 1,
+            # $avg يتجاهل null إن كانت القيم الرقمية أقل من النافذة
+            "moving_average": {"$avg": "$recent"}
+        }}
+    ], allowDiskUse=True).to_list(None)
+    return {doc.pop("_id"): doc for doc in docs}
+
+async def grouped_user_results(response: Response, user_id: str, pillar: Optional[str], limit: int, cursor: Optional[str]) -> dict:
+    """النتائج مجمعة حسب الركيزة: صفحة لكل ركيزة مع ملخصها، أو الصفحة التالية لركيزة واحدة"""
+    if pillar is not None and pillar not in RESULT_PILLARS:
+        raise HTTPException(status_code=400, detail="Invalid pillar")
+    if cursor and pillar is None:
+        raise HTTPException(status_code=400, detail="cursor requires pillar")
+    pillars = [pillar] if pillar else RESULT_PILLARS
+    
+    stats, *pages = await asyncio.gather(
+        pillar_result_stats(user_id, pillars),
+        *(paginate(db.user_results, pillar_results_query(user_id, p), "saved_at", limit=limit, cursor=cursor) for p in pillars)
+    )
     
-    for r in results:
-        r["id"] = r.pop("_id")
-        pillar = r.get("pillar", "physical")
-        if pillar in organized:
-            organized[pillar].append(r)
+    organized = {p: [] for p in RESULT_PILLARS}
+    summary = {}
+    for p, (results, next_cursor, has_more) in zip(pillars, pages):
+        for r in results:
+            r["id"] = r.pop("_id")
+        organized[p] = results
+        summary[p] = {
+            "count": 0, "latest": None, "latest_at": None, "min": None, "max": None, "average": None, "moving_average": None,
+            **stats.get(p, {}),
+            "next_cursor": next_cursor,
+            "has_more": has_more
+        }
+    if pillar:
+        set_page_headers(response, summary[pillar]["next_cursor"], summary[pillar]["has_more"])
     
+    organized["summary"] = summary
     return organized
 
+@api_router.get("/user-results/my-results")
+async def get_my_results(response: Response, current_user: dict = Depends(get_current_user), limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX), pillar: Optional[str] = None, cursor: Optional[str] = None):
+    """الحصول على نتائج المتدرب الحالي"""
+    return await grouped_user_results(response, current_user["_id"], pillar, limit, cursor)
+
 @api_router.get("/user-results/trainee/{trainee_id}")
-async def get_trainee_results(trainee_id: str, current_user: dict = Depends(get_current_user)):
+async def get_trainee_results(trainee_id: str, response: Response, current_user: dict = Depends(get_current_user), limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX), pillar: Optional[str] = None, cursor: Optional[str] = None):
     """الحصول على نتائج متدرب معين - متاح للمدرب فقط"""
     if current_user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="غير مصرح")
     
-    results = await db.user_results.find({"user_id": trainee_id}).sort("saved_at", -1).to_list(1000)
-    
-    organized = {
-        "physical": [],
-        "mental": [],
-        "social": [],
-        "spiritual": []
-    }
-    
-    for r in results:
-        r["id"] = r.pop("_id")
-        pillar = r.get("pillar", "physical")
-        if pillar in organized:
-            organized[pillar].append(r)
-    
-    return organized
+    return await grouped_user_results(response, trainee_id, pillar, limit, cursor)
 
 @api_router.delete("/user-results/{result_id}")
 async def delete_user_result(result_id: str, current_user: dict = Depends(get_current_user)):
@@ -856,30 +1582,19 @@ async def get_user_profile_data(user_id: str, current_user: dict = Depends(get_c
     if current_user["_id"] != user_id and current_user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="غير مصرح")
     
-    # بيانات المستخدم
-    user = await db.users.find_one({"_id": user_id})
+    # الاستعلامات مستقلة فتُرسل معاً: المستخدم، النتائج المحفوظة، استبيان القبول، متتبع العادات، الحجوزات
+    user, results, intake, habits, bookings = await asyncio.gather(
+        db.users.find_one({"_id": user_id}, {"full_name": 1, "email": 1, "created_at": 1}),
+        db.user_results.find({"user_id": user_id}).sort("saved_at", -1).to_list(1000),
+        db.intake_questionnaire.find_one({"user_id": user_id}),
+        db.habit_tracker.find({"user_id": user_id}).sort("date", -1).to_list(100),
+        db.bookings.find({"user_id": user_id}).to_list(100)
+    )
     if not user:
         raise HTTPException(status_code=404, detail="المستخدم غير موجود")
     
-    # النتائج المحفوظة
-    results = await db.user_results.find({"user_id": user_id}).sort("saved_at", -1).to_list(1000)
-    for r in results:
-        r["id"] = r.pop("_id")
-    
-    # استبيان القبول
-    intake = await db.intake_questionnaire.find_one({"user_id": user_id})
-    if intake:
-        intake["id"] = intake.pop("_id")
-    
-    # متتبع العادات
-    habits = await db.habit_tracker.find({"user_id": user_id}).sort("date", -1).to_list(100)
-    for h in habits:
-        h["id"] = h.pop("_id")
-    
-    # الحجوزات
-    bookings = await db.bookings.find({"user_id": user_id}).to_list(100)
-    for b in bookings:
-        b["id"] = b.pop("_id")
+    for doc in [*results, *habits, *bookings, *([intake] if intake else [])]:
+        doc["id"] = doc.pop("_id")
     
     return {
         "user_id": user_id,
@@ -898,25 +1613,49 @@ async def get_all_trainees_profiles(current_user: dict = Depends(get_current_use
     if current_user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="غير مصرح")
     
-    # الحصول على جميع المتدربين الذين لديهم حجوزات
-    bookings = await db.bookings.find({"booking_status": {"$in": ["confirmed", "active", "completed"]}}).to_list(1000)
-    trainee_ids = list(set([b["client_id"] for b in bookings]))
-    
-    trainees_data = []
-    for trainee_id in trainee_ids:
-        user = await db.users.find_one({"_id": trainee_id})
-        if user:
-            results_count = await db.user_results.count_documents({"user_id": trainee_id})
-            has_intake = await db.intake_questionnaire.count_documents({"user_id": trainee_id}) > 0
-            
-            trainees_data.append({
-                "user_id": trainee_id,
-                "full_name": user.get("full_name", ""),
-                "email": user.get("email", ""),
-                "results_count": results_count,
-                "has_intake": has_intake,
-                "created_at": user.get("created_at")
-            })
+    # المتدربون الذين لديهم حجوزات، مع عدد النتائج ووجود الاستبيان في تجميع واحد
+    trainees_data = await db.bookings.aggregate([
+        {"$match": {"booking_status": {"$in": ["confirmed", "active", "completed"]}}},
+        {"$group": {"_id": "$client_id"}},
+        {"$lookup": {
+            "from": "users",
+            "let": {"user_id": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", "$$user_id"]}}},
+                {"$project": {"full_name": 1, "email": 1, "created_at": 1}}
+            ],
+            "as": "user"
+        }},
+        {"$unwind": "$user"},
+        {"$lookup": {
+            "from": "user_results",
+            "let": {"user_id": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
+                {"$count": "n"}
+            ],
+            "as": "results"
+        }},
+        {"$lookup": {
+            "from": "intake_questionnaire",
+            "let": {"user_id": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
+                {"$limit": 1},
+                {"$project": {"_id": 1}}
+            ],
+            "as": "intake"
+        }},
+        {"$project": {
+            "_id": 0,
+            "user_id": "$_id",
+            "full_name": {"$ifNull": ["$user.full_name", ""]},
+            "email": {"$ifNull": ["$user.email", ""]},
+            "results_count": {"$ifNull": [{"$first": "$results.n"}, 0]},
+            "has_intake": {"$gt": [{"$size": "$intake"}, 0]},
+            "created_at": "$user.created_at"
+        }}
+    ], allowDiskUse=True).to_list(None)
     
     return trainees_data
 
@@ -1002,6 +1741,7 @@ async def create_booking(booking: dict, current_user: dict = Depends(get_current
     }
     
     await db.bookings.insert_one(booking_dict)
+    await track_counters("bookings", None, booking_dict)
     
     return {"message": "Booking created", "booking_id": booking_id}
 
@@ -1012,21 +1752,25 @@ async def confirm_booking(booking_id: str, current_user: dict = Depends(get_curr
         raise HTTPException(status_code=404, detail="Booking not found")
     
     # Update booking status
-    await db.bookings.update_one(
-        {"_id": booking_id},
-        {"$set": {"payment_status": "completed", "booking_status": "confirmed"}}
-    )
+    update = {"payment_status": "completed", "booking_status": "confirmed"}
+    previous = await db.bookings.find_one_and_update({"_id": booking_id}, {"$set": update})
+    if previous:
+        await track_counters("bookings", previous, {**previous, **update})
     
     return {"message": "Booking confirmed"}
 
 @api_router.get("/bookings/my-bookings")
-async def get_my_bookings(current_user: dict = Depends(get_current_user)):
-    bookings = await db.bookings.find({"client_id": current_user["_id"]}).sort("created_at", -1).to_list(100)
+async def get_my_bookings(response: Response, current_user: dict = Depends(get_current_user), limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX), cursor: Optional[str] = None):
+    bookings, next_cursor, has_more = await paginate(
+        db.bookings, {"client_id": current_user["_id"]}, "created_at", limit=limit, cursor=cursor, unpaged_limit=100
+    )
+    set_page_headers(response, next_cursor, has_more)
     
     # Enrich with coach info
+    coaches = await fetch_by_ids(db.users, [b.get("coach_id") for b in bookings], USER_SUMMARY_PROJECTION)
     result = []
     for booking in bookings:
-        coach = await db.users.find_one({"_id": booking.get("coach_id")})
+        coach = coaches.get(booking.get("coach_id"))
         result.append({
             "id": booking["_id"],
             "coach_id": booking.get("coach_id"),
@@ -1044,18 +1788,18 @@ async def get_my_bookings(current_user: dict = Depends(get_current_user)):
     return result
 
 @api_router.get("/coach/my-clients")
-async def get_coach_clients(coach_user: dict = Depends(get_coach_user)):
+async def get_coach_clients(response: Response, coach_user: dict = Depends(get_coach_user), limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX), cursor: Optional[str] = None):
     # للأدمن: عرض جميع الحجوزات
     # للمدرب العادي: عرض حجوزاته فقط
-    if coach_user.get("role") == "admin":
-        bookings = await db.bookings.find().sort("created_at", -1).to_list(100)
-    else:
-        bookings = await db.bookings.find({"coach_id": coach_user["_id"]}).sort("created_at", -1).to_list(100)
+    query = {} if coach_user.get("role") == "admin" else {"coach_id": coach_user["_id"]}
+    bookings, next_cursor, has_more = await paginate(db.bookings, query, "created_at", limit=limit, cursor=cursor, unpaged_limit=100)
+    set_page_headers(response, next_cursor, has_more)
     
     # Enrich with client info
+    clients = await fetch_by_ids(db.users, [b.get("client_id") for b in bookings], USER_SUMMARY_PROJECTION)
     result = []
     for booking in bookings:
-        client = await db.users.find_one({"_id": booking.get("client_id")})
+        client = clients.get(booking.get("client_id"))
         result.append({
             "id": booking["_id"],
             "client_id": booking.get("client_id"),
@@ -1095,28 +1839,58 @@ async def update_booking_status(booking_id: str, data: dict, coach_user: dict =
         update["hours_used"] = data["hours_used"]
     
     if update:
-        await db.bookings.update_one({"_id": booking_id}, {"$set": update})
+        previous = await db.bookings.find_one_and_update({"_id": booking_id}, {"$set": update})
+        if previous:
+            await track_counters("bookings", previous, {**previous, **update})
     
     return {"message": "Booking updated"}
 
 @api_router.get("/bookings/all", response_model=List[BookingResponse])
-async def get_all_bookings(admin_user: dict = Depends(get_admin_user)):
-    bookings = await db.bookings.find().sort("created_at", -1).to_list(1000)
+async def get_all_bookings(response: Response, admin_user: dict = Depends(get_admin_user), limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX), cursor: Optional[str] = None):
+    bookings, next_cursor, has_more = await paginate(db.bookings, {}, "created_at", limit=limit, cursor=cursor)
+    set_page_headers(response, next_cursor, has_more)
     return [BookingResponse(**booking, id=booking["_id"]) for booking in bookings]
 
 # ==================== SESSION TRACKING ENDPOINTS ====================
 
+def booking_hours_guard(delta: float) -> dict:
+    """شرط تعديل ساعات الحجز: لا تقل عن صفر، والزيادة فقط لا تتجاوز الساعات المشتراة إن كانت محددة
+    
+    التخفيض مسموح دائماً حتى على حجوزات تجاوزت ساعاتها قبل وجود هذا الشرط
+    """
+    hours_used = {"$add": [{"$ifNull": ["$hours_used", 0]}, delta]}
+    if delta <= 0:
+        return {"$expr": {"$gte": [hours_used, 0]}}
+    return {"$expr": {"$or": [
+        {"$not": [{"$isNumber": "$hours_purchased"}]},
+        {"$lte": [hours_used, "$hours_purchased"]}
+    ]}}
+
+async def inc_booking_hours(booking_query: dict, delta: float, projection: Optional[dict] = None) -> dict:
+    """$inc ذري لساعات الحجز مع الشرط؛ القراءة الإضافية فقط لتحديد سبب الرفض"""
+    booking = await db.bookings.find_one_and_update(
+        {**booking_query, **booking_hours_guard(delta)},
+        {"$inc": {"hours_used": delta}},
+        projection=projection or {"_id": 1}
+    )
+    if booking is not None:
+        return booking
+    if await db.bookings.find_one(booking_query, {"_id": 1}) is None:
+        raise HTTPException(status_code=404, detail="Booking not found")
+    if delta < 0:
+        raise HTTPException(status_code=400, detail="Booking hours used cannot go below zero")
+    raise HTTPException(status_code=400, detail="Session hours exceed the booking's purchased hours")
+
 @api_router.post("/sessions/create")
 async def create_session(session_data: SessionCreate, coach_user: dict = Depends(get_coach_user)):
     """Create a new training session"""
     # للأدمن: يمكنه إنشاء جلسة لأي حجز
-    if coach_user.get("role") == "admin":
-        booking = await db.bookings.find_one({"_id": session_data.booking_id})
-    else:
-        booking = await db.bookings.find_one({"_id": session_data.booking_id, "coach_id": coach_user["_id"]})
+    booking_query = {"_id": session_data.booking_id}
+    if coach_user.get("role") != "admin":
+        booking_query["coach_id"] = coach_user["_id"]
     
-    if not booking:
-        raise HTTPException(status_code=404, detail="Booking not found")
+    # Reserve the hours first; the session insert is the second and last write
+    booking = await inc_booking_hours(booking_query, session_data.duration_hours, {"client_id": 1})
     
     # Create session record
     session_id = str(uuid.uuid4())
@@ -1132,33 +1906,29 @@ async def create_session(session_data: SessionCreate, coach_user: dict = Depends
         "created_at": datetime.utcnow()
     }
     
-    await db.sessions.insert_one(session_dict)
-    
-    # Update booking hours used
-    current_hours_used = booking.get("hours_used", 0)
-    new_hours_used = current_hours_used + session_data.duration_hours
-    
-    await db.bookings.update_one(
-        {"_id": session_data.booking_id},
-        {"$set": {"hours_used": new_hours_used}}
-    )
+    try:
+        await db.sessions.insert_one(session_dict)
+    except PyMongoError:
+        await db.bookings.update_one({"_id": session_data.booking_id}, {"$inc": {"hours_used": -session_data.duration_hours}})
+        raise
     
     return {"message": "Session created", "session_id": session_id}
 
 @api_router.get("/sessions/my-sessions")
-async def get_coach_sessions(coach_user: dict = Depends(get_coach_user)):
+async def get_coach_sessions(response: Response, coach_user: dict = Depends(get_coach_user), limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX), cursor: Optional[str] = None):
     """Get all sessions for the coach"""
     # للأدمن: عرض جميع الجلسات
-    if coach_user.get("role") == "admin":
-        sessions = await db.sessions.find().sort("session_date", -1).to_list(1000)
-    else:
-        sessions = await db.sessions.find({"coach_id": coach_user["_id"]}).sort("session_date", -1).to_list(1000)
+    query = {} if coach_user.get("role") == "admin" else {"coach_id": coach_user["_id"]}
+    sessions, next_cursor, has_more = await paginate(db.sessions, query, "session_date", limit=limit, cursor=cursor)
+    set_page_headers(response, next_cursor, has_more)
+    
+    clients = await fetch_by_ids(db.users, [s["client_id"] for s in sessions], USER_SUMMARY_PROJECTION)
+    bookings = await fetch_by_ids(db.bookings, [s["booking_id"] for s in sessions], {"package_name": 1})
     
     result = []
     for session in sessions:
-        # Get client info
-        client = await db.users.find_one({"_id": session["client_id"]})
-        booking = await db.bookings.find_one({"_id": session["booking_id"]})
+        client = clients.get(session["client_id"])
+        booking = bookings.get(session["booking_id"])
         
         result.append({
             "id": session["_id"],
@@ -1175,15 +1945,20 @@ async def get_coach_sessions(coach_user: dict = Depends(get_coach_user)):
     return result
 
 @api_router.get("/sessions/client-sessions")
-async def get_client_sessions(current_user: dict = Depends(get_current_user)):
+async def get_client_sessions(response: Response, current_user: dict = Depends(get_current_user), limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX), cursor: Optional[str] = None):
     """Get all sessions for the client"""
-    sessions = await db.sessions.find({"client_id": current_user["_id"]}).sort("session_date", -1).to_list(1000)
+    sessions, next_cursor, has_more = await paginate(
+        db.sessions, {"client_id": current_user["_id"]}, "session_date", limit=limit, cursor=cursor
+    )
+    set_page_headers(response, next_cursor, has_more)
+    
+    coaches = await fetch_by_ids(db.users, [s["coach_id"] for s in sessions], USER_SUMMARY_PROJECTION)
+    bookings = await fetch_by_ids(db.bookings, [s["booking_id"] for s in sessions], {"package_name": 1})
     
     result = []
     for session in sessions:
-        # Get coach info
-        coach = await db.users.find_one({"_id": session["coach_id"]})
-        booking = await db.bookings.find_one({"_id": session["booking_id"]})
+        coach = coaches.get(session["coach_id"])
+        booking = bookings.get(session["booking_id"])
         
         result.append({
             "id": session["_id"],
@@ -1207,21 +1982,13 @@ async def update_session(session_id: str, data: dict, coach_user: dict = Depends
         raise HTTPException(status_code=404, detail="Session not found")
     
     update_data = {}
+    duration_diff = 0
     if "duration_hours" in data:
-        # If duration changed, update booking hours
-        old_duration = session["duration_hours"]
-        new_duration = data["duration_hours"]
-        duration_diff = new_duration - old_duration
-        
-        booking = await db.bookings.find_one({"_id": session["booking_id"]})
-        if booking:
-            new_hours_used = booking.get("hours_used", 0) + duration_diff
-            await db.bookings.update_one(
-                {"_id": session["booking_id"]},
-                {"$set": {"hours_used": new_hours_used}}
-            )
-        
-        update_data["duration_hours"] = new_duration
+        # If duration changed, move the difference atomically on the booking
+        duration_diff = data["duration_hours"] - session["duration_hours"]
+        if duration_diff:
+            await inc_booking_hours({"_id": session["booking_id"]}, duration_diff)
+        update_data["duration_hours"] = data["duration_hours"]
     
     if "session_type" in data:
         update_data["session_type"] = data["session_type"]
@@ -1232,7 +1999,15 @@ async def update_session(session_id: str, data: dict, coach_user: dict = Depends
     
     if update_data:
         update_data["updated_at"] = datetime.utcnow()
-        await db.sessions.update_one({"_id": session_id}, {"$set": update_data})
+        # المدة السابقة جزء من الشرط حتى لا يُحتسب فرق تعديلين متزامنين مرتين
+        result = await db.sessions.update_one(
+            {"_id": session_id, "duration_hours": session["duration_hours"]},
+            {"$set": update_data}
+        )
+        if result.matched_count == 0:
+            if duration_diff:
+                await db.bookings.update_one({"_id": session["booking_id"]}, {"$inc": {"hours_used": -duration_diff}})
+            raise HTTPException(status_code=409, detail="Session is being updated, please retry")
     
     return {"message": "Session updated"}
 
@@ -1241,24 +2016,19 @@ async def delete_session(session_id: str, coach_user: dict = Depends(get_coach_u
     """Delete a session"""
     # للأدمن: يمكنه حذف أي جلسة
     # للمدرب: يمكنه حذف جلساته فقط
-    if coach_user["role"] == "admin":
-        session = await db.sessions.find_one({"_id": session_id})
-    else:
-        session = await db.sessions.find_one({"_id": session_id, "coach_id": coach_user["_id"]})
+    session_query = {"_id": session_id}
+    if coach_user["role"] != "admin":
+        session_query["coach_id"] = coach_user["_id"]
+    session = await db.sessions.find_one_and_delete(session_query, projection={"booking_id": 1, "duration_hours": 1})
     
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    # Update booking hours (subtract the session duration)
-    booking = await db.bookings.find_one({"_id": session["booking_id"]})
-    if booking:
-        new_hours_used = max(0, booking.get("hours_used", 0) - session.get("duration_hours", 0))
-        await db.bookings.update_one(
-            {"_id": session["booking_id"]},
-            {"$set": {"hours_used": new_hours_used}}
-        )
-    
-    await db.sessions.delete_one({"_id": session_id})
+    # Update booking hours (subtract the session duration, never below zero)
+    await db.bookings.update_one(
+        {"_id": session["booking_id"]},
+        [{"$set": {"hours_used": {"$max": [0, {"$subtract": [{"$ifNull": ["$hours_used", 0]}, session.get("duration_hours", 0)]}]}}}]
+    )
     return {"message": "Session deleted"}
 
 @api_router.get("/sessions/stats")
@@ -1292,103 +2062,630 @@ async def get_session_stats(coach_user: dict = Depends(get_coach_user)):
         "active_clients": len(active_clients)
     }
 
+# ==================== MESSAGE ATTACHMENTS ====================
+
+def attachment_filename(attachment: dict, user_id: str) -> Optional[str]:
+    """اسم الملف كما رفعه هذا المستخدم - المحتوى مشترك بين الرافعين لكن لكل منهم اسمه"""
+    return attachment.get("filenames", {}).get(user_id) or attachment.get("filename")
+
+def attachment_summary(attachment: dict, user_id: str) -> dict:
+    return {
+        "id": attachment["_id"],
+        "size": attachment["size"],
+        "content_type": attachment["content_type"],
+        "filename": attachment_filename(attachment, user_id)
+    }
+
+def message_attachment_fields(attachment: dict, user_id: str) -> dict:
+    return {
+        "attachment_id": attachment["_id"],
+        "attachment_size": attachment["size"],
+        "attachment_type": attachment["content_type"],
+        "attachment_name": attachment_filename(attachment, user_id)
+    }
+
+async def claim_attachment(attachment_id: str, filename: str, user_id: str) -> Optional[dict]:
+    """إضافة رافع جديد لمرفق موجود مع اسمه، وتحديث last_used_at حتى لا يحذفه جامع المرفقات"""
+    return await db.attachments.find_one_and_update(
+        {"_id": attachment_id},
+        {"$addToSet": {"uploaders": user_id}, "$set": {f"filenames.{user_id}": filename, "last_used_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def store_attachment(chunks: AsyncIterator[bytes], filename: str, content_type: str, user_id: str) -> dict:
+    """تخزين مرفق في GridFS بمعرف هو بصمة sha256 للمحتوى - المحتوى المكرر يُخزن مرة واحدة
+
+    تمريرة واحدة: البايتات تُكتب إلى GridFS وتُحسب بصمتها أثناء استلامها، فيُرفض الملف الكبير
+    قبل قراءته كاملاً، وتُحذف النسخة الجديدة إن كان المحتوى مخزناً من قبل
+    """
+    digest = hashlib.sha256()
+    size = 0
+    grid_in = attachments_fs.open_upload_stream(filename, metadata={"content_type": content_type})
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > ATTACHMENT_MAX_BYTES:
+                raise HTTPException(status_code=413, detail="Attachment too large")
+            digest.update(chunk)
+            await grid_in.write(chunk)
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Empty attachment")
+        await grid_in.close()
+    except BaseException:
+        await grid_in.abort()
+        raise
+    attachment_id = digest.hexdigest()
+    
+    existing = await claim_attachment(attachment_id, filename, user_id)
+    if existing:
+        await attachments_fs.delete(grid_in._id)
+        return existing
+    
+    now = datetime.utcnow()
+    attachment = {
+        "_id": attachment_id,
+        "file_id": grid_in._id,
+        "size": size,
+        "content_type": content_type,
+        "uploaders": [user_id],
+        "filenames": {user_id: filename},
+        "created_at": now,
+        "last_used_at": now
+    }
+    try:
+        await db.attachments.insert_one(attachment)
+    except DuplicateKeyError:
+        # رفع متزامن لنفس المحتوى - نحتفظ بالنسخة الأولى
+        await attachments_fs.delete(grid_in._id)
+        attachment = await claim_attachment(attachment_id, filename, user_id)
+    return attachment
+
+async def store_inline_attachment(data: str, user_id: str) -> dict:
+    """تخزين مرفق base64 القديم (مع بادئة data: URI اختيارية)"""
+    content_type = "application/octet-stream"
+    if data.startswith("data:") and "," in data:
+        header, data = data.split(",", 1)
+        content_type = header[5:].split(";")[0] or content_type
+    try:
+        raw = base64.b64decode(data)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid attachment encoding")
+    
+    async def read_chunks():
+        for offset in range(0, len(raw), ATTACHMENT_CHUNK_SIZE):
+            yield raw[offset:offset + ATTACHMENT_CHUNK_SIZE]
+    
+    return await store_attachment(read_chunks(), "attachment", content_type, user_id)
+
+def parse_byte_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """تحليل ترويسة Range (مدى واحد) إلى (البداية، النهاية) شاملة"""
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start_str, _, end_str = spec.strip().partition("-")
+    try:
+        if start_str:
+            start = int(start_str)
+            end = min(int(end_str), size - 1) if end_str else size - 1
+        else:
+            start, end = max(size - int(end_str), 0), size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+@api_router.post("/attachments")
+async def upload_attachment(request: Request, filename: str = Query("attachment", min_length=1, max_length=255), current_user: dict = Depends(get_current_user)):
+    """رفع مرفق: جسم الطلب هو محتوى الملف ونوعه في Content-Type، ويُكتب إلى GridFS أثناء استلامه
+
+    يُعاد المعرف لإرساله مع الرسالة
+    """
+    declared_size = request.headers.get("content-length", "")
+    if declared_size.isdigit() and int(declared_size) > ATTACHMENT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Attachment too large")
+    
+    attachment = await store_attachment(
+        request.stream(),
+        filename,
+        request.headers.get("content-type") or "application/octet-stream",
+        current_user["_id"]
+    )
+    return attachment_summary(attachment, current_user["_id"])
+
+@api_router.get("/attachments/{attachment_id}")
+async def download_attachment(attachment_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    """تنزيل مرفق بالتدفق مع دعم طلبات المدى (Range) - للرافع وأطراف المحادثة"""
+    attachment = await db.attachments.find_one({"_id": attachment_id})
+    if not attachment:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    
+    if current_user.get("role") != "admin" and current_user["_id"] not in attachment.get("uploaders", []):
+        shared = await db.messages.find_one(
+            {"attachment_id": attachment_id, "$or": [{"sender_id": current_user["_id"]}, {"recipient_id": current_user["_id"]}]},
+            {"_id": 1}
+        )
+        if not shared:
+            raise HTTPException(status_code=404, detail="Attachment not found")
+    
+    etag = f'"{attachment_id}"'
+    cache_control = "private, max-age=31536000, immutable"
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+    
+    size = attachment["size"]
+    byte_range = parse_byte_range(request.headers.get("range"), size)
+    start, end = byte_range or (0, size - 1)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(end - start + 1),
+        "ETag": etag,
+        "Cache-Control": cache_control
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    
+    grid_out = await attachments_fs.open_download_stream(attachment["file_id"])
+    grid_out.seek(start)
+    
+    async def stream():
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await grid_out.read(min(ATTACHMENT_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    
+    return StreamingResponse(
+        stream(),
+        status_code=206 if byte_range else 200,
+        media_type=attachment["content_type"],
+        headers=headers
+    )
+
+async def migrate_message_attachments() -> int:
+    """نقل مرفقات base64 المخزنة داخل الرسائل إلى مخزن المرفقات"""
+    migrated = 0
+    async for message in db.messages.find({"attachment": {"$type": "string", "$ne": ""}}, {"attachment": 1, "sender_id": 1}):
+        try:
+            attachment = await store_inline_attachment(message["attachment"], message["sender_id"])
+        except HTTPException as e:
+            logger.warning(f"Skipping attachment of message {message['_id']}: {e.detail}")
+            continue
+        await db.messages.update_one(
+            {"_id": message["_id"]},
+            {"$set": message_attachment_fields(attachment, message["sender_id"]), "$unset": {"attachment": ""}}
+        )
+        migrated += 1
+    logger.info(f"Migrated {migrated} message attachments")
+    return migrated
+
+async def collect_unreferenced_attachments() -> int:
+    """حذف المرفقات التي لا تشير إليها أي رسالة (رُفعت ولم تُرسل، أو حُذفت رسائلها) وملفات GridFS اليتيمة
+
+    الحذف مشروط بأن last_used_at ما زال قديماً، فإرسال رسالة بالمرفق أثناء الجمع يمنع حذفه
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=ATTACHMENT_GC_GRACE_SECONDS)
+    stale = {"$or": [
+        {"last_used_at": {"$lt": cutoff}},
+        {"last_used_at": {"$exists": False}, "created_at": {"$lt": cutoff}}
+    ]}
+    removed = 0
+    async for attachment in db.attachments.find(stale, {"file_id": 1}):
+        if await db.messages.find_one({"attachment_id": attachment["_id"]}, {"_id": 1}):
+            continue
+        result = await db.attachments.delete_one({"_id": attachment["_id"], **stale})
+        if result.deleted_count:
+            await attachments_fs.delete(attachment["file_id"])
+            removed += 1
+    
+    # ملفات بلا مستند مرفق: رفع انقطع قبل التسجيل أو فشل حذف نسخة مكررة
+    async for grid_out in attachments_fs.find({"uploadDate": {"$lt": cutoff}}):
+        if not await db.attachments.find_one({"file_id": grid_out._id}, {"_id": 1}):
+            await attachments_fs.delete(grid_out._id)
+            removed += 1
+    if removed:
+        logger.info(f"Removed {removed} unreferenced attachments")
+    return removed
+
+async def collect_attachments_periodically():
+    while True:
+        try:
+            if await acquire_job_lease("collect_attachments", ATTACHMENT_GC_INTERVAL_SECONDS):
+                await collect_unreferenced_attachments()
+        except PyMongoError as e:
+            logger.warning(f"Attachment collection failed: {e}")
+        await asyncio.sleep(ATTACHMENT_GC_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_attachment_collector():
+    start_background_task(collect_attachments_periodically())
+
+# ==================== PROFILE IMAGES ====================
+
+def render_image_variants(raw: bytes, content_type: str) -> Dict[str, Tuple[bytes, str]]:
+    """الصورة الأصلية ومصغرات JPEG مربعة الحدود - تعمل في خيط منفصل لأنها تستهلك المعالج"""
+    variants = {"original": (raw, content_type)}
+    if Image is None:
+        return variants
+    with Image.open(io.BytesIO(raw)) as img:
+        variants["original"] = (raw, Image.MIME.get(img.format, content_type))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        for size in PROFILE_IMAGE_SIZES:
+            thumb = img.copy()
+            thumb.thumbnail((size, size))
+            out = io.BytesIO()
+            thumb.save(out, format="JPEG", quality=85, optimize=True)
+            variants[str(size)] = (out.getvalue(), "image/jpeg")
+    return variants
+
+def profile_image_id_from_url(value: str) -> Optional[str]:
+    marker = "/api/images/"
+    if marker not in value:
+        return None
+    return value.split(marker, 1)[1].split("/", 1)[0] or None
+
+async def ingest_profile_image(value: Optional[str]) -> Optional[str]:
+    """تخزين صورة (data URI أو base64) مرة واحدة ببصمتها وتوليد المصغرات، ويُعاد المعرف"""
+    if not value:
+        return None
+    existing_id = profile_image_id_from_url(value)
+    if existing_id:
+        return existing_id
+    
+    content_type = "image/jpeg"
+    data = value
+    if data.startswith("data:") and "," in data:
+        header, data = data.split(",", 1)
+        content_type = header[5:].split(";")[0] or content_type
+    try:
+        raw = base64.b64decode(data)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid image encoding")
+    if len(raw) > PROFILE_IMAGE_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Image too large")
+    
+    image_id = hashlib.sha256(raw).hexdigest()
+    if await db.profile_images.find_one({"_id": f"{image_id}:original"}, {"_id": 1}):
+        return image_id
+    
+    try:
+        variants = await asyncio.get_running_loop().run_in_executor(None, render_image_variants, raw, content_type)
+    except IMAGE_DECODE_ERRORS:
+        raise HTTPException(status_code=400, detail="Unsupported image")
+    
+    now = datetime.utcnow()
+    await db.profile_images.bulk_write([
+        UpdateOne(
+            {"_id": f"{image_id}:{variant}"},
+            {"$setOnInsert": {"image_id": image_id, "variant": variant, "data": body, "content_type": variant_type, "created_at": now}},
+            upsert=True
+        )
+        for variant, (body, variant_type) in variants.items()
+    ], ordered=False)
+    return image_id
+
+def profile_image_url(*docs: Optional[dict], size: int = PROFILE_IMAGE_LIST_SIZE) -> Optional[str]:
+    """رابط أول صورة متوفرة في المستندات المعطاة (بالترتيب)"""
+    for doc in docs:
+        if not doc:
+            continue
+        if doc.get("profile_image_id"):
+            return f"{PUBLIC_BASE_URL}/api/images/{doc['profile_image_id']}/{size}"
+        if doc.get("profile_image"):
+            # لم تُرحّل بعد
+            return doc["profile_image"]
+    return None
+
+PROFILE_IMAGE_PROJECTION = {"profile_image_id": 1, "profile_image": 1}
+
+@api_router.get("/images/{image_id}/{size}")
+async def get_profile_image(image_id: str, size: str, request: Request):
+    """صورة ملف شخصي بمقاس محدد - المحتوى ثابت لكل معرف لذا يُخزن مؤقتاً بلا انتهاء"""
+    etag = f'"{image_id}:{size}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    image = await db.profile_images.find_one({"_id": f"{image_id}:{size}"})
+    if image is None:
+        # بدون Pillow لا توجد مصغرات، نخدم الأصل
+        image = await db.profile_images.find_one({"_id": f"{image_id}:original"})
+    if image is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return Response(content=bytes(image["data"]), media_type=image["content_type"], headers=headers)
+
+async def migrate_profile_images() -> int:
+    """تحويل profile_image المضمنة في users و coach_profiles إلى profile_image_id"""
+    migrated = 0
+    for collection in (db.users, db.coach_profiles):
+        async for doc in collection.find({"profile_image": {"$type": "string", "$ne": ""}}, {"profile_image": 1, "user_id": 1}):
+            try:
+                image_id = await ingest_profile_image(doc["profile_image"])
+            except HTTPException as e:
+                logger.warning(f"Skipping profile image of {doc['_id']}: {e.detail}")
+                continue
+            await collection.update_one(
+                {"_id": doc["_id"], "profile_image": doc["profile_image"]},
+                {"$set": {"profile_image_id": image_id}, "$unset": {"profile_image": ""}}
+            )
+            invalidate_cached_user(doc.get("user_id", doc["_id"]))
+            migrated += 1
+    if migrated:
+        catalog_cache.invalidate("coaches")
+        logger.info(f"Migrated {migrated} profile images")
+    return migrated
+
+@app.on_event("startup")
+async def start_profile_image_migration():
+    start_background_task(migrate_profile_images())
+
 # ==================== MESSAGING ENDPOINTS ====================
 
+def conversation_id(user_a: str, user_b: str) -> str:
+    """معرف المحادثة مبني على زوج المشاركين المرتب"""
+    return ":".join(sorted([user_a, user_b]))
+
+def conversation_summary(conversation: Optional[dict], user_id: str) -> dict:
+    """آخر رسالة وعدد غير المقروء من منظور أحد المشاركين"""
+    if not conversation:
+        return {"last_message": "", "last_message_time": None, "unread_count": 0}
+    return {
+        "last_message": conversation.get("last_message", ""),
+        "last_message_time": conversation.get("last_message_time"),
+        "unread_count": conversation.get("unread", {}).get(user_id, 0)
+    }
+
+async def record_conversation_message(message_dict: dict):
+    """تحديث فهرس المحادثة ذرياً عند إرسال رسالة"""
+    sender_id = message_dict["sender_id"]
+    recipient_id = message_dict["recipient_id"]
+    await db.conversations.update_one(
+        {"_id": conversation_id(sender_id, recipient_id)},
+        {
+            "$set": {
+                "participants": sorted([sender_id, recipient_id]),
+                "last_message": message_dict.get("message", ""),
+                "last_message_time": message_dict["timestamp"],
+                "last_sender_id": sender_id
+            },
+            "$inc": {f"unread.{recipient_id}": 1, f"unread.{sender_id}": 0}
+        },
+        upsert=True
+    )
+
+async def mark_conversation_read(user_id: str, partner_id: str, count: int):
+    """إنقاص عداد غير المقروء لطرف واحد بعدد الرسائل التي عُلّمت فعلاً
+
+    التصفير المباشر يمحو رسائل وصلت بين تعليم القراءة وتحديث المحادثة
+    """
+    if not count:
+        return
+    field = f"unread.{user_id}"
+    await db.conversations.update_one(
+        {"_id": conversation_id(user_id, partner_id)},
+        [{"$set": {field: {"$max": [{"$subtract": [{"$ifNull": [f"${field}", 0]}, count]}, 0]}}}]
+    )
+
+async def rebuild_conversations():
+    """إعادة بناء فهرس المحادثات بالكامل من مجموعة الرسائل"""
+    pair_id = {"$cond": [
+        {"$lt": ["$sender_id", "$recipient_id"]},
+        {"$concat": ["$sender_id", ":", "$recipient_id"]},
+        {"$concat": ["$recipient_id", ":", "$sender_id"]}
+    ]}
+    pipeline = [
+        {"$sort": {"timestamp": 1}},
+        {"$group": {
+            "_id": {"pair": pair_id, "recipient_id": "$recipient_id"},
+            "unread": {"$sum": {"$cond": [{"$eq": ["$read", False]}, 1, 0]}},
+            "last_message": {"$last": "$message"},
+            "last_message_time": {"$last": "$timestamp"},
+            "last_sender_id": {"$last": "$sender_id"}
+        }},
+        {"$sort": {"last_message_time": 1}},
+        {"$group": {
+            "_id": "$_id.pair",
+            "unread": {"$push": {"k": "$_id.recipient_id", "v": "$unread"}},
+            "last_message": {"$last": "$last_message"},
+            "last_message_time": {"$last": "$last_message_time"},
+            "last_sender_id": {"$last": "$last_sender_id"}
+        }},
+        {"$project": {
+            "participants": {"$split": ["$_id", ":"]},
+            "unread": {"$arrayToObject": "$unread"},
+            "last_message": 1,
+            "last_message_time": 1,
+            "last_sender_id": 1
+        }},
+        {"$merge": {"into": "conversations", "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ]
+    await db.messages.aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+async def adjust_unread(user_id: str, delta: int):
+    """تعديل إجمالي غير المقروء للمستخدم ودفع التغيير إلى غرفته"""
+    if not delta:
+        return
+    counter = await db.unread_counts.find_one_and_update(
+        {"_id": user_id},
+        {"$inc": {"total": delta}},
+        return_document=ReturnDocument.AFTER
+    )
+    if counter is None:
+        # أول تعديل لهذا المستخدم: البذرة من الرسائل وهي تشمل التغيير الحالي
+        total = await seed_unread_count(user_id)
+    else:
+        total = max(counter["total"], 0)
+    await emit_to_user('unread_count', {"unread_count": total, "delta": delta}, user_id)
+
+async def seed_unread_count(user_id: str) -> int:
+    total = await db.messages.count_documents({"recipient_id": user_id, "read": False})
+    counter = await db.unread_counts.find_one_and_update(
+        {"_id": user_id},
+        {"$setOnInsert": {"total": total}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return max(counter["total"], 0)
+
+async def mark_read_from(user_id: str, partner_id: str) -> int:
+    """تعليم رسائل طرف واحد كمقروءة وتحديث المحادثة وإجمالي غير المقروء"""
+    result = await db.messages.update_many(
+        {"sender_id": partner_id, "recipient_id": user_id, "read": False},
+        {"$set": {"read": True}}
+    )
+    await mark_conversation_read(user_id, partner_id, result.modified_count)
+    await adjust_unread(user_id, -result.modified_count)
+    return result.modified_count
+
+async def rebuild_unread_counts():
+    """إعادة حساب إجمالي غير المقروء لكل المستخدمين من مجموعة الرسائل"""
+    await db.unread_counts.update_many({}, {"$set": {"total": 0}})
+    await db.messages.aggregate([
+        {"$match": {"read": False}},
+        {"$group": {"_id": "$recipient_id", "total": {"$sum": 1}}},
+        {"$merge": {"into": "unread_counts", "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ], allowDiskUse=True).to_list(None)
+
+@app.on_event("startup")
+async def backfill_conversations():
+    if await db.conversations.find_one({}, {"_id": 1}) is None and await db.messages.find_one({}, {"_id": 1}):
+        logger.info("Backfilling conversations index from messages")
+        await rebuild_conversations()
+
 @api_router.get("/messages/unread-count")
 async def get_unread_count(current_user: dict = Depends(get_current_user)):
     """Get total count of unread messages for the current user"""
-    unread_count = await db.messages.count_documents({
-        "recipient_id": current_user["_id"],
-        "read": False
-    })
-    return {"unread_count": unread_count}
+    # التحديثات تُدفع عبر حدث unread_count؛ هذا للتحميل الأول فقط
+    counter = await db.unread_counts.find_one({"_id": current_user["_id"]})
+    if counter is None:
+        return {"unread_count": await seed_unread_count(current_user["_id"])}
+    return {"unread_count": max(counter["total"], 0)}
 
 @api_router.post("/messages/mark-read/{sender_id}")
 async def mark_messages_as_read(sender_id: str, current_user: dict = Depends(get_current_user)):
     """Mark all messages from a sender as read"""
-    result = await db.messages.update_many(
-        {
-            "sender_id": sender_id,
-            "recipient_id": current_user["_id"],
-            "read": False
-        },
-        {"$set": {"read": True}}
-    )
-    return {"marked_count": result.modified_count}
+    marked_count = await mark_read_from(current_user["_id"], sender_id)
+    return {"marked_count": marked_count}
 
 @api_router.get("/messages/conversations")
 async def get_conversations(current_user: dict = Depends(get_current_user)):
-    # Get all unique conversation partners
-    sent = await db.messages.distinct("recipient_id", {"sender_id": current_user["_id"]})
-    received = await db.messages.distinct("sender_id", {"recipient_id": current_user["_id"]})
+    # Single indexed query over the materialized conversations, newest first
+    threads = await db.conversations.find(
+        {"participants": current_user["_id"]}
+    ).sort("last_message_time", -1).to_list(1000)
+    
+    partner_ids = [
+        next((p for p in t["participants"] if p != current_user["_id"]), current_user["_id"])
+        for t in threads
+    ]
+    users = await fetch_by_ids(db.users, partner_ids, {"full_name": 1, "email": 1, "role": 1, **PROFILE_IMAGE_PROJECTION})
     
-    conversation_ids = list(set(sent + received))
+    # Get profile image from coach profile when the user has none
+    without_image = [uid for uid, u in users.items() if not profile_image_url(u)]
+    coach_profiles = await fetch_by_ids(db.coach_profiles, without_image, {"user_id": 1, **PROFILE_IMAGE_PROJECTION}, key="user_id")
     
     conversations = []
-    for user_id in conversation_ids:
-        user = await db.users.find_one({"_id": user_id})
-        if user:
-            # Get last message
-            last_message = await db.messages.find_one({
-                "$or": [
-                    {"sender_id": current_user["_id"], "recipient_id": user_id},
-                    {"sender_id": user_id, "recipient_id": current_user["_id"]}
-                ]
-            }, sort=[("timestamp", -1)])
-            
-            # Count unread messages
-            unread_count = await db.messages.count_documents({
-                "sender_id": user_id,
-                "recipient_id": current_user["_id"],
-                "read": False
-            })
-            
-            # Get profile image
-            profile_image = user.get("profile_image")
-            if not profile_image:
-                coach_profile = await db.coach_profiles.find_one({"user_id": user_id})
-                if coach_profile:
-                    profile_image = coach_profile.get("profile_image")
-            
-            conversations.append({
-                "user_id": user_id,
-                "full_name": user["full_name"],
-                "email": user["email"],
-                "role": user.get("role", "client"),
-                "profile_image": profile_image,
-                "last_message": last_message.get("message", "") if last_message else "",
-                "last_message_time": last_message.get("timestamp") if last_message else None,
-                "unread_count": unread_count
-            })
+    for thread, user_id in zip(threads, partner_ids):
+        user = users.get(user_id)
+        if not user:
+            continue
+        
+        profile_image = profile_image_url(user, coach_profiles.get(user_id))
+        
+        conversations.append({
+            "user_id": user_id,
+            "full_name": user["full_name"],
+            "email": user["email"],
+            "role": user.get("role", "client"),
+            "profile_image": profile_image,
+            **conversation_summary(thread, current_user["_id"])
+        })
     
     return conversations
 
+# المرفقات تُحمّل من /attachments/{id}، والرسالة تحمل المعرف والحجم والنوع فقط
+MESSAGE_LIST_FIELDS = {
+    "id": 1, "sender_id": 1, "recipient_id": 1, "message": 1, "timestamp": 1, "read": 1,
+    "attachment_id": 1, "attachment_size": 1, "attachment_type": 1, "attachment_name": 1,
+    "has_attachment": {"$or": [has_value("attachment"), has_value("attachment_id")]}
+}
+
 @api_router.get("/messages/{recipient_id}")
-async def get_messages(recipient_id: str, current_user: dict = Depends(get_current_user)):
-    messages = await db.messages.find({
+async def get_messages(recipient_id: str, response: Response, current_user: dict = Depends(get_current_user), limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX), cursor: Optional[str] = None, fields: Optional[str] = None):
+    selected = parse_fields(fields, MESSAGE_LIST_FIELDS)
+    projection = list_projection(MESSAGE_LIST_FIELDS, selected)
+    if selected is not None:
+        projection["timestamp"] = 1  # needed for the page cursor
+    
+    # Newest page first; the cursor walks back in time, each page is returned oldest-first
+    messages, next_cursor, has_more = await paginate(db.messages, {
         "$or": [
             {"sender_id": current_user["_id"], "recipient_id": recipient_id},
             {"sender_id": recipient_id, "recipient_id": current_user["_id"]}
         ]
-    }).sort("timestamp", 1).to_list(1000)
+    }, "timestamp", limit=limit, cursor=cursor, projection=projection)
+    messages.reverse()
+    set_page_headers(response, next_cursor, has_more)
     
     # Mark messages as read
-    await db.messages.update_many(
-        {"sender_id": recipient_id, "recipient_id": current_user["_id"], "read": False},
-        {"$set": {"read": True}}
-    )
+    await mark_read_from(current_user["_id"], recipient_id)
     
     return messages
 
+@api_router.get("/messages/{message_id}/attachment")
+async def get_message_attachment(message_id: str, current_user: dict = Depends(get_current_user)):
+    """جلب مرفق رسالة واحدة - للمرسل أو المستقبل فقط"""
+    message = await db.messages.find_one(
+        {"_id": message_id, "$or": [{"sender_id": current_user["_id"]}, {"recipient_id": current_user["_id"]}]},
+        {"attachment": 1, "attachment_id": 1, "attachment_size": 1, "attachment_type": 1, "attachment_name": 1}
+    )
+    if message and message.get("attachment_id"):
+        return {
+            "id": message_id,
+            "attachment_id": message["attachment_id"],
+            "size": message.get("attachment_size"),
+            "content_type": message.get("attachment_type"),
+            "filename": message.get("attachment_name"),
+            "url": f"/api/attachments/{message['attachment_id']}"
+        }
+    if not message or not message.get("attachment"):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    return {"id": message_id, "attachment": message["attachment"]}
+
 @api_router.post("/messages/send")
 async def send_message(message: Message, current_user: dict = Depends(get_current_user)):
     message_dict = message.dict()
     message_dict["_id"] = str(uuid.uuid4())
     message_dict["sender_id"] = current_user["_id"]
+    
+    # المرفق يُخزن خارج الرسالة حتى تبقى الرسائل وأحداث Socket.IO صغيرة
+    inline_attachment = message_dict.pop("attachment", None)
+    if inline_attachment:
+        attachment = await store_inline_attachment(inline_attachment, current_user["_id"])
+    elif message.attachment_id:
+        attachment = await db.attachments.find_one_and_update(
+            {"_id": message.attachment_id, "uploaders": current_user["_id"]},
+            {"$set": {"last_used_at": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not attachment:
+            raise HTTPException(status_code=404, detail="Attachment not found")
+    else:
+        attachment = None
+    message_dict.pop("attachment_id", None)
+    if attachment:
+        message_dict.update(message_attachment_fields(attachment, current_user["_id"]))
+    
     await db.messages.insert_one(message_dict)
+    await record_conversation_message(message_dict)
     
     # Emit socket event
-    await sio.emit('new_message', message_dict, room=message.recipient_id)
+    await emit_to_user('new_message', message_dict, message.recipient_id)
+    await adjust_unread(message.recipient_id, 1)
     
     return {"message": "Message sent", "id": message_dict["_id"]}
 
@@ -1404,32 +2701,18 @@ async def get_available_chat_contacts(current_user: dict = Depends(get_current_u
     if current_user["role"] in ["client", "trainee"]:
         # المتدرب: يرى يازو (جميع الأدمن)
         admins = await db.users.find({"role": "admin"}).to_list(10)
+        threads = await fetch_by_ids(db.conversations, [conversation_id(current_user["_id"], a["_id"]) for a in admins])
         
         for admin in admins:
-            # Get last message
-            last_message = await db.messages.find_one({
-                "$or": [
-                    {"sender_id": current_user["_id"], "recipient_id": admin["_id"]},
-                    {"sender_id": admin["_id"], "recipient_id": current_user["_id"]}
-                ]
-            }, sort=[("timestamp", -1)])
-            
-            # Count unread messages
-            unread_count = await db.messages.count_documents({
-                "sender_id": admin["_id"],
-                "recipient_id": current_user["_id"],
-                "read": False
-            })
+            thread = threads.get(conversation_id(current_user["_id"], admin["_id"]))
             
             contacts.append({
                 "user_id": admin["_id"],
                 "full_name": admin.get("full_name", "يازو"),
                 "role": "coach",
-                "profile_image": admin.get("profile_image"),
+                "profile_image": profile_image_url(admin),
                 "specialties": ["تدريب حياة شامل"],
-                "last_message": last_message.get("message", "") if last_message else "",
-                "last_message_time": last_message.get("timestamp") if last_message else None,
-                "unread_count": unread_count,
+                **conversation_summary(thread, current_user["_id"]),
                 "booking_status": "active",
                 "package_name": "",
                 "hours_remaining": 0
@@ -1438,25 +2721,25 @@ async def get_available_chat_contacts(current_user: dict = Depends(get_current_u
     elif current_user["role"] in ["coach", "admin"]:
         # يازو/المدرب: يرى جميع المتدربين (client و trainee)
         trainees = await db.users.find({"role": {"$in": ["client", "trainee"]}}).to_list(100)
+        trainee_ids = [t["_id"] for t in trainees]
+        threads = await fetch_by_ids(db.conversations, [conversation_id(current_user["_id"], tid) for tid in trainee_ids])
+        
+        # Get booking info if exists (first booking per trainee) - التجميع في Mongo فالنتيجة صف لكل متدرب
+        trainee_bookings = await db.bookings.aggregate([
+            {"$match": {"client_id": {"$in": trainee_ids}}},
+            {"$sort": {"client_id": 1, "created_at": 1}},
+            {"$group": {
+                "_id": "$client_id",
+                "hours_purchased": {"$first": {"$ifNull": ["$hours_purchased", 0]}},
+                "hours_used": {"$first": {"$ifNull": ["$hours_used", 0]}},
+                "package_name": {"$first": {"$ifNull": ["$package_name", ""]}}
+            }}
+        ]).to_list(len(trainee_ids))
+        bookings = {b["_id"]: b for b in trainee_bookings}
         
         for trainee in trainees:
-            # Get last message
-            last_message = await db.messages.find_one({
-                "$or": [
-                    {"sender_id": current_user["_id"], "recipient_id": trainee["_id"]},
-                    {"sender_id": trainee["_id"], "recipient_id": current_user["_id"]}
-                ]
-            }, sort=[("timestamp", -1)])
-            
-            # Count unread messages
-            unread_count = await db.messages.count_documents({
-                "sender_id": trainee["_id"],
-                "recipient_id": current_user["_id"],
-                "read": False
-            })
-            
-            # Get booking info if exists
-            booking = await db.bookings.find_one({"client_id": trainee["_id"]})
+            thread = threads.get(conversation_id(current_user["_id"], trainee["_id"]))
+            booking = bookings.get(trainee["_id"])
             hours_remaining = 0
             package_name = ""
             if booking:
@@ -1467,10 +2750,8 @@ async def get_available_chat_contacts(current_user: dict = Depends(get_current_u
                 "user_id": trainee["_id"],
                 "full_name": trainee["full_name"],
                 "role": "client",
-                "profile_image": trainee.get("profile_image"),
-                "last_message": last_message.get("message", "") if last_message else "",
-                "last_message_time": last_message.get("timestamp") if last_message else None,
-                "unread_count": unread_count,
+                "profile_image": profile_image_url(trainee),
+                **conversation_summary(thread, current_user["_id"]),
                 "hours_remaining": hours_remaining,
                 "package_name": package_name,
                 "booking_status": "active" if booking else "no_booking"
@@ -1507,8 +2788,9 @@ async def get_my_intake(current_user: dict = Depends(get_current_user)):
     return intake
 
 @api_router.get("/intake/all")
-async def get_all_intakes(admin_user: dict = Depends(get_admin_user)):
-    intakes = await db.intake_responses.find().sort("timestamp", -1).to_list(1000)
+async def get_all_intakes(response: Response, admin_user: dict = Depends(get_admin_user), limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX), cursor: Optional[str] = None):
+    intakes, next_cursor, has_more = await paginate(db.intake_responses, {}, "timestamp", limit=limit, cursor=cursor)
+    set_page_headers(response, next_cursor, has_more)
     return intakes
 
 # ==================== RESOURCE LIBRARY ====================
@@ -1520,6 +2802,7 @@ async def upload_resource(resource: Resource, admin_user: dict = Depends(get_adm
     resource_dict["id"] = resource_dict["_id"]
     resource_dict["uploaded_by"] = admin_user["_id"]
     await db.resources.insert_one(resource_dict)
+    catalog_cache.invalidate("resources")
     return {"message": "Resource uploaded", "id": resource_dict["_id"]}
 
 # تم نقل GET /resources إلى أسفل الملف لتجنب التكرار
@@ -1527,6 +2810,7 @@ async def upload_resource(resource: Resource, admin_user: dict = Depends(get_adm
 @api_router.delete("/resources/{resource_id}")
 async def delete_resource(resource_id: str, admin_user: dict = Depends(get_admin_user)):
     await db.resources.delete_one({"_id": resource_id})
+    catalog_cache.invalidate("resources")
     return {"message": "Resource deleted"}
 
 # ==================== HABIT TRACKER ====================
@@ -1688,6 +2972,17 @@ async def get_all_users(admin_user: dict = Depends(get_admin_user)):
     users = await db.users.find({"role": {"$in": ["client", "trainee"]}}).to_list(1000)
     return [{"id": u["_id"], "email": u["email"], "full_name": u["full_name"], "role": u.get("role"), "created_at": u["created_at"]} for u in users]
 
+@api_router.get("/admin/metrics")
+async def get_runtime_metrics(admin_user: dict = Depends(get_admin_user)):
+    """مقاييس تشغيلية داخلية لهذه العملية"""
+    return {
+        "password_hashing": password_hasher.stats(),
+        "stripe": stripe_gateway.stats(),
+        "user_cache": user_cache.stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "socketio": {**socket_metrics.stats(), **socket_registry.stats()}
+    }
+
 @api_router.get("/users/{user_id}")
 async def get_user_by_id(user_id: str, current_user: dict = Depends(get_current_user)):
     """جلب بيانات مستخدم واحد"""
@@ -1709,29 +3004,21 @@ async def get_all_coaches(admin_user: dict = Depends(get_admin_user)):
 
 @api_router.get("/admin/stats")
 async def get_admin_stats(admin_user: dict = Depends(get_admin_user)):
-    total_users = await db.users.count_documents({"role": "client"})
-    total_coaches = await db.users.count_documents({"role": "coach"})
-    total_bookings = await db.bookings.count_documents({})
-    active_subscriptions = await db.subscriptions.count_documents({"status": "active"})
-    total_revenue = await db.bookings.aggregate([
-        {"$match": {"payment_status": "completed"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount_paid"}}}
-    ]).to_list(1)
-    
-    revenue = total_revenue[0]["total"] if total_revenue else 0
+    counters = await read_counters(["users.client", "users.coach", "bookings.total", "bookings.revenue", "subscriptions.active"])
     
     return {
-        "total_users": total_users,
-        "coaches": total_coaches,
-        "total_bookings": total_bookings,
-        "total_revenue": revenue,
-        "active_subscriptions": active_subscriptions
+        "total_users": counters["users.client"],
+        "coaches": counters["users.coach"],
+        "total_bookings": counters["bookings.total"],
+        "total_revenue": counters["bookings.revenue"],
+        "active_subscriptions": counters["subscriptions.active"]
     }
 
 @api_router.get("/admin/bookings")
-async def get_admin_bookings(admin_user: dict = Depends(get_admin_user)):
+async def get_admin_bookings(response: Response, admin_user: dict = Depends(get_admin_user), limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX), cursor: Optional[str] = None):
     """Get all bookings for admin"""
-    bookings = await db.bookings.find().sort("created_at", -1).to_list(1000)
+    bookings, next_cursor, has_more = await paginate(db.bookings, {}, "created_at", limit=limit, cursor=cursor)
+    set_page_headers(response, next_cursor, has_more)
     
     result = []
     for booking in bookings:
@@ -1758,14 +3045,73 @@ async def get_admin_bookings(admin_user: dict = Depends(get_admin_user)):
 
 # ==================== ADMIN PAYMENT MANAGEMENT ====================
 
+def _completed_amount(condition: dict) -> dict:
+    return {"$sum": {"$cond": [{"$and": [{"$eq": ["$status", "completed"]}, condition]}, "$amount", 0]}}
+
+def _status_count(payment_status: str) -> dict:
+    return {"$sum": {"$cond": [{"$eq": ["$status", payment_status]}, 1, 0]}}
+
+async def refresh_revenue_rollup(since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """إعادة حساب ملخص الإيرادات اليومي (revenue_daily) من المدفوعات للفترة المحددة"""
+    created_at = {"$type": "date"}
+    if since:
+        created_at["$gte"] = since
+    if until:
+        created_at["$lt"] = until
+    
+    pipeline = [
+        {"$match": {"created_at": created_at}},
+        {"$group": {
+            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+            "booking_revenue": _completed_amount({"$eq": ["$type", "booking"]}),
+            "subscription_revenue": _completed_amount({"$eq": ["$type", "subscription"]}),
+            "completed_revenue": _completed_amount(True),
+            "payments_count": {"$sum": 1},
+            "completed_count": _status_count("completed"),
+            "pending_count": _status_count("pending"),
+            "failed_count": _status_count("failed")
+        }},
+        {"$addFields": {"date": {"$dateFromString": {"dateString": "$_id"}}, "updated_at": "$$NOW"}},
+        {"$merge": {"into": "revenue_daily", "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ]
+    await db.payments.aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+async def refresh_revenue_day(when: datetime):
+    """تحديث ملخص يوم واحد بعد أي عملية كتابة على المدفوعات"""
+    day_start = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    await refresh_revenue_rollup(day_start, day_start + timedelta(days=1))
+
+@app.on_event("startup")
+async def backfill_revenue_rollup():
+    if await db.revenue_daily.find_one({}, {"_id": 1}) is None and await db.payments.find_one({}, {"_id": 1}):
+        logger.info("Backfilling revenue_daily rollup from payments")
+        await refresh_revenue_rollup()
+
+async def refresh_recent_revenue_periodically():
+    """تحديثان متزامنان لنفس اليوم قد يكتب الأقدم منهما أخيراً فيبقى اليوم قديماً - نعيد حساب الأيام الأخيرة"""
+    while True:
+        try:
+            if await acquire_job_lease("refresh_revenue_rollup", REVENUE_ROLLUP_REFRESH_INTERVAL_SECONDS):
+                today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+                await refresh_revenue_rollup(today - timedelta(days=REVENUE_ROLLUP_REFRESH_DAYS - 1))
+        except PyMongoError as e:
+            logger.warning(f"Revenue rollup refresh failed: {e}")
+        await asyncio.sleep(REVENUE_ROLLUP_REFRESH_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_revenue_rollup_refresh():
+    start_background_task(refresh_recent_revenue_periodically())
+
 @api_router.get("/admin/payments")
-async def get_all_payments(admin_user: dict = Depends(get_admin_user)):
+async def get_all_payments(response: Response, admin_user: dict = Depends(get_admin_user), limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX), cursor: Optional[str] = None):
     """Get all payments with user details"""
-    payments = await db.payments.find().sort("created_at", -1).to_list(1000)
+    payments, next_cursor, has_more = await paginate(db.payments, {}, "created_at", limit=limit, cursor=cursor)
+    set_page_headers(response, next_cursor, has_more)
+    users = await fetch_by_ids(db.users, [p.get("user_id") for p in payments], USER_SUMMARY_PROJECTION)
     
     result = []
     for payment in payments:
-        user = await db.users.find_one({"_id": payment.get("user_id")})
+        user = users.get(payment.get("user_id"))
         
         result.append({
             "id": payment["_id"],
@@ -1787,65 +3133,65 @@ async def get_all_payments(admin_user: dict = Depends(get_admin_user)):
 @api_router.get("/admin/payments/stats")
 async def get_payment_stats(admin_user: dict = Depends(get_admin_user)):
     """Get payment statistics"""
-    # Total revenue from bookings
-    booking_revenue = await db.payments.aggregate([
-        {"$match": {"type": "booking", "status": "completed"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]).to_list(1)
-    
-    # Total revenue from subscriptions
-    subscription_revenue = await db.payments.aggregate([
-        {"$match": {"type": "subscription", "status": "completed"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]).to_list(1)
-    
-    # This month's revenue
-    from datetime import datetime
-    first_of_month = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    monthly_revenue = await db.payments.aggregate([
-        {"$match": {"status": "completed", "created_at": {"$gte": first_of_month}}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]).to_list(1)
-    
-    # Today's revenue
-    today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    today_revenue = await db.payments.aggregate([
-        {"$match": {"status": "completed", "created_at": {"$gte": today_start}}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
+    now = datetime.utcnow()
+    first_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    
+    # Revenue and status counts from the daily rollup in a single pass
+    facets = await db.revenue_daily.aggregate([
+        {"$facet": {
+            "all_time": [{"$group": {
+                "_id": None,
+                "booking_revenue": {"$sum": "$booking_revenue"},
+                "subscription_revenue": {"$sum": "$subscription_revenue"},
+                "total_payments": {"$sum": "$payments_count"},
+                "completed_payments": {"$sum": "$completed_count"},
+                "pending_payments": {"$sum": "$pending_count"},
+                "failed_payments": {"$sum": "$failed_count"}
+            }}],
+            "monthly": [
+                {"$match": {"date": {"$gte": first_of_month}}},
+                {"$group": {"_id": None, "total": {"$sum": "$completed_revenue"}}}
+            ],
+            "today": [
+                {"$match": {"_id": now.strftime("%Y-%m-%d")}},
+                {"$project": {"total": "$completed_revenue"}}
+            ]
+        }}
     ]).to_list(1)
     
-    # Count by status
-    total_payments = await db.payments.count_documents({})
-    completed_payments = await db.payments.count_documents({"status": "completed"})
-    pending_payments = await db.payments.count_documents({"status": "pending"})
-    failed_payments = await db.payments.count_documents({"status": "failed"})
+    all_time = facets[0]["all_time"][0] if facets and facets[0]["all_time"] else {}
+    monthly = facets[0]["monthly"] if facets else []
+    today = facets[0]["today"] if facets else []
     
-    # Revenue by coach
-    coach_revenues = await db.bookings.aggregate([
+    # Revenue by coach, with the coach name joined in-database
+    coach_details = await db.bookings.aggregate([
         {"$match": {"payment_status": "completed"}},
-        {"$group": {"_id": "$coach_id", "total": {"$sum": "$amount"}}}
+        {"$group": {"_id": "$coach_id", "total": {"$sum": "$amount"}}},
+        {"$limit": 100},
+        {"$lookup": {
+            "from": "users",
+            "localField": "_id",
+            "foreignField": "_id",
+            "pipeline": [{"$project": {"full_name": 1}}],
+            "as": "coach"
+        }},
+        {"$unwind": "$coach"},
+        {"$project": {"_id": 0, "coach_id": "$_id", "coach_name": "$coach.full_name", "total_revenue": "$total"}}
     ]).to_list(100)
     
-    coach_details = []
-    for cr in coach_revenues:
-        coach = await db.users.find_one({"_id": cr["_id"]})
-        if coach:
-            coach_details.append({
-                "coach_id": cr["_id"],
-                "coach_name": coach["full_name"],
-                "total_revenue": cr["total"]
-            })
+    booking_revenue = all_time.get("booking_revenue", 0)
+    subscription_revenue = all_time.get("subscription_revenue", 0)
     
     return {
-        "total_revenue": (booking_revenue[0]["total"] if booking_revenue else 0) + (subscription_revenue[0]["total"] if subscription_revenue else 0),
-        "booking_revenue": booking_revenue[0]["total"] if booking_revenue else 0,
-        "subscription_revenue": subscription_revenue[0]["total"] if subscription_revenue else 0,
-        "monthly_revenue": monthly_revenue[0]["total"] if monthly_revenue else 0,
-        "today_revenue": today_revenue[0]["total"] if today_revenue else 0,
-        "total_payments": total_payments,
-        "completed_payments": completed_payments,
-        "pending_payments": pending_payments,
-        "failed_payments": failed_payments,
+        "total_revenue": booking_revenue + subscription_revenue,
+        "booking_revenue": booking_revenue,
+        "subscription_revenue": subscription_revenue,
+        "monthly_revenue": monthly[0]["total"] if monthly else 0,
+        "today_revenue": today[0]["total"] if today else 0,
+        "total_payments": all_time.get("total_payments", 0),
+        "completed_payments": all_time.get("completed_payments", 0),
+        "pending_payments": all_time.get("pending_payments", 0),
+        "failed_payments": all_time.get("failed_payments", 0),
         "coach_revenues": coach_details
     }
 
@@ -1855,11 +3201,12 @@ async def get_coach_payments(coach_id: str, admin_user: dict = Depends(get_admin
     # Get bookings for this coach
     bookings = await db.bookings.find({"coach_id": coach_id}).sort("created_at", -1).to_list(1000)
     
-    coach = await db.users.find_one({"_id": coach_id})
+    users = await fetch_by_ids(db.users, [coach_id] + [b.get("client_id") for b in bookings], USER_SUMMARY_PROJECTION)
+    coach = users.get(coach_id)
     
     result = []
     for booking in bookings:
-        client = await db.users.find_one({"_id": booking.get("client_id")})
+        client = users.get(booking.get("client_id"))
         result.append({
             "id": booking["_id"],
             "client_name": client["full_name"] if client else "غير معروف",
@@ -1899,13 +3246,16 @@ async def record_manual_payment(data: dict, admin_user: dict = Depends(get_admin
     }
     
     await db.payments.insert_one(payment)
+    await refresh_revenue_day(payment["created_at"])
     
     # If linked to a booking, update booking status
     if data.get("booking_id"):
-        await db.bookings.update_one(
+        previous = await db.bookings.find_one_and_update(
             {"_id": data["booking_id"]},
             {"$set": {"payment_status": "completed"}}
         )
+        if previous:
+            await track_counters("bookings", previous, {**previous, "payment_status": "completed"})
     
     return {"message": "Payment recorded", "id": payment["_id"]}
 
@@ -1937,14 +3287,20 @@ async def process_refund(payment_id: str, data: dict, admin_user: dict = Depends
         {"$set": {"status": "refunded"}}
     )
     
+    await refresh_revenue_day(refund["created_at"])
+    if isinstance(payment.get("created_at"), datetime):
+        await refresh_revenue_day(payment["created_at"])
+    
     return {"message": "Refund processed", "id": refund["_id"]}
 
 @api_router.get("/admin/subscriptions")
-async def get_all_subscriptions(admin_user: dict = Depends(get_admin_user)):
-    subscriptions = await db.subscriptions.find().sort("created_at", -1).to_list(1000)
+async def get_all_subscriptions(response: Response, admin_user: dict = Depends(get_admin_user), limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX), cursor: Optional[str] = None):
+    subscriptions, next_cursor, has_more = await paginate(db.subscriptions, {}, "created_at", limit=limit, cursor=cursor)
+    set_page_headers(response, next_cursor, has_more)
+    coaches = await fetch_by_ids(db.users, [sub["coach_id"] for sub in subscriptions], USER_SUMMARY_PROJECTION)
     result = []
     for sub in subscriptions:
-        coach = await db.users.find_one({"_id": sub["coach_id"]})
+        coach = coaches.get(sub["coach_id"])
         result.append({
             "id": sub["_id"],
             "coach_id": sub["coach_id"],
@@ -1995,6 +3351,7 @@ async def grant_subscription(data: dict, admin_user: dict = Depends(get_admin_us
     }
     
     await db.subscriptions.insert_one(subscription)
+    await track_counters("subscriptions", None, subscription)
     
     # Activate coach profile
     await db.coach_profiles.update_one(
@@ -2002,26 +3359,28 @@ async def grant_subscription(data: dict, admin_user: dict = Depends(get_admin_us
         {"$set": {"is_active": True}},
         upsert=True
     )
+    catalog_cache.invalidate("coaches")
     
     return {"message": "Subscription granted", "subscription_id": subscription["_id"]}
 
 @api_router.put("/admin/subscriptions/{subscription_id}/cancel")
 async def cancel_subscription(subscription_id: str, admin_user: dict = Depends(get_admin_user)):
-    result = await db.subscriptions.update_one(
-        {"_id": subscription_id},
+    subscription = await db.subscriptions.find_one_and_update(
+        {"_id": subscription_id, "status": {"$ne": "cancelled"}},
         {"$set": {"status": "cancelled"}}
     )
     
-    if result.modified_count == 0:
+    if subscription is None:
         raise HTTPException(status_code=404, detail="Subscription not found")
     
-    # Get subscription to deactivate coach
-    subscription = await db.subscriptions.find_one({"_id": subscription_id})
-    if subscription:
-        await db.coach_profiles.update_one(
-            {"user_id": subscription["coach_id"]},
-            {"$set": {"is_active": False}}
-        )
+    await track_counters("subscriptions", subscription, {**subscription, "status": "cancelled"})
+    
+    # Deactivate coach
+    await db.coach_profiles.update_one(
+        {"user_id": subscription["coach_id"]},
+        {"$set": {"is_active": False}}
+    )
+    catalog_cache.invalidate("coaches")
     
     return {"message": "Subscription cancelled"}
 
@@ -2054,16 +3413,116 @@ async def change_user_role(user_id: str, data: dict, admin_user: dict = Depends(
     if new_role not in ["client", "coach"]:
         raise HTTPException(status_code=400, detail="Invalid role")
     
-    result = await db.users.update_one(
-        {"_id": user_id},
-        {"$set": {"role": new_role}}
+    previous = await db.users.find_one_and_update(
+        {"_id": user_id, "role": {"$ne": new_role}},
+        {"$set": {"role": new_role}},
+        projection={"role": 1}
     )
+    invalidate_cached_user(user_id)
     
-    if result.modified_count == 0:
+    if previous is None:
         raise HTTPException(status_code=404, detail="User not found")
     
+    await track_counters("users", previous, {**previous, "role": new_role})
+    catalog_cache.invalidate("coaches")
     return {"message": "Role updated"}
 
+# ==================== ADMIN EXPORTS ====================
+
+EXPORT_BATCH_SIZE = 1000
+
+# اسم السجل -> (المجموعة، حقل التاريخ للترتيب والتصفية، الأعمدة)
+EXPORT_LEDGERS: Dict[str, Tuple[str, str, List[str]]] = {
+    "payments": ("payments", "created_at", [
+        "_id", "user_id", "type", "amount", "status", "payment_method", "stripe_payment_intent_id",
+        "booking_id", "plan", "original_payment_id", "recorded_by", "processed_by", "created_at"
+    ]),
+    "bookings": ("bookings", "created_at", [
+        "_id", "client_id", "client_name", "coach_id", "coach_name", "package_id", "package_name",
+        "hours_purchased", "hours_used", "amount", "amount_paid", "payment_status", "booking_status", "created_at"
+    ]),
+    "subscriptions": ("subscriptions", "created_at", [
+        "_id", "coach_id", "plan", "status", "start_date", "end_date", "amount", "created_at"
+    ]),
+    "user_subscriptions": ("user_subscriptions", "created_at", [
+        "_id", "user_id", "package_id", "package_name", "category", "status", "payment_status",
+        "amount_paid", "start_date", "end_date", "expired_at", "created_at"
+    ]),
+    "sessions": ("sessions", "session_date", [
+        "_id", "booking_id", "coach_id", "client_id", "duration_hours", "session_type", "notes", "session_date", "created_at"
+    ]),
+    "intake": ("intake_responses", "timestamp", ["_id", "user_id", "responses", "pillars_assessment", "timestamp"]),
+    "intake_questionnaires": ("intake_questionnaires", "completed_at", ["_id", "user_id", "answers", "completed_at"]),
+}
+
+def export_cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(jsonable_encoder(value), ensure_ascii=False)
+    return str(value)
+
+@api_router.get("/admin/export/{ledger}")
+async def export_ledger(ledger: str, request: Request, admin_user: dict = Depends(get_admin_user), format: str = "ndjson", since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """تصدير سجل كامل بالبث: المؤشر يُقرأ على دفعات وكل دفعة تُكتب فوراً، فالذاكرة ثابتة مهما كبر السجل"""
+    if ledger not in EXPORT_LEDGERS:
+        raise HTTPException(status_code=404, detail="Unknown ledger")
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    collection_name, date_field, columns = EXPORT_LEDGERS[ledger]
+    
+    query = {}
+    if since or until:
+        query[date_field] = {**({"$gte": since} if since else {}), **({"$lt": until} if until else {})}
+    cursor = db[collection_name].find(query, {column: 1 for column in columns}).sort(
+        [(date_field, ASCENDING), ("_id", ASCENDING)]
+    ).batch_size(EXPORT_BATCH_SIZE)
+    
+    gzip_body = "gzip" in request.headers.get("accept-encoding", "")
+    
+    def encode_rows(rows: List[dict]) -> str:
+        if format == "ndjson":
+            return "".join(json.dumps(jsonable_encoder(row), ensure_ascii=False) + "\n" for row in rows)
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows([export_cell(row.get(column)) for column in columns] for row in rows)
+        return buffer.getvalue()
+    
+    async def stream():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip_body else None
+        
+        def encode(text: str) -> bytes:
+            data = text.encode()
+            return compressor.compress(data) if compressor else data
+        
+        if format == "csv":
+            yield encode(",".join(columns) + "\r\n")
+        rows = []
+        async for doc in cursor:
+            rows.append(doc)
+            if len(rows) >= EXPORT_BATCH_SIZE:
+                chunk = encode(encode_rows(rows))
+                rows = []
+                if chunk:
+                    yield chunk
+        tail = encode(encode_rows(rows)) if rows else b""
+        if compressor:
+            tail += compressor.flush()
+        if tail:
+            yield tail
+    
+    extension = "ndjson" if format == "ndjson" else "csv"
+    headers = {
+        "Content-Disposition": f'attachment; filename="{ledger}-{datetime.utcnow():%Y%m%d}.{extension}"',
+        "Cache-Control": "private, no-store",
+        "Vary": "Accept-Encoding"
+    }
+    if gzip_body:
+        headers["Content-Encoding"] = "gzip"
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv; charset=utf-8"
+    return StreamingResponse(stream(), media_type=media_type, headers=headers)
+
 # ==================== ADMIN SETTINGS ====================
 
 @api_router.get("/admin/settings")
@@ -2087,17 +3546,21 @@ async def update_admin_settings(data: dict, admin_user: dict = Depends(get_admin
         }},
         upsert=True
     )
+    catalog_cache.invalidate("settings")
     return {"message": "Settings updated"}
 
 @api_router.get("/settings/price-limits")
-async def get_price_limits():
-    settings = await db.settings.find_one({"type": "platform"})
-    if not settings:
-        return {"min_hourly_rate": 20, "max_hourly_rate": 200}
-    return {
-        "min_hourly_rate": settings.get("min_hourly_rate", 20),
-        "max_hourly_rate": settings.get("max_hourly_rate", 200)
-    }
+async def get_price_limits(request: Request):
+    async def build():
+        settings = await db.settings.find_one({"type": "platform"})
+        if not settings:
+            return {"min_hourly_rate": 20, "max_hourly_rate": 200}
+        return {
+            "min_hourly_rate": settings.get("min_hourly_rate", 20),
+            "max_hourly_rate": settings.get("max_hourly_rate", 200)
+        }
+    
+    return await catalog_response(request, "settings", "", build)
 
 # ==================== COACH PACKAGES ====================
 
@@ -2217,10 +3680,11 @@ async def get_coach_stats(coach_user: dict = Depends(get_coach_user)):
 async def get_coach_clients_list(coach_user: dict = Depends(get_coach_user)):
     # Get all unique client IDs from bookings
     client_ids = await db.bookings.distinct("client_id", {"coach_id": coach_user["_id"]})
+    users = await fetch_by_ids(db.users, client_ids, USER_SUMMARY_PROJECTION)
     
     clients = []
     for client_id in client_ids:
-        client = await db.users.find_one({"_id": client_id})
+        client = users.get(client_id)
         if client:
             clients.append({
                 "id": client["_id"],
@@ -2232,8 +3696,11 @@ async def get_coach_clients_list(coach_user: dict = Depends(get_coach_user)):
     return clients
 
 @api_router.get("/coach/bookings")
-async def get_coach_bookings(coach_user: dict = Depends(get_coach_user)):
-    bookings = await db.bookings.find({"coach_id": coach_user["_id"]}).sort("created_at", -1).to_list(1000)
+async def get_coach_bookings(response: Response, coach_user: dict = Depends(get_coach_user), limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX), cursor: Optional[str] = None):
+    bookings, next_cursor, has_more = await paginate(
+        db.bookings, {"coach_id": coach_user["_id"]}, "created_at", limit=limit, cursor=cursor
+    )
+    set_page_headers(response, next_cursor, has_more)
     return [BookingResponse(**booking, id=booking["_id"]) for booking in bookings]
 
 @api_router.get("/coach/my-trainees")
@@ -2305,6 +3772,7 @@ async def subscribe_coach(data: dict, coach_user: dict = Depends(get_coach_user)
     }
     
     await db.subscriptions.insert_one(subscription)
+    await track_counters("subscriptions", None, subscription)
     
     # Update coach profile to be active
     await db.coach_profiles.update_one(
@@ -2312,38 +3780,102 @@ async def subscribe_coach(data: dict, coach_user: dict = Depends(get_coach_user)
         {"$set": {"is_active": True}},
         upsert=True
     )
+    catalog_cache.invalidate("coaches")
     
     return {"message": "Subscription activated", "subscription_id": subscription["_id"]}
 
 # ==================== PUBLIC COACHES LIST ====================
 
+# مجموع التقييمات وعددها وتوزيعها تُحدّث على ملف المدرب عند كل تقييم
+RATING_STARS = ["1", "2", "3", "4", "5"]
+
+def parse_rating(value) -> int:
+    """التقييم عدد صحيح من 1 إلى 5"""
+    try:
+        rating = int(round(float(value)))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid rating")
+    return min(max(rating, 1), 5)
+
+def rating_summary(profile: Optional[dict]) -> dict:
+    count = (profile or {}).get("rating_count", 0)
+    return {
+        "rating": round(profile["rating_sum"] / count, 1) if count else 0,
+        "reviews_count": count
+    }
+
+async def rebuild_coach_ratings():
+    """إعادة حساب ملخص التقييمات لكل المدربين من مجموعة التقييمات"""
+    await db.coach_profiles.update_many({}, {"$set": {
+        "rating_sum": 0,
+        "rating_count": 0,
+        "rating_histogram": {star: 0 for star in RATING_STARS}
+    }})
+    await db.reviews.aggregate([
+        {"$group": {
+            "_id": "$coach_id",
+            "rating_sum": {"$sum": "$rating"},
+            "rating_count": {"$sum": 1},
+            **{f"star_{star}": {"$sum": {"$cond": [{"$eq": ["$rating", int(star)]}, 1, 0]}} for star in RATING_STARS}
+        }},
+        {"$project": {
+            "_id": 0,
+            "user_id": "$_id",
+            "rating_sum": 1,
+            "rating_count": 1,
+            "rating_histogram": {star: f"$star_{star}" for star in RATING_STARS}
+        }},
+        {"$merge": {"into": "coach_profiles", "on": "user_id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+    ], allowDiskUse=True).to_list(None)
+    catalog_cache.invalidate("coaches")
+
+@app.on_event("startup")
+async def backfill_coach_ratings():
+    if await db.coach_profiles.find_one({"rating_count": {"$exists": True}}, {"_id": 1}) is None and await db.reviews.find_one({}, {"_id": 1}):
+        logger.info("Backfilling coach rating aggregates from reviews")
+        await rebuild_coach_ratings()
+
 @api_router.get("/coaches")
-async def get_public_coaches():
-    # Get all active coach profiles
-    coach_profiles = await db.coach_profiles.find({"is_active": True}).to_list(100)
-    
-    coaches = []
-    for profile in coach_profiles:
-        user = await db.users.find_one({"_id": profile["user_id"]})
-        if user:
-            # Get average rating
-            reviews = await db.reviews.find({"coach_id": profile["user_id"]}).to_list(1000)
-            avg_rating = sum(r["rating"] for r in reviews) / len(reviews) if reviews else 0
-            
+async def get_public_coaches(request: Request):
+    async def build():
+        # Active coach profiles with their user fields in one aggregation
+        coach_profiles = await db.coach_profiles.aggregate([
+            {"$match": {"is_active": True}},
+            {"$limit": 100},
+            {"$lookup": {
+                "from": "users",
+                "let": {"user_id": "$user_id"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$_id", "$$user_id"]}}},
+                    {"$project": {"full_name": 1, "email": 1}}
+                ],
+                "as": "user"
+            }},
+            {"$unwind": "$user"},
+            {"$project": {
+                "user": 1, "bio": 1, "specialties": 1, "hourly_rate": 1, "is_active": 1,
+                "rating_sum": 1, "rating_count": 1, **PROFILE_IMAGE_PROJECTION
+            }}
+        ]).to_list(100)
+        
+        coaches = []
+        for profile in coach_profiles:
+            user = profile["user"]
             coaches.append({
                 "id": user["_id"],
                 "full_name": user["full_name"],
                 "email": user["email"],
                 "bio": profile.get("bio", ""),
                 "specialties": profile.get("specialties", []),
-                "rating": round(avg_rating, 1),
-                "reviews_count": len(reviews),
+                **rating_summary(profile),
                 "hourly_rate": profile.get("hourly_rate", 50),
                 "is_active": profile.get("is_active", False),
-                "profile_image": profile.get("profile_image")
+                "profile_image": profile_image_url(profile)
             })
+        
+        return coaches
     
-    return coaches
+    return await catalog_response(request, "coaches", "", build)
 
 @api_router.get("/coaches/{coach_id}")
 async def get_coach_profile(coach_id: str):
@@ -2352,16 +3884,10 @@ async def get_coach_profile(coach_id: str):
         raise HTTPException(status_code=404, detail="Coach not found")
     
     profile = await db.coach_profiles.find_one({"user_id": coach_id})
-    reviews = await db.reviews.find({"coach_id": coach_id}).sort("created_at", -1).to_list(100)
-    
-    avg_rating = sum(r["rating"] for r in reviews) / len(reviews) if reviews else 0
+    reviews = await db.reviews.find({"coach_id": coach_id}).sort("created_at", -1).to_list(20)
     
     # Get profile image from profile or user
-    profile_image = None
-    if profile and profile.get("profile_image"):
-        profile_image = profile.get("profile_image")
-    elif user.get("profile_image"):
-        profile_image = user.get("profile_image")
+    profile_image = profile_image_url(profile, user, size=PROFILE_IMAGE_DETAIL_SIZE)
     
     return {
         "id": user["_id"],
@@ -2369,8 +3895,7 @@ async def get_coach_profile(coach_id: str):
         "email": user["email"],
         "bio": profile.get("bio", "") if profile else "",
         "specialties": profile.get("specialties", []) if profile else [],
-        "rating": round(avg_rating, 1),
-        "reviews_count": len(reviews),
+        **rating_summary(profile),
         "hourly_rate": profile.get("hourly_rate", 50) if profile else 50,
         "profile_image": profile_image,
         "reviews": [
@@ -2381,23 +3906,34 @@ async def get_coach_profile(coach_id: str):
                 "client_name": r.get("client_name", "متدرب"),
                 "created_at": r["created_at"]
             }
-            for r in reviews[:20]
+            for r in reviews
         ]
     }
 
 @api_router.post("/coaches/{coach_id}/review")
 async def add_coach_review(coach_id: str, data: dict, current_user: dict = Depends(get_current_user)):
+    coach = await get_cached_user(coach_id)
+    if not coach or coach.get("role") != "coach":
+        raise HTTPException(status_code=404, detail="Coach not found")
+    
+    rating = parse_rating(data.get("rating", 5))
     review = {
         "_id": str(uuid.uuid4()),
         "coach_id": coach_id,
         "client_id": current_user["_id"],
         "client_name": current_user["full_name"],
-        "rating": data.get("rating", 5),
+        "rating": rating,
         "comment": data.get("comment", ""),
         "created_at": datetime.utcnow()
     }
     
     await db.reviews.insert_one(review)
+    await db.coach_profiles.update_one(
+        {"user_id": coach_id},
+        {"$inc": {"rating_sum": rating, "rating_count": 1, f"rating_histogram.{rating}": 1}},
+        upsert=True
+    )
+    catalog_cache.invalidate("coaches")
     return {"message": "Review added", "review_id": review["_id"]}
 
 # Intake questionnaire
@@ -2427,27 +3963,31 @@ async def get_intake_questionnaire(current_user: dict = Depends(get_current_user
 
 @api_router.put("/coach/profile")
 async def update_coach_profile(data: dict, coach_user: dict = Depends(get_coach_user)):
+    # الصورة تُخزن مرة واحدة ببصمتها، والمستندات تحمل المعرف فقط
+    profile_image_id = await ingest_profile_image(data.get("profile_image"))
     update_data = {
         "user_id": coach_user["_id"],
         "bio": data.get("bio", ""),
         "specialties": data.get("specialties", []),
         "hourly_rate": data.get("hourly_rate", 50),
-        "profile_image": data.get("profile_image"),
+        "profile_image_id": profile_image_id,
         "updated_at": datetime.utcnow()
     }
     
     await db.coach_profiles.update_one(
         {"user_id": coach_user["_id"]},
-        {"$set": update_data},
+        {"$set": update_data, "$unset": {"profile_image": ""}},
         upsert=True
     )
+    catalog_cache.invalidate("coaches")
     
     # Also update user's profile_image
-    if data.get("profile_image") is not None:
+    if profile_image_id is not None:
         await db.users.update_one(
             {"_id": coach_user["_id"]},
-            {"$set": {"profile_image": data.get("profile_image")}}
+            {"$set": {"profile_image_id": profile_image_id}, "$unset": {"profile_image": ""}}
         )
+        invalidate_cached_user(coach_user["_id"])
     
     return {"message": "Profile updated"}
 
@@ -2462,6 +4002,149 @@ class HabitCreate(BaseModel):
 class HabitToggle(BaseModel):
     date: str  # YYYY-MM-DD format
 
+# الإنجاز محفوظ كخريطة بت لكل سنة: completion_bits.<year>.w<n> كلمات Int64 تحمل 32 يوماً لكل منها
+# حتى يكون التبديل عملية $bit ذرية واحدة بدلاً من قراءة المصفوفة وإعادة كتابتها
+HABIT_WORD_BITS = 32
+
+def habit_day_slot(day: datetime) -> Tuple[str, str, int]:
+    """(السنة، الكلمة، رقم البت) لليوم المعطى"""
+    index = day.timetuple().tm_yday - 1
+    return str(day.year), f"w{index // HABIT_WORD_BITS}", index % HABIT_WORD_BITS
+
+def parse_habit_date(date_str: str, user: dict) -> datetime:
+    """تاريخ التبديل محصور بين يوم إنشاء الحساب والغد (هامش لفروق المناطق الزمنية)
+
+    تاريخ بعيد مثل 0001-01-01 يجعل كل حسابات التحليلات تمتد عبر قرون
+    """
+    try:
+        day = datetime.strptime(date_str, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date, expected YYYY-MM-DD")
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    created_at = user.get("created_at") or today
+    if not created_at.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1) <= day <= today + timedelta(days=1):
+        raise HTTPException(status_code=400, detail="Date is outside the habit tracking range")
+    return day
+
+def encode_completion_bits(date_strings: List[str]) -> Dict[str, Dict[str, Int64]]:
+    words: Dict[str, Dict[str, int]] = {}
+    for date_str in date_strings:
+        try:
+            year, word, bit = habit_day_slot(datetime.strptime(date_str, "%Y-%m-%d"))
+        except ValueError:
+            continue
+        year_words = words.setdefault(year, {})
+        year_words[word] = year_words.get(word, 0) | (1 << bit)
+    return {year: {word: Int64(value) for word, value in year_words.items()} for year, year_words in words.items()}
+
+def habit_year_masks(habit: dict) -> Dict[int, int]:
+    """خريطة بت واحدة (int) لكل سنة، البت n يمثل اليوم n من السنة"""
+    bits = habit.get("completion_bits") or {}
+    if "completed_dates" in habit:
+        # مستند لم يُرحّل بعد
+        bits = encode_completion_bits(habit.get("completed_dates") or [])
+    masks = {}
+    for year, year_words in bits.items():
+        mask = 0
+        for word, value in year_words.items():
+            mask |= (int(value) & 0xFFFFFFFF) << (HABIT_WORD_BITS * int(word[1:]))
+        masks[int(year)] = mask
+    return masks
+
+def habit_completed_dates(masks: Dict[int, int]) -> List[str]:
+    dates = []
+    for year in sorted(masks):
+        mask = masks[year]
+        while mask:
+            low = mask & -mask
+            dates.append((datetime(year, 1, 1) + timedelta(days=low.bit_length() - 1)).strftime("%Y-%m-%d"))
+            mask ^= low
+    return dates
+
+def habit_is_done(masks: Dict[int, int], day: datetime) -> bool:
+    return bool(masks.get(day.year, 0) >> (day.timetuple().tm_yday - 1) & 1)
+
+def habit_streak(masks: Dict[int, int], day: datetime) -> int:
+    """عدد الأيام المتتالية المنجزة المنتهية في اليوم المعطى"""
+    streak = 0
+    year, index = day.year, day.timetuple().tm_yday - 1
+    while True:
+        window = (1 << (index + 1)) - 1
+        gaps = ~masks.get(year, 0) & window
+        if gaps:
+            return streak + index - gaps.bit_length() + 1
+        streak += index + 1
+        year -= 1
+        if year not in masks:
+            return streak
+        index = datetime(year, 12, 31).timetuple().tm_yday - 1
+
+def habit_longest_streak(masks: Dict[int, int]) -> int:
+    """أطول سلسلة من أطوال المقاطع في كل سنة فيها إنجاز، والمقطع الممتد لنهاية السنة يُكمل في السنة التالية"""
+    longest = carry = 0
+    previous_year = None
+    for year in sorted(year for year, mask in masks.items() if mask):
+        if previous_year != year - 1:
+            carry = 0
+        year_length = (datetime(year + 1, 1, 1) - datetime(year, 1, 1)).days
+        bits = np.unpackbits(np.frombuffer(masks[year].to_bytes(48, "little"), dtype=np.uint8), bitorder="little")[:year_length]
+        edges = np.diff(np.pad(bits, 1).astype(np.int8))
+        run_starts, run_ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        runs = run_ends - run_starts
+        if run_starts[0] == 0:
+            runs[0] += carry
+        longest = max(longest, int(runs.max()))
+        carry = int(runs[-1]) if run_ends[-1] == year_length else 0
+        previous_year = year
+    return longest
+
+def habit_count_between(masks: Dict[int, int], start: datetime, end: datetime) -> int:
+    """عدد الأيام المنجزة في المدى [start, end]"""
+    total = 0
+    for year in range(start.year, end.year + 1):
+        first = start.timetuple().tm_yday - 1 if year == start.year else 0
+        last = end.timetuple().tm_yday - 1 if year == end.year else 365
+        window = ((1 << (last + 1)) - 1) ^ ((1 << first) - 1)
+        total += bin(masks.get(year, 0) & window).count("1")
+    return total
+
+def habit_matrix(masks: List[Dict[int, int]], start: datetime, days: int) -> np.ndarray:
+    """مصفوفة منطقية (عادة × يوم) تبدأ من start، مفكوكة من خرائط البت بدون حلقات على الأيام"""
+    matrix = np.zeros((len(masks), days), dtype=bool)
+    end = start + timedelta(days=days - 1)
+    for row, habit_masks in enumerate(masks):
+        for year in range(start.year, end.year + 1):
+            mask = habit_masks.get(year)
+            if not mask:
+                continue
+            year_bits = np.unpackbits(np.frombuffer(mask.to_bytes(48, "little"), dtype=np.uint8), bitorder="little")
+            offset = (datetime(year, 1, 1) - start).days
+            year_length = (datetime(year + 1, 1, 1) - datetime(year, 1, 1)).days
+            first, last = max(offset, 0), min(offset + year_length, days)
+            if first < last:
+                matrix[row, first:last] = year_bits[first - offset:last - offset]
+    return matrix
+
+async def migrate_habit_document(habit: dict) -> bool:
+    """تحويل completed_dates إلى completion_bits (مقارنة ثم تبديل حتى لا تضيع تعديلات متزامنة)
+
+    الشرط يطلب مصفوفة صراحة: {"completed_dates": None} يطابق الحقل المفقود أيضاً فيمسح بتات مستند رُحّل للتو
+    """
+    result = await db.habits.update_one(
+        {"_id": habit["_id"], "completed_dates": {"$type": "array", "$eq": habit["completed_dates"]}},
+        {"$set": {"completion_bits": encode_completion_bits(habit["completed_dates"])},
+         "$unset": {"completed_dates": ""}}
+    )
+    return result.modified_count == 1
+
+async def migrate_habit_bitsets() -> int:
+    migrated = 0
+    async for habit in db.habits.find({"completed_dates": {"$type": "array"}}, {"completed_dates": 1}):
+        if await migrate_habit_document(habit):
+            migrated += 1
+    logger.info(f"Migrated {migrated} habits to completion bitsets")
+    return migrated
+
 @api_router.get("/habits")
 async def get_habits(current_user: dict = Depends(get_current_user)):
     """Get all habits for the current user"""
@@ -2484,7 +4167,7 @@ async def get_habits(current_user: dict = Depends(get_current_user)):
                 "icon": habit["icon"],
                 "color": habit["color"],
                 "frequency": "daily",
-                "completed_dates": [],
+                "completion_bits": {},
                 "created_at": datetime.utcnow()
             }
             await db.habits.insert_one(habit_doc)
@@ -2499,7 +4182,7 @@ async def get_habits(current_user: dict = Depends(get_current_user)):
             "icon": h["icon"],
             "color": h["color"],
             "frequency": h.get("frequency", "daily"),
-            "completedDates": h.get("completed_dates", []),
+            "completedDates": habit_completed_dates(habit_year_masks(h)),
             "createdAt": h.get("created_at", datetime.utcnow()).isoformat()
         })
     
@@ -2515,7 +4198,7 @@ async def create_habit(habit: HabitCreate, current_user: dict = Depends(get_curr
         "icon": habit.icon,
         "color": habit.color,
         "frequency": habit.frequency,
-        "completed_dates": [],
+        "completion_bits": {},
         "created_at": datetime.utcnow()
     }
     
@@ -2534,32 +4217,33 @@ async def create_habit(habit: HabitCreate, current_user: dict = Depends(get_curr
 @api_router.post("/habits/{habit_id}/toggle")
 async def toggle_habit(habit_id: str, data: HabitToggle, current_user: dict = Depends(get_current_user)):
     """Toggle habit completion for a specific date"""
-    habit = await db.habits.find_one({"_id": habit_id, "user_id": current_user["_id"]})
-    
-    if not habit:
-        raise HTTPException(status_code=404, detail="Habit not found")
-    
-    completed_dates = habit.get("completed_dates", [])
-    date_str = data.date
-    
-    if date_str in completed_dates:
-        # Remove the date (uncomplete)
-        completed_dates.remove(date_str)
-        action = "uncompleted"
+    year, word, bit = habit_day_slot(parse_habit_date(data.date, current_user))
+    
+    for _ in range(3):
+        habit = await db.habits.find_one_and_update(
+            {"_id": habit_id, "user_id": current_user["_id"], "completed_dates": {"$exists": False}},
+            {"$bit": {f"completion_bits.{year}.{word}": {"xor": Int64(1 << bit)}}},
+            projection={"completion_bits": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if habit:
+            break
+        
+        legacy = await db.habits.find_one({"_id": habit_id, "user_id": current_user["_id"]}, {"completed_dates": 1})
+        if not legacy:
+            raise HTTPException(status_code=404, detail="Habit not found")
+        if isinstance(legacy.get("completed_dates"), list):
+            await migrate_habit_document(legacy)
     else:
-        # Add the date (complete)
-        completed_dates.append(date_str)
-        action = "completed"
+        raise HTTPException(status_code=409, detail="Habit is being updated, please retry")
     
-    await db.habits.update_one(
-        {"_id": habit_id},
-        {"$set": {"completed_dates": completed_dates}}
-    )
+    masks = habit_year_masks(habit)
+    action = "completed" if masks.get(int(year), 0) >> (HABIT_WORD_BITS * int(word[1:]) + bit) & 1 else "uncompleted"
     
     return {
         "message": f"Habit {action}",
         "action": action,
-        "completedDates": completed_dates
+        "completedDates": habit_completed_dates(masks)
     }
 
 @api_router.delete("/habits/{habit_id}")
@@ -2577,33 +4261,17 @@ async def get_habit_stats(current_user: dict = Depends(get_current_user)):
     """Get habit statistics for the current user"""
     habits = await db.habits.find({"user_id": current_user["_id"]}).to_list(100)
     
-    today = datetime.utcnow().strftime("%Y-%m-%d")
+    today = datetime.utcnow()
+    week_start = today - timedelta(days=6)
     total_habits = len(habits)
-    completed_today = sum(1 for h in habits if today in h.get("completed_dates", []))
-    
-    # Calculate streaks
-    total_streak = 0
-    for habit in habits:
-        streak = 0
-        check_date = datetime.utcnow()
-        for i in range(365):
-            date_str = check_date.strftime("%Y-%m-%d")
-            if date_str in habit.get("completed_dates", []):
-                streak += 1
-                check_date -= timedelta(days=1)
-            else:
-                break
-        total_streak = max(total_streak, streak)
+    masks = [habit_year_masks(h) for h in habits]
+    
+    completed_today = sum(1 for m in masks if habit_is_done(m, today))
+    total_streak = max((habit_streak(m, today) for m in masks), default=0)
     
     # Weekly completion rate
-    week_completions = 0
+    week_completions = sum(habit_count_between(m, week_start, today) for m in masks)
     week_possible = total_habits * 7
-    for i in range(7):
-        date = (datetime.utcnow() - timedelta(days=i)).strftime("%Y-%m-%d")
-        for h in habits:
-            if date in h.get("completed_dates", []):
-                week_completions += 1
-    
     weekly_rate = (week_completions / week_possible * 100) if week_possible > 0 else 0
     
     return {
@@ -2614,25 +4282,258 @@ async def get_habit_stats(current_user: dict = Depends(get_current_user)):
         "weekly_rate": round(weekly_rate, 1)
     }
 
+@api_router.get("/habits/analytics")
+async def get_habit_analytics(
+    current_user: dict = Depends(get_current_user),
+    heatmap_days: int = Query(365, ge=7, le=366 * 3)
+):
+    """Per-habit streaks, rolling completion rates and heatmaps"""
+    habits = await db.habits.find(
+        {"user_id": current_user["_id"], "name": {"$exists": True}},
+        {"name": 1, "completion_bits": 1, "completed_dates": 1}
+    ).to_list(100)
+    
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    masks = [habit_year_masks(h) for h in habits]
+    # المصفوفة تغطي نافذة العرض والنسب فقط، والسلاسل تُحسب من خرائط البت مباشرة
+    days = max(heatmap_days, 90)
+    done = habit_matrix(masks, today - timedelta(days=days - 1), days)
+    
+    current_streaks = [habit_streak(m, today) for m in masks]
+    longest_streaks = [habit_longest_streak(m) for m in masks]
+    
+    # نسب الإنجاز المتحركة من المجموع التراكمي
+    cumulative = np.concatenate([np.zeros((len(habits), 1), dtype=np.int64), np.cumsum(done, axis=1)], axis=1)
+    rates = {
+        window: (cumulative[:, -1] - cumulative[:, -1 - window]) / window * 100
+        for window in (7, 30, 90)
+    }
+    
+    heatmap = done[:, -heatmap_days:]
+    heatmap_start = (today - timedelta(days=heatmap_days - 1)).strftime("%Y-%m-%d")
+    
+    return {
+        "start": heatmap_start,
+        "end": today.strftime("%Y-%m-%d"),
+        "habits": [
+            {
+                "id": habit["_id"],
+                "name": habit["name"],
+                "current_streak": int(current_streaks[i]),
+                "longest_streak": int(longest_streaks[i]),
+                "rate_7": round(float(rates[7][i]), 1),
+                "rate_30": round(float(rates[30][i]), 1),
+                "rate_90": round(float(rates[90][i]), 1),
+                "heatmap": heatmap[i].astype(np.uint8).tolist()
+            }
+            for i, habit in enumerate(habits)
+        ],
+        "heatmap": {"start": heatmap_start, "counts": heatmap.sum(axis=0).tolist()}
+    }
+
 # ==================== SOCKET.IO EVENTS ====================
 
+async def emit_to_user(event: str, data: Any, user_id: str):
+    """إرسال حدث لغرفة المستخدم عبر جميع العمال - البيانات تُحوّل لصيغة JSON (التواريخ مثلاً) قبل النشر"""
+    await sio.emit(event, jsonable_encoder(data), room=user_id)
+
+class SocketRegistry:
+    """اتصالات Socket.IO في هذا العامل: صاحب كل اتصال وآخر نشاط له"""
+    
+    def __init__(self, max_per_user: int, idle_timeout: float):
+        self.max_per_user = max_per_user
+        self.idle_timeout = idle_timeout
+        self.owners: Dict[str, str] = {}
+        self.last_seen: Dict[str, float] = {}
+        self.by_user: Dict[str, set] = {}
+        self.refused = 0
+        self.evicted_over_cap = 0
+        self.evicted_idle = 0
+    
+    def add(self, sid: str, user_id: str) -> List[str]:
+        """تسجيل اتصال جديد، ويُعاد ما يجب قطعه من أقدم اتصالات المستخدم لتجاوز الحد"""
+        self.owners[sid] = user_id
+        self.last_seen[sid] = time.monotonic()
+        sids = self.by_user.setdefault(user_id, set())
+        sids.add(sid)
+        overflow = len(sids) - self.max_per_user
+        if overflow <= 0:
+            return []
+        oldest = sorted((s for s in sids if s != sid), key=lambda s: self.last_seen[s])[:overflow]
+        self.evicted_over_cap += len(oldest)
+        return oldest
+    
+    def touch(self, sid: str):
+        if sid in self.last_seen:
+            self.last_seen[sid] = time.monotonic()
+    
+    def remove(self, sid: str):
+        user_id = self.owners.pop(sid, None)
+        self.last_seen.pop(sid, None)
+        sids = self.by_user.get(user_id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self.by_user[user_id]
+    
+    def idle(self) -> List[str]:
+        cutoff = time.monotonic() - self.idle_timeout
+        return [sid for sid, seen in self.last_seen.items() if seen < cutoff]
+    
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.owners),
+            "users": len(self.by_user),
+            "max_per_user": self.max_per_user,
+            "idle_timeout_seconds": self.idle_timeout,
+            "refused": self.refused,
+            "evicted_over_cap": self.evicted_over_cap,
+            "evicted_idle": self.evicted_idle
+        }
+
+socket_registry = SocketRegistry(SOCKET_MAX_CONNECTIONS_PER_USER, SOCKET_IDLE_TIMEOUT_SECONDS)
+
+def socket_token(environ: dict, auth) -> Optional[str]:
+    """التوكن من auth في المصافحة، أو ?token= في الرابط، أو ترويسة Authorization"""
+    if isinstance(auth, dict) and auth.get("token"):
+        return auth["token"]
+    query = dict(pair.split("=", 1) for pair in environ.get("QUERY_STRING", "").split("&") if "=" in pair)
+    if query.get("token"):
+        return query["token"]
+    header = environ.get("HTTP_AUTHORIZATION", "")
+    if header.lower().startswith("bearer "):
+        return header[7:]
+    return None
+
 @sio.event
-async def connect(sid, environ):
-    logger.info(f"Client connected: {sid}")
+async def connect(sid, environ, auth=None):
+    token = socket_token(environ, auth)
+    try:
+        user_id = decode_access_token(token) if token else None
+    except HTTPException:
+        user_id = None
+    user = await get_cached_user(user_id) if user_id else None
+    if user is None:
+        socket_registry.refused += 1
+        raise socketio.exceptions.ConnectionRefusedError("unauthorized")
+    
+    # الغرفة تُحدد في الخادم: غرفة المستخدم نفسه فقط
+    await sio.save_session(sid, {"user_id": user_id})
+    await sio.enter_room(sid, user_id)
+    for stale_sid in socket_registry.add(sid, user_id):
+        # السبب يُرسل قبل القطع حتى لا يعيد العميل الاتصال فيطرد الاتصال الأحدث
+        await sio.emit('evicted', {"reason": "connection_limit"}, to=stale_sid)
+        await sio.disconnect(stale_sid)
+    logger.info(f"Client connected: {sid} (user {user_id})")
 
 @sio.event
 async def disconnect(sid):
+    socket_registry.remove(sid)
     logger.info(f"Client disconnected: {sid}")
 
 @sio.event
-async def join(sid, data):
-    user_id = data.get('user_id')
-    if user_id:
-        await sio.enter_room(sid, user_id)
-        logger.info(f"User {user_id} joined room")
+async def join(sid, data=None):
+    """للتوافق مع العملاء القدامى - الغرفة انضُم إليها عند الاتصال ولا يُقبل user_id من العميل"""
+    socket_registry.touch(sid)
+    session = await sio.get_session(sid)
+    return {"room": session.get("user_id")}
+
+@sio.event
+async def heartbeat(sid, data=None):
+    socket_registry.touch(sid)
+
+@sio.on("*")
+async def any_event(event, sid, *args):
+    socket_registry.touch(sid)
+
+async def evict_idle_sockets():
+    while True:
+        await asyncio.sleep(60)
+        for sid in socket_registry.idle():
+            socket_registry.evicted_idle += 1
+            await sio.disconnect(sid)
+
+@app.on_event("startup")
+async def start_socket_bus():
+    # المستمع على الناقل يبدأ عادة مع أول اتصال Socket.IO؛ نبدؤه مبكراً حتى تصل إبطالات الكتالوج لكل عامل
+    if not sio.manager_initialized:
+        sio.manager_initialized = True
+        sio.manager.initialize()
+
+@app.on_event("startup")
+async def start_socket_eviction():
+    start_background_task(evict_idle_sockets())
 
 # ==================== STRIPE PAYMENT ENDPOINTS ====================
 
+class StripeGateway:
+    """استدعاءات Stripe خارج حلقة الأحداث مع مهلة لكل استدعاء وإعادة محاولة وقياس للكمون"""
+    
+    RETRYABLE_ERRORS = (stripe.APIConnectionError, stripe.RateLimitError)
+    
+    def __init__(self, workers: int, timeout: float, max_retries: int):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stripe")
+        self.latency: Dict[str, LatencyHistogram] = {}
+        self.failures: Dict[str, int] = {}
+    
+    async def _call(self, operation: str, fn, *args, idempotent: bool = False, **params):
+        # The same idempotency key is reused across retries so creates never duplicate
+        if idempotent:
+            params.setdefault("idempotency_key", str(uuid.uuid4()))
+        
+        histogram = self.latency.setdefault(operation, LatencyHistogram())
+        loop = asyncio.get_running_loop()
+        error = None
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(
+                    loop.run_in_executor(self._executor, functools.partial(fn, *args, **params)),
+                    timeout=self.timeout
+                )
+                histogram.observe(time.perf_counter() - started)
+                return result
+            except asyncio.TimeoutError:
+                error = stripe.APIConnectionError(f"Stripe {operation} timed out after {self.timeout}s")
+            except self.RETRYABLE_ERRORS as e:
+                error = e
+            histogram.observe(time.perf_counter() - started)
+            
+            if attempt < self.max_retries:
+                # Exponential backoff with full jitter
+                await asyncio.sleep(random.uniform(0, 0.25 * 2 ** attempt))
+        
+        self.failures[operation] = self.failures.get(operation, 0) + 1
+        logger.error(f"Stripe {operation} failed after {self.max_retries + 1} attempts: {error}")
+        raise error
+    
+    async def create_customer(self, **params):
+        return await self._call("customer.create", stripe.Customer.create, idempotent=True, **params)
+    
+    async def create_payment_intent(self, **params):
+        return await self._call("payment_intent.create", stripe.PaymentIntent.create, idempotent=True, **params)
+    
+    async def retrieve_payment_intent(self, payment_intent_id: str):
+        return await self._call("payment_intent.retrieve", stripe.PaymentIntent.retrieve, payment_intent_id)
+    
+    async def create_setup_intent(self, **params):
+        return await self._call("setup_intent.create", stripe.SetupIntent.create, idempotent=True, **params)
+    
+    async def create_ephemeral_key(self, **params):
+        return await self._call("ephemeral_key.create", stripe.EphemeralKey.create, idempotent=True, **params)
+    
+    def stats(self) -> dict:
+        return {
+            "timeout_seconds": self.timeout,
+            "max_retries": self.max_retries,
+            "failures": self.failures,
+            "latency": {operation: h.snapshot() for operation, h in self.latency.items()}
+        }
+
+stripe_gateway = StripeGateway(STRIPE_WORKERS, STRIPE_TIMEOUT_SECONDS, STRIPE_MAX_RETRIES)
+
 class CreatePaymentIntentRequest(BaseModel):
     package_id: str
     coach_id: str
@@ -2662,7 +4563,7 @@ async def create_payment_intent(data: CreatePaymentIntentRequest, current_user:
         stripe_customer_id = current_user.get("stripe_customer_id")
         
         if not stripe_customer_id:
-            customer = stripe.Customer.create(
+            customer = await stripe_gateway.create_customer(
                 email=current_user["email"],
                 name=current_user.get("full_name", ""),
                 metadata={"user_id": current_user["_id"]}
@@ -2674,9 +4575,10 @@ async def create_payment_intent(data: CreatePaymentIntentRequest, current_user:
                 {"_id": current_user["_id"]},
                 {"$set": {"stripe_customer_id": stripe_customer_id}}
             )
+            invalidate_cached_user(current_user["_id"])
         
         # Create PaymentIntent
-        payment_intent = stripe.PaymentIntent.create(
+        payment_intent = await stripe_gateway.create_payment_intent(
             amount=data.amount,
             currency="usd",
             customer=stripe_customer_id,
@@ -2690,7 +4592,7 @@ async def create_payment_intent(data: CreatePaymentIntentRequest, current_user:
         )
         
         # Create ephemeral key for Payment Sheet
-        ephemeral_key = stripe.EphemeralKey.create(
+        ephemeral_key = await stripe_gateway.create_ephemeral_key(
             customer=stripe_customer_id,
             stripe_version="2023-10-16"
         )
@@ -2716,7 +4618,7 @@ async def confirm_booking_payment(data: dict, current_user: dict = Depends(get_c
         notes = data.get("notes", "")
         
         # Verify payment with Stripe
-        payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        payment_intent = await stripe_gateway.retrieve_payment_intent(payment_intent_id)
         
         if payment_intent.status != "succeeded":
             raise HTTPException(status_code=400, detail="Payment not completed")
@@ -2750,6 +4652,7 @@ async def confirm_booking_payment(data: dict, current_user: dict = Depends(get_c
         }
         
         await db.bookings.insert_one(booking_dict)
+        await track_counters("bookings", None, booking_dict)
         
         # Record payment
         await db.payments.insert_one({
@@ -2762,6 +4665,7 @@ async def confirm_booking_payment(data: dict, current_user: dict = Depends(get_c
             "status": "completed",
             "created_at": datetime.utcnow()
         })
+        await refresh_revenue_day(datetime.utcnow())
         
         return {"message": "Booking confirmed", "booking_id": booking_id}
         
@@ -2786,9 +4690,12 @@ SUBSCRIPTION_PRICES = {
 }
 
 @api_router.get("/subscriptions/plans")
-async def get_subscription_plans():
+async def get_subscription_plans(request: Request):
     """Get available subscription plans"""
-    return list(SUBSCRIPTION_PRICES.values())
+    async def build():
+        return list(SUBSCRIPTION_PRICES.values())
+    
+    return await catalog_response(request, "plans", "", build)
 
 @api_router.post("/subscriptions/create-setup-intent")
 async def create_subscription_setup(coach_user: dict = Depends(get_coach_user)):
@@ -2798,7 +4705,7 @@ async def create_subscription_setup(coach_user: dict = Depends(get_coach_user)):
         stripe_customer_id = coach_user.get("stripe_customer_id")
         
         if not stripe_customer_id:
-            customer = stripe.Customer.create(
+            customer = await stripe_gateway.create_customer(
                 email=coach_user["email"],
                 name=coach_user.get("full_name", ""),
                 metadata={"user_id": coach_user["_id"], "role": "coach"}
@@ -2809,16 +4716,17 @@ async def create_subscription_setup(coach_user: dict = Depends(get_coach_user)):
                 {"_id": coach_user["_id"]},
                 {"$set": {"stripe_customer_id": stripe_customer_id}}
             )
+            invalidate_cached_user(coach_user["_id"])
         
         # Create SetupIntent for collecting payment method
-        setup_intent = stripe.SetupIntent.create(
+        setup_intent = await stripe_gateway.create_setup_intent(
             customer=stripe_customer_id,
             payment_method_types=["card"],
             metadata={"user_id": coach_user["_id"]}
         )
         
         # Create ephemeral key
-        ephemeral_key = stripe.EphemeralKey.create(
+        ephemeral_key = await stripe_gateway.create_ephemeral_key(
             customer=stripe_customer_id,
             stripe_version="2023-10-16"
         )
@@ -2869,6 +4777,7 @@ async def activate_subscription(data: dict, coach_user: dict = Depends(get_coach
                 }
             }
         )
+        invalidate_cached_user(coach_user["_id"])
         
         # Record subscription payment
         await db.payments.insert_one({
@@ -2880,6 +4789,7 @@ async def activate_subscription(data: dict, coach_user: dict = Depends(get_coach
             "status": "completed",
             "created_at": datetime.utcnow()
         })
+        await refresh_revenue_day(datetime.utcnow())
         
         return {"message": "Subscription activated", "status": "active", "plan": plan}
         
@@ -2933,6 +4843,7 @@ async def stripe_webhook(request):
                 {"_id": user["_id"]},
                 {"$set": {"subscription_status": subscription.get("status")}}
             )
+            invalidate_cached_user(user["_id"])
     
     return {"status": "success"}
 
@@ -2944,38 +4855,51 @@ async def root():
 
 # ==================== RESOURCES ENDPOINTS ====================
 
+# حقول عرض القوائم - المحتوى الكامل للمقال يُجلب من صفحة التفاصيل فقط
+RESOURCE_LIST_FIELDS = {
+    "title": 1, "description": 1, "category": 1, "content_type": 1, "external_url": 1,
+    "internal_route": 1, "duration": 1, "icon": 1, "is_active": 1, "created_at": 1, "updated_at": 1,
+    "has_content": has_value("content")
+}
+
 @api_router.get("/resources")
-async def get_resources(category: Optional[str] = None, active_only: bool = True):
-    """جلب جميع الموارد - متاح للجميع"""
-    query = {}
-    if category and category != "all":
-        query["category"] = category
-    if active_only:
-        query["is_active"] = True
-    
-    resources = await db.resources.find(query).sort("created_at", -1).to_list(100)
-    
-    # تنسيق البيانات للعرض
-    result = []
-    for r in resources:
-        # توليد ID إذا لم يكن موجوداً
-        resource_id = r.get("_id") or r.get("id") or str(uuid.uuid4())
-        result.append({
-            "id": str(resource_id),
-            "title": r.get("title", ""),
-            "description": r.get("description", ""),
-            "category": r.get("category", ""),
-            "content_type": r.get("content_type", "article"),
-            "content": r.get("content", ""),
-            "external_url": r.get("external_url", ""),
-            "internal_route": r.get("internal_route", ""),
-            "duration": r.get("duration", ""),
-            "icon": r.get("icon", "document-text"),
-            "is_active": r.get("is_active", True),
-            "created_at": r.get("created_at"),
-        })
+async def get_resources(request: Request, category: Optional[str] = None, active_only: bool = True, fields: Optional[str] = None):
+    """جلب جميع الموارد - متاح للجميع (المحتوى الكامل من /resources/{id})"""
+    selected = parse_fields(fields, RESOURCE_LIST_FIELDS)
+    
+    async def build():
+        query = {}
+        if category and category != "all":
+            query["category"] = category
+        if active_only:
+            query["is_active"] = True
+        
+        projection = {"id": 1, **list_projection(RESOURCE_LIST_FIELDS, selected)}
+        resources = await db.resources.find(query, projection).sort("created_at", -1).to_list(100)
+        
+        # تنسيق البيانات للعرض
+        result = []
+        for r in resources:
+            # توليد ID إذا لم يكن موجوداً
+            resource_id = r.get("_id") or r.get("id") or str(uuid.uuid4())
+            result.append(pick_fields({
+                "id": str(resource_id),
+                "title": r.get("title", ""),
+                "description": r.get("description", ""),
+                "category": r.get("category", ""),
+                "content_type": r.get("content_type", "article"),
+                "has_content": r.get("has_content", False),
+                "external_url": r.get("external_url", ""),
+                "internal_route": r.get("internal_route", ""),
+                "duration": r.get("duration", ""),
+                "icon": r.get("icon", "document-text"),
+                "is_active": r.get("is_active", True),
+                "created_at": r.get("created_at"),
+            }, selected))
+        
+        return result
     
-    return result
+    return await catalog_response(request, "resources", f"{category}:{active_only}:{fields or ''}", build)
 
 @api_router.get("/resources/{resource_id}")
 async def get_resource(resource_id: str):
@@ -3024,6 +4948,7 @@ async def create_resource(resource: ResourceCreate, admin: dict = Depends(get_ad
     }
     
     await db.resources.insert_one(resource_dict)
+    catalog_cache.invalidate("resources")
     
     return {"message": "تم إنشاء المورد بنجاح", "id": resource_id}
 
@@ -3041,6 +4966,7 @@ async def update_resource(resource_id: str, resource: ResourceUpdate, admin: dic
         {"_id": resource_id},
         {"$set": update_data}
     )
+    catalog_cache.invalidate("resources")
     
     return {"message": "تم تحديث المورد بنجاح"}
 
@@ -3050,23 +4976,25 @@ async def delete_resource(resource_id: str, admin: dict = Depends(get_admin_user
     result = await db.resources.delete_one({"_id": resource_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Resource not found")
+    catalog_cache.invalidate("resources")
     
     return {"message": "تم حذف المورد بنجاح"}
 
 @api_router.get("/admin/resources")
-async def get_all_resources_admin(admin: dict = Depends(get_admin_user)):
+async def get_all_resources_admin(admin: dict = Depends(get_admin_user), fields: Optional[str] = None):
     """جلب جميع الموارد للأدمن (بما فيها غير النشطة)"""
-    resources = await db.resources.find({}).sort("created_at", -1).to_list(100)
+    selected = parse_fields(fields, RESOURCE_LIST_FIELDS)
+    resources = await db.resources.find({}, list_projection(RESOURCE_LIST_FIELDS, selected)).sort("created_at", -1).to_list(100)
     
     result = []
     for r in resources:
-        result.append({
+        result.append(pick_fields({
             "id": r["_id"],
             "title": r.get("title", ""),
             "description": r.get("description", ""),
             "category": r.get("category", ""),
             "content_type": r.get("content_type", "article"),
-            "content": r.get("content", ""),
+            "has_content": r.get("has_content", False),
             "external_url": r.get("external_url", ""),
             "internal_route": r.get("internal_route", ""),
             "duration": r.get("duration", ""),
@@ -3074,36 +5002,46 @@ async def get_all_resources_admin(admin: dict = Depends(get_admin_user)):
             "is_active": r.get("is_active", True),
             "created_at": r.get("created_at"),
             "updated_at": r.get("updated_at"),
-        })
+        }, selected))
     
     return result
 
 # ==================== CUSTOM CALCULATORS ENDPOINTS ====================
 
+# كود HTML الكامل للحاسبة يُجلب من /custom-calculators/{id} فقط
+CALCULATOR_LIST_FIELDS = {
+    "title": 1, "description": 1, "category": 1, "icon": 1, "is_active": 1, "created_at": 1, "updated_at": 1
+}
+
 @api_router.get("/custom-calculators")
-async def get_custom_calculators(category: Optional[str] = None, active_only: bool = True):
+async def get_custom_calculators(request: Request, category: Optional[str] = None, active_only: bool = True, fields: Optional[str] = None):
     """جلب الحاسبات المخصصة - متاح للجميع"""
-    query = {}
-    if category and category != "all":
-        query["category"] = category
-    if active_only:
-        query["is_active"] = True
-    
-    calculators = await db.custom_calculators.find(query).sort("created_at", -1).to_list(100)
-    
-    result = []
-    for calc in calculators:
-        result.append({
-            "id": calc["_id"],
-            "title": calc.get("title", ""),
-            "description": calc.get("description", ""),
-            "category": calc.get("category", ""),
-            "icon": calc.get("icon", "calculator"),
-            "is_active": calc.get("is_active", True),
-            "created_at": calc.get("created_at"),
-        })
+    selected = parse_fields(fields, CALCULATOR_LIST_FIELDS)
+    
+    async def build():
+        query = {}
+        if category and category != "all":
+            query["category"] = category
+        if active_only:
+            query["is_active"] = True
+        
+        calculators = await db.custom_calculators.find(query, list_projection(CALCULATOR_LIST_FIELDS, selected)).sort("created_at", -1).to_list(100)
+        
+        result = []
+        for calc in calculators:
+            result.append(pick_fields({
+                "id": calc["_id"],
+                "title": calc.get("title", ""),
+                "description": calc.get("description", ""),
+                "category": calc.get("category", ""),
+                "icon": calc.get("icon", "calculator"),
+                "is_active": calc.get("is_active", True),
+                "created_at": calc.get("created_at"),
+            }, selected))
+        
+        return result
     
-    return result
+    return await catalog_response(request, "calculators", f"{category}:{active_only}:{fields or ''}", build)
 
 @api_router.get("/custom-calculators/{calculator_id}")
 async def get_custom_calculator(calculator_id: str):
@@ -3143,6 +5081,7 @@ async def create_custom_calculator(calculator: CustomCalculatorCreate, admin: di
     }
     
     await db.custom_calculators.insert_one(calc_dict)
+    catalog_cache.invalidate("calculators")
     
     return {"message": "تم إنشاء الحاسبة بنجاح", "id": calculator_id}
 
@@ -3160,6 +5099,7 @@ async def update_custom_calculator(calculator_id: str, calculator: CustomCalcula
         {"_id": calculator_id},
         {"$set": update_data}
     )
+    catalog_cache.invalidate("calculators")
     
     return {"message": "تم تحديث الحاسبة بنجاح"}
 
@@ -3169,27 +5109,28 @@ async def delete_custom_calculator(calculator_id: str, admin: dict = Depends(get
     result = await db.custom_calculators.delete_one({"_id": calculator_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Calculator not found")
+    catalog_cache.invalidate("calculators")
     
     return {"message": "تم حذف الحاسبة بنجاح"}
 
 @api_router.get("/admin/custom-calculators")
-async def get_all_custom_calculators_admin(admin: dict = Depends(get_admin_user)):
+async def get_all_custom_calculators_admin(admin: dict = Depends(get_admin_user), fields: Optional[str] = None):
     """جلب جميع الحاسبات للأدمن"""
-    calculators = await db.custom_calculators.find({}).sort("created_at", -1).to_list(100)
+    selected = parse_fields(fields, CALCULATOR_LIST_FIELDS)
+    calculators = await db.custom_calculators.find({}, list_projection(CALCULATOR_LIST_FIELDS, selected)).sort("created_at", -1).to_list(100)
     
     result = []
     for calc in calculators:
-        result.append({
+        result.append(pick_fields({
             "id": calc["_id"],
             "title": calc.get("title", ""),
             "description": calc.get("description", ""),
             "category": calc.get("category", ""),
             "icon": calc.get("icon", "calculator"),
-            "html_content": calc.get("html_content", ""),
             "is_active": calc.get("is_active", True),
             "created_at": calc.get("created_at"),
             "updated_at": calc.get("updated_at"),
-        })
+        }, selected))
     
     return result
 
@@ -3285,6 +5226,8 @@ async def create_unified_package(package: UnifiedPackageCreate, admin: dict = De
     }
     
     await db.unified_packages.insert_one(package_dict)
+    await track_counters("unified_packages", None, package_dict)
+    catalog_cache.invalidate("packages")
     
     package_dict["id"] = package_dict.pop("_id")
     return package_dict
@@ -3300,12 +5243,16 @@ async def update_unified_package(package_id: str, package: UnifiedPackageUpdate,
     update_data = {k: v for k, v in package.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    await db.unified_packages.update_one(
+    previous = await db.unified_packages.find_one_and_update(
         {"_id": package_id},
         {"$set": update_data}
     )
+    if previous is None:
+        raise HTTPException(status_code=404, detail="الباقة غير موجودة")
+    updated = {**previous, **update_data}
+    await track_counters("unified_packages", previous, updated)
+    catalog_cache.invalidate("packages")
     
-    updated = await db.unified_packages.find_one({"_id": package_id})
     updated["id"] = updated.pop("_id")
     return updated
 
@@ -3313,68 +5260,69 @@ async def update_unified_package(package_id: str, package: UnifiedPackageUpdate,
 @api_router.delete("/admin/packages/{package_id}")
 async def delete_unified_package(package_id: str, admin: dict = Depends(get_admin_user)):
     """حذف باقة"""
-    result = await db.unified_packages.delete_one({"_id": package_id})
-    if result.deleted_count == 0:
+    deleted = await db.unified_packages.find_one_and_delete({"_id": package_id})
+    if deleted is None:
         raise HTTPException(status_code=404, detail="الباقة غير موجودة")
+    await track_counters("unified_packages", deleted, None)
+    catalog_cache.invalidate("packages")
     return {"message": "تم حذف الباقة بنجاح"}
 
 
 @api_router.get("/admin/packages/stats")
 async def get_packages_stats(admin: dict = Depends(get_admin_user)):
     """إحصائيات الباقات"""
-    total_packages = await db.unified_packages.count_documents({})
-    active_packages = await db.unified_packages.count_documents({"is_active": True})
-    private_sessions_count = await db.unified_packages.count_documents({"category": "private_sessions"})
-    self_training_count = await db.unified_packages.count_documents({"category": "self_training"})
-    
-    total_subscriptions = await db.user_subscriptions.count_documents({})
-    active_subscriptions = await db.user_subscriptions.count_documents({"status": "active"})
+    counters = await read_counters([
+        "packages.total", "packages.active", "packages.private_sessions", "packages.self_training",
+        "user_subscriptions.total", "user_subscriptions.active"
+    ])
     
     return {
-        "total_packages": total_packages,
-        "active_packages": active_packages,
-        "private_sessions_count": private_sessions_count,
-        "self_training_count": self_training_count,
-        "total_subscriptions": total_subscriptions,
-        "active_subscriptions": active_subscriptions,
+        "total_packages": counters["packages.total"],
+        "active_packages": counters["packages.active"],
+        "private_sessions_count": counters["packages.private_sessions"],
+        "self_training_count": counters["packages.self_training"],
+        "total_subscriptions": counters["user_subscriptions.total"],
+        "active_subscriptions": counters["user_subscriptions.active"],
     }
 
 
 # --- عرض الباقات للمستخدمين ---
 
 @api_router.get("/all-packages")
-async def get_packages_for_users(category: Optional[str] = None):
+async def get_packages_for_users(request: Request, category: Optional[str] = None):
     """جلب الباقات المتاحة للمستخدمين"""
-    query = {"is_active": True}
-    if category:
-        query["category"] = category
-    
-    packages = await db.unified_packages.find(query).sort("display_order", 1).to_list(100)
-    
-    result = []
-    for pkg in packages:
-        result.append({
-            "id": pkg["_id"],
-            "name": pkg.get("name", ""),
-            "description": pkg.get("description", ""),
-            "price": pkg.get("price", 0),
-            "category": pkg.get("category", ""),
-            
-            "sessions_count": pkg.get("sessions_count"),
-            "validity_days": pkg.get("validity_days"),
-            "includes_self_training": pkg.get("includes_self_training", False),
-            
-            "subscription_type": pkg.get("subscription_type"),
-            "duration_months": pkg.get("duration_months"),
-            "auto_renewal": pkg.get("auto_renewal", False),
-            
-            "features": pkg.get("features", []),
-            "discount_percentage": pkg.get("discount_percentage", 0),
-            "is_popular": pkg.get("is_popular", False),
-        })
+    async def build():
+        query = {"is_active": True}
+        if category:
+            query["category"] = category
+        
+        packages = await db.unified_packages.find(query).sort("display_order", 1).to_list(100)
+        
+        result = []
+        for pkg in packages:
+            result.append({
+                "id": pkg["_id"],
+                "name": pkg.get("name", ""),
+                "description": pkg.get("description", ""),
+                "price": pkg.get("price", 0),
+                "category": pkg.get("category", ""),
+                
+                "sessions_count": pkg.get("sessions_count"),
+                "validity_days": pkg.get("validity_days"),
+                "includes_self_training": pkg.get("includes_self_training", False),
+                
+                "subscription_type": pkg.get("subscription_type"),
+                "duration_months": pkg.get("duration_months"),
+                "auto_renewal": pkg.get("auto_renewal", False),
+                
+                "features": pkg.get("features", []),
+                "discount_percentage": pkg.get("discount_percentage", 0),
+                "is_popular": pkg.get("is_popular", False),
+            })
+        
+        return result
     
-    return result
-
+    return await catalog_response(request, "packages", category or "", build)
 
 @api_router.get("/all-packages/{package_id}")
 async def get_package_details(package_id: str):
@@ -3387,6 +5335,69 @@ async def get_package_details(package_id: str):
     return package
 
 
+# --- انتهاء صلاحية الاشتراكات ---
+
+SUBSCRIPTION_COLLECTIONS = ("user_subscriptions", "self_training_subscriptions")
+
+def active_subscription_query(user_id: str, **conditions) -> dict:
+    """الاشتراك الفعال: status active وتاريخ الانتهاء لم يمر بعد
+    
+    مهمة الكنس الدورية تغيّر status فقط، وشرط التاريخ يبقي القراءة صحيحة إن تأخرت المهمة أو توقفت
+    """
+    return {"user_id": user_id, "status": "active", "end_date": {"$gt": datetime.utcnow()}, **conditions}
+
+async def expire_subscriptions() -> int:
+    """تعليم الاشتراكات المنتهية دفعة واحدة لكل مجموعة وإرسال أحداث الانتهاء"""
+    now = datetime.utcnow()
+    expired_total = 0
+    for collection_name in SUBSCRIPTION_COLLECTIONS:
+        collection = db[collection_name]
+        result = await collection.update_many(
+            {"status": "active", "end_date": {"$lte": now}},
+            {"$set": {"status": "expired", "expired_at": now}}
+        )
+        if not result.modified_count:
+            continue
+        expired_total += result.modified_count
+        await track_counters(collection_name, {"status": "active"}, {"status": "expired"}, count=result.modified_count)
+        
+        expired = await collection.find(
+            {"expired_at": now, "status": "expired"},
+            {"user_id": 1, "package_id": 1, "package_name": 1, "category": 1, "end_date": 1}
+        ).to_list(None)
+        await db.subscription_events.insert_many([{
+            "_id": str(uuid.uuid4()),
+            "type": "expired",
+            "collection": collection_name,
+            "subscription_id": sub["_id"],
+            "user_id": sub["user_id"],
+            "created_at": now
+        } for sub in expired])
+        for sub in expired:
+            await emit_to_user('subscription_expired', {
+                "subscription_id": sub["_id"],
+                "package_id": sub.get("package_id"),
+                "package_name": sub.get("package_name"),
+                "category": sub.get("category", "self_training"),
+                "end_date": sub.get("end_date")
+            }, sub["user_id"])
+    if expired_total:
+        logger.info(f"Expired {expired_total} subscriptions")
+    return expired_total
+
+async def expire_subscriptions_periodically():
+    while True:
+        try:
+            if await acquire_job_lease("expire_subscriptions", SUBSCRIPTION_SWEEP_INTERVAL_SECONDS):
+                await expire_subscriptions()
+        except PyMongoError as e:
+            logger.warning(f"Subscription expiry sweep failed: {e}")
+        await asyncio.sleep(SUBSCRIPTION_SWEEP_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_subscription_sweeper():
+    start_background_task(expire_subscriptions_periodically())
+
 # --- اشتراك المستخدم في باقة ---
 
 @api_router.post("/all-packages/{package_id}/subscribe")
@@ -3398,12 +5409,10 @@ async def subscribe_to_package(package_id: str, current_user: dict = Depends(get
         raise HTTPException(status_code=404, detail="الباقة غير موجودة أو غير متاحة")
     
     # التحقق من عدم وجود اشتراك فعال من نفس الفئة
-    existing_subscription = await db.user_subscriptions.find_one({
-        "user_id": current_user["_id"],
-        "category": package["category"],
-        "status": "active",
-        "end_date": {"$gt": datetime.utcnow()}
-    })
+    existing_subscription = await db.user_subscriptions.find_one(
+        active_subscription_query(current_user["_id"], category=package["category"]),
+        {"_id": 1}
+    )
     
     if existing_subscription:
         raise HTTPException(
@@ -3451,10 +5460,11 @@ async def subscribe_to_package(package_id: str, current_user: dict = Depends(get
     }
     
     await db.user_subscriptions.insert_one(subscription_dict)
+    await track_counters("user_subscriptions", None, subscription_dict)
     
     # إنشاء نية دفع Stripe
     try:
-        payment_intent = stripe.PaymentIntent.create(
+        payment_intent = await stripe_gateway.create_payment_intent(
             amount=int(package["price"] * 100),  # بالهللات
             currency="sar",
             metadata={
@@ -3477,7 +5487,8 @@ async def subscribe_to_package(package_id: str, current_user: dict = Depends(get
         }
     except Exception as e:
         # في حالة الفشل، احذف الاشتراك
-        await db.user_subscriptions.delete_one({"_id": subscription_id})
+        deleted = await db.user_subscriptions.find_one_and_delete({"_id": subscription_id})
+        await track_counters("user_subscriptions", deleted, None)
         raise HTTPException(status_code=500, detail=f"فشل في إنشاء عملية الدفع: {str(e)}")
 
 
@@ -3501,13 +5512,15 @@ async def confirm_package_payment(payment_data: dict, current_user: dict = Depen
     
     # التحقق من حالة الدفع في Stripe
     try:
-        payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        payment_intent = await stripe_gateway.retrieve_payment_intent(payment_intent_id)
         
         if payment_intent.status == "succeeded":
-            await db.user_subscriptions.update_one(
+            previous = await db.user_subscriptions.find_one_and_update(
                 {"_id": subscription_id},
                 {"$set": {"payment_status": "paid"}}
             )
+            if previous:
+                await track_counters("user_subscriptions", previous, {**previous, "payment_status": "paid"})
             return {"message": "تم تأكيد الدفع وتفعيل الاشتراك بنجاح", "status": "success"}
         else:
             return {"message": "الدفع لم يكتمل بعد", "status": payment_intent.status}
@@ -3526,10 +5539,10 @@ async def mark_subscription_as_paid(subscription_id: str, current_user: dict = D
     if not subscription:
         raise HTTPException(status_code=404, detail="الاشتراك غير موجود")
     
-    await db.user_subscriptions.update_one(
-        {"_id": subscription_id},
-        {"$set": {"payment_status": "paid", "status": "active"}}
-    )
+    update = {"payment_status": "paid", "status": "active"}
+    previous = await db.user_subscriptions.find_one_and_update({"_id": subscription_id}, {"$set": update})
+    if previous:
+        await track_counters("user_subscriptions", previous, {**previous, **update})
     
     return {"message": "تم تفعيل الاشتراك بنجاح", "status": "success"}
 
@@ -3543,14 +5556,6 @@ async def get_my_subscriptions(current_user: dict = Depends(get_current_user)):
     
     result = []
     for sub in subscriptions:
-        # التحقق من انتهاء الصلاحية
-        if sub.get("status") == "active" and sub.get("end_date") < datetime.utcnow():
-            await db.user_subscriptions.update_one(
-                {"_id": sub["_id"]},
-                {"$set": {"status": "expired"}}
-            )
-            sub["status"] = "expired"
-        
         result.append({
             "id": sub["_id"],
             "package_id": sub.get("package_id"),
@@ -3573,12 +5578,7 @@ async def get_my_subscriptions(current_user: dict = Depends(get_current_user)):
 @api_router.get("/my-active-subscription")
 async def get_active_subscription(current_user: dict = Depends(get_current_user), category: Optional[str] = None):
     """جلب الاشتراك الفعال للمستخدم"""
-    query = {
-        "user_id": current_user["_id"],
-        "status": "active",
-        "payment_status": "paid",
-        "end_date": {"$gt": datetime.utcnow()}
-    }
+    query = active_subscription_query(current_user["_id"], payment_status="paid")
     
     if category:
         query["category"] = category
@@ -3670,6 +5670,8 @@ async def create_self_training_package(package: SelfTrainingPackageCreate, admin
     }
     
     await db.self_training_packages.insert_one(package_dict)
+    await track_counters("self_training_packages", None, package_dict)
+    catalog_cache.invalidate("self_training_packages")
     
     return {"message": "تم إنشاء الباقة بنجاح", "id": package_id}
 
@@ -3690,10 +5692,13 @@ async def update_self_training_package(package_id: str, package: SelfTrainingPac
     
     update_data["updated_at"] = datetime.utcnow()
     
-    await db.self_training_packages.update_one(
+    previous = await db.self_training_packages.find_one_and_update(
         {"_id": package_id},
         {"$set": update_data}
     )
+    if previous:
+        await track_counters("self_training_packages", previous, {**previous, **update_data})
+    catalog_cache.invalidate("self_training_packages")
     
     return {"message": "تم تحديث الباقة بنجاح"}
 
@@ -3712,34 +5717,39 @@ async def delete_self_training_package(package_id: str, admin: dict = Depends(ge
             detail=f"لا يمكن حذف الباقة - يوجد {active_subs} اشتراك نشط"
         )
     
-    result = await db.self_training_packages.delete_one({"_id": package_id})
-    if result.deleted_count == 0:
+    deleted = await db.self_training_packages.find_one_and_delete({"_id": package_id})
+    if deleted is None:
         raise HTTPException(status_code=404, detail="الباقة غير موجودة")
+    await track_counters("self_training_packages", deleted, None)
+    catalog_cache.invalidate("self_training_packages")
     
     return {"message": "تم حذف الباقة بنجاح"}
 
 # --- عرض الباقات للمستخدمين ---
 
 @api_router.get("/self-training/packages")
-async def get_self_training_packages():
+async def get_self_training_packages(request: Request):
     """جلب باقات التدريب الذاتي النشطة للمستخدمين"""
-    packages = await db.self_training_packages.find({"is_active": True}).sort("duration_months", 1).to_list(100)
-    
-    result = []
-    for pkg in packages:
-        result.append({
-            "id": pkg["_id"],
-            "name": pkg.get("name", ""),
-            "description": pkg.get("description", ""),
-            "duration_months": pkg.get("duration_months", 1),
-            "price": pkg.get("price", 0),
-            "price_per_month": pkg.get("price_per_month", 0),
-            "discount_percentage": pkg.get("discount_percentage", 0),
-            "features": pkg.get("features", []),
-            "is_popular": pkg.get("is_popular", False),
-        })
+    async def build():
+        packages = await db.self_training_packages.find({"is_active": True}).sort("duration_months", 1).to_list(100)
+        
+        result = []
+        for pkg in packages:
+            result.append({
+                "id": pkg["_id"],
+                "name": pkg.get("name", ""),
+                "description": pkg.get("description", ""),
+                "duration_months": pkg.get("duration_months", 1),
+                "price": pkg.get("price", 0),
+                "price_per_month": pkg.get("price_per_month", 0),
+                "discount_percentage": pkg.get("discount_percentage", 0),
+                "features": pkg.get("features", []),
+                "is_popular": pkg.get("is_popular", False),
+            })
+        
+        return result
     
-    return result
+    return await catalog_response(request, "self_training_packages", "", build)
 
 # --- إدارة الاشتراكات ---
 
@@ -3802,6 +5812,7 @@ async def subscribe_to_self_training(package_id: str, current_user: dict = Depen
     }
     
     await db.self_training_subscriptions.insert_one(subscription_dict)
+    await track_counters("self_training_subscriptions", None, subscription_dict)
     
     return {
         "message": "تم إنشاء الاشتراك - في انتظار الدفع",
@@ -3821,15 +5832,15 @@ async def confirm_self_training_payment(subscription_id: str, current_user: dict
         raise HTTPException(status_code=404, detail="الاشتراك غير موجود")
     
     # تحديث الاشتراك
-    await db.self_training_subscriptions.update_one(
-        {"_id": subscription_id},
-        {"$set": {
-            "status": "active",
-            "payment_status": "paid",
-            "start_date": datetime.utcnow(),
-            "end_date": datetime.utcnow() + timedelta(days=30 * (await db.self_training_packages.find_one({"_id": subscription.get("package_id")})).get("duration_months", 1))
-        }}
-    )
+    update = {
+        "status": "active",
+        "payment_status": "paid",
+        "start_date": datetime.utcnow(),
+        "end_date": datetime.utcnow() + timedelta(days=30 * (await db.self_training_packages.find_one({"_id": subscription.get("package_id")})).get("duration_months", 1))
+    }
+    previous = await db.self_training_subscriptions.find_one_and_update({"_id": subscription_id}, {"$set": update})
+    if previous:
+        await track_counters("self_training_subscriptions", previous, {**previous, **update})
     
     return {"message": "تم تفعيل الاشتراك بنجاح", "subscription_id": subscription_id}
 
@@ -3928,6 +5939,7 @@ async def save_self_assessment(assessment_data: Dict[str, Any], current_user: di
         assessment_dict["_id"] = assessment_id
         assessment_dict["created_at"] = datetime.utcnow()
         await db.self_assessments.insert_one(assessment_dict)
+        await track_counters("self_assessments", None, assessment_dict)
     
     return {
         "message": "تم حفظ التقييم بنجاح",
@@ -3969,18 +5981,15 @@ async def get_self_assessment(current_user: dict = Depends(get_current_user)):
 async def complete_assessment(current_user: dict = Depends(get_current_user)):
     """إتمام التقييم وتوليد الخطة"""
     # البحث في النظام الموحد الجديد أولاً
-    subscription = await db.user_subscriptions.find_one({
-        "user_id": current_user["_id"],
-        "category": "self_training",
-        "status": "active"
-    })
+    subscription = await db.user_subscriptions.find_one(
+        active_subscription_query(current_user["_id"], category="self_training"), {"_id": 1}
+    )
     
     # إذا لم يوجد، البحث في النظام القديم
     if not subscription:
-        subscription = await db.self_training_subscriptions.find_one({
-            "user_id": current_user["_id"],
-            "status": "active"
-        })
+        subscription = await db.self_training_subscriptions.find_one(
+            active_subscription_query(current_user["_id"]), {"_id": 1}
+        )
     
     if not subscription:
         raise HTTPException(status_code=403, detail="يجب الاشتراك أولاً")
@@ -4001,10 +6010,12 @@ async def complete_assessment(current_user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=400, detail="يجب إكمال التقييم أولاً")
     
     # تعليم التقييم كمكتمل
-    await db.self_assessments.update_one(
+    previous = await db.self_assessments.find_one_and_update(
         {"_id": assessment["_id"]},
         {"$set": {"is_complete": True, "completed_at": datetime.utcnow()}}
     )
+    if previous:
+        await track_counters("self_assessments", previous, {**previous, "is_complete": True})
     
     # توليد الخطة (سيتم تحسينها لاحقاً مع AI)
     plan_id = str(uuid.uuid4())
@@ -4029,6 +6040,7 @@ async def complete_assessment(current_user: dict = Depends(get_current_user)):
     }
     
     await db.generated_plans.insert_one(plan_dict)
+    await track_counters("generated_plans", None, plan_dict)
     
     return {
         "message": "تم إتمام التقييم وتوليد الخطة",
@@ -4275,32 +6287,293 @@ def generate_tips(assessment: dict) -> list:
 @api_router.get("/admin/self-training/stats")
 async def get_self_training_stats(admin: dict = Depends(get_admin_user)):
     """إحصائيات نظام التدريب الذاتي"""
-    total_packages = await db.self_training_packages.count_documents({})
-    active_packages = await db.self_training_packages.count_documents({"is_active": True})
-    
-    total_subscriptions = await db.self_training_subscriptions.count_documents({})
-    active_subscriptions = await db.self_training_subscriptions.count_documents({"status": "active"})
-    
-    total_assessments = await db.self_assessments.count_documents({})
-    completed_assessments = await db.self_assessments.count_documents({"is_complete": True})
-    
-    total_plans = await db.generated_plans.count_documents({})
-    
-    # الإيرادات
-    pipeline = [
-        {"$match": {"payment_status": "paid"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount_paid"}}}
-    ]
-    revenue_result = await db.self_training_subscriptions.aggregate(pipeline).to_list(1)
-    total_revenue = revenue_result[0]["total"] if revenue_result else 0
+    counters = await read_counters([
+        "self_training.packages.total", "self_training.packages.active",
+        "self_training.subscriptions.total", "self_training.subscriptions.active",
+        "self_assessments.total", "self_assessments.completed",
+        "generated_plans.total", "self_training.revenue"
+    ])
     
     return {
-        "packages": {"total": total_packages, "active": active_packages},
-        "subscriptions": {"total": total_subscriptions, "active": active_subscriptions},
-        "assessments": {"total": total_assessments, "completed": completed_assessments},
-        "plans_generated": total_plans,
-        "total_revenue": total_revenue
+        "packages": {"total": counters["self_training.packages.total"], "active": counters["self_training.packages.active"]},
+        "subscriptions": {"total": counters["self_training.subscriptions.total"], "active": counters["self_training.subscriptions.active"]},
+        "assessments": {"total": counters["self_assessments.total"], "completed": counters["self_assessments.completed"]},
+        "plans_generated": counters["generated_plans.total"],
+        "total_revenue": counters["self_training.revenue"]
+    }
+
+# ==================== APP BOOTSTRAP ====================
+
+# أقسام شاشة البداية: كل قسم هو نفس دالة المسار المقابل، تُستدعى بالمستخدم المحلول مرة واحدة
+BOOTSTRAP_SECTIONS = {
+    "me": get_me,
+    "unread_count": get_unread_count,
+    "active_subscription": get_active_subscription,
+    "habits": get_habits,
+    "goals": get_my_goals,
+    "plan": get_my_plan,
+    "subscription_status": check_subscription_status,
+}
+
+async def run_bootstrap_section(name: str, endpoint, current_user: dict) -> Tuple[str, Any, Optional[dict], float]:
+    started = time.perf_counter()
+    try:
+        data, error = await endpoint(current_user=current_user), None
+    except HTTPException as e:
+        data, error = None, {"status_code": e.status_code, "detail": e.detail}
+    except Exception:
+        logger.exception(f"Bootstrap section {name} failed")
+        data, error = None, {"status_code": 500, "detail": "Internal server error"}
+    return name, data, error, (time.perf_counter() - started) * 1000
+
+@api_router.get("/bootstrap")
+async def get_bootstrap(request: Request, current_user: dict = Depends(get_current_user)):
+    """كل بيانات شاشة البداية في طلب واحد، والاستعلامات تعمل بالتوازي"""
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        run_bootstrap_section(name, endpoint, current_user) for name, endpoint in BOOTSTRAP_SECTIONS.items()
+    ))
+    payload = {
+        "sections": {name: data for name, data, _, _ in results},
+        "errors": {name: error for name, _, error, _ in results if error},
+        "timings_ms": {name: round(elapsed, 1) for name, _, _, elapsed in results},
+        "total_ms": round((time.perf_counter() - started) * 1000, 1)
     }
+    
+    body = json.dumps(jsonable_encoder(payload), ensure_ascii=False, separators=(",", ":")).encode()
+    headers = {
+        "Cache-Control": "private, no-store",
+        "Vary": "Accept-Encoding",
+        "Server-Timing": ", ".join(f"{name};dur={elapsed:.1f}" for name, _, _, elapsed in results)
+    }
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# ==================== DATABASE INDEXES ====================
+
+# سجل الفهارس لكل مجموعة يستخدمها الراوتر - يتم إنشاؤها عند بدء التشغيل
+INDEX_REGISTRY: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("role", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("stripe_customer_id", ASCENDING)], sparse=True),
+    ],
+    "user_sessions": [
+        IndexModel([("session_token", ASCENDING)]),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    "attachments": [
+        IndexModel([("last_used_at", ASCENDING)]),
+        IndexModel([("file_id", ASCENDING)]),
+    ],
+    "messages": [
+        IndexModel([("sender_id", ASCENDING), ("recipient_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("recipient_id", ASCENDING), ("sender_id", ASCENDING), ("read", ASCENDING)]),
+        IndexModel([("recipient_id", ASCENDING), ("read", ASCENDING)]),
+        IndexModel([("attachment_id", ASCENDING)], sparse=True),
+    ],
+    "bookings": [
+        IndexModel([("client_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("coach_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("booking_status", ASCENDING), ("client_id", ASCENDING)]),
+        IndexModel([("payment_status", ASCENDING), ("coach_id", ASCENDING)]),
+    ],
+    "sessions": [
+        IndexModel([("coach_id", ASCENDING), ("session_date", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("client_id", ASCENDING), ("session_date", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("session_date", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("booking_id", ASCENDING)]),
+    ],
+    "habits": [
+        IndexModel([("user_id", ASCENDING), ("date", ASCENDING)]),
+    ],
+    "habit_tracker": [
+        IndexModel([("user_id", ASCENDING), ("date", DESCENDING)]),
+    ],
+    "goals": [
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+    "user_results": [
+        IndexModel([("user_id", ASCENDING), ("saved_at", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("pillar", ASCENDING), ("saved_at", DESCENDING)]),
+    ],
+    "calculator_history": [
+        IndexModel([("user_id", ASCENDING), ("calculator_type", ASCENDING), ("timestamp", DESCENDING)]),
+    ],
+    "intake_responses": [
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING)]),
+        IndexModel([("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ],
+    "intake_questionnaire": [
+        IndexModel([("user_id", ASCENDING)]),
+    ],
+    "intake_questionnaires": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        IndexModel([("completed_at", ASCENDING), ("_id", ASCENDING)]),
+    ],
+    "payments": [
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("type", ASCENDING), ("status", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+    "subscriptions": [
+        IndexModel([("coach_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("status", ASCENDING)]),
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ],
+    "user_subscriptions": [
+        IndexModel([("user_id", ASCENDING), ("category", ASCENDING), ("status", ASCENDING), ("end_date", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("end_date", ASCENDING)]),
+        IndexModel([("expired_at", ASCENDING)], sparse=True),
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ],
+    "self_training_subscriptions": [
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING)]),
+        IndexModel([("package_id", ASCENDING), ("status", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("end_date", ASCENDING)]),
+        IndexModel([("expired_at", ASCENDING)], sparse=True),
+    ],
+    "subscription_events": [
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+    "self_assessments": [
+        IndexModel([("user_id", ASCENDING), ("subscription_id", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+    "generated_plans": [
+        IndexModel([("user_id", ASCENDING), ("subscription_id", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+    "conversations": [
+        IndexModel([("participants", ASCENDING), ("last_message_time", DESCENDING)]),
+    ],
+    "revenue_daily": [
+        IndexModel([("date", DESCENDING)]),
+    ],
+    "reviews": [
+        IndexModel([("coach_id", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+    "coach_profiles": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        IndexModel([("is_active", ASCENDING)]),
+    ],
+    "coach_packages": [
+        IndexModel([("coach_id", ASCENDING), ("active", ASCENDING)]),
+    ],
+    "hourly_packages": [
+        IndexModel([("active", ASCENDING)]),
+    ],
+    "unified_packages": [
+        IndexModel([("is_active", ASCENDING), ("category", ASCENDING), ("display_order", ASCENDING)]),
+        IndexModel([("display_order", ASCENDING)]),
+    ],
+    "self_training_packages": [
+        IndexModel([("is_active", ASCENDING), ("duration_months", ASCENDING)]),
+    ],
+    "resources": [
+        IndexModel([("is_active", ASCENDING), ("category", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING)]),
+    ],
+    "custom_calculators": [
+        IndexModel([("is_active", ASCENDING), ("category", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING)]),
+    ],
+    "settings": [
+        IndexModel([("type", ASCENDING)], unique=True),
+    ],
+}
+
+# الاستعلامات الساخنة التي يجب ألا تمسح المجموعة بالكامل (للتحقق عبر explain)
+HOT_QUERIES = [
+    ("users", {"email": "probe@example.com"}, None),
+    ("messages", {"recipient_id": "probe", "read": False}, None),
+    ("messages", {"sender_id": "probe", "recipient_id": "probe", "read": False}, None),
+    ("messages", {"$or": [
+        {"sender_id": "probe", "recipient_id": "probe2"},
+        {"sender_id": "probe2", "recipient_id": "probe"},
+    ]}, [("timestamp", -1)]),
+    ("conversations", {"participants": "probe"}, [("last_message_time", -1)]),
+    ("bookings", {"client_id": "probe"}, [("created_at", -1)]),
+    ("bookings", {"coach_id": "probe"}, [("created_at", -1)]),
+    ("sessions", {"coach_id": "probe"}, [("session_date", -1)]),
+    ("sessions", {"client_id": "probe"}, [("session_date", -1)]),
+    ("habits", {"user_id": "probe"}, None),
+    ("goals", {"user_id": "probe"}, [("created_at", -1)]),
+    ("user_results", {"user_id": "probe"}, [("saved_at", -1)]),
+    ("user_results", {"user_id": "probe", "pillar": "mental"}, [("saved_at", -1)]),
+    ("payments", {}, [("created_at", -1)]),
+    ("user_subscriptions", {"user_id": "probe", "category": "self_training", "status": "active"}, None),
+    ("user_subscriptions", {"status": "active", "end_date": {"$lt": datetime(2000, 1, 1)}}, None),
+    ("self_training_subscriptions", {"user_id": "probe", "status": "active"}, None),
+    ("self_training_subscriptions", {"status": "active", "end_date": {"$lt": datetime(2000, 1, 1)}}, None),
+    ("user_subscriptions", {"expired_at": datetime(2000, 1, 1), "status": "expired"}, None),
+    ("user_subscriptions", {}, [("created_at", 1), ("_id", 1)]),
+    ("intake_responses", {}, [("timestamp", 1), ("_id", 1)]),
+    ("intake_questionnaires", {}, [("completed_at", 1), ("_id", 1)]),
+    ("reviews", {"coach_id": "probe"}, [("created_at", -1)]),
+    ("coach_profiles", {"user_id": "probe"}, None),
+    ("unified_packages", {"is_active": True}, [("display_order", 1)]),
+    ("resources", {"is_active": True}, [("created_at", -1)]),
+    ("custom_calculators", {"is_active": True}, [("created_at", -1)]),
+]
+
+async def ensure_indexes() -> Dict[str, Dict[str, List[str]]]:
+    """إنشاء الفهارس المسجلة (عملية آمنة للتكرار) وإرجاع تقرير الانحراف"""
+    drift = {}
+    for collection_name, indexes in INDEX_REGISTRY.items():
+        collection = db[collection_name]
+        declared = {index.document["name"] for index in indexes}
+        try:
+            await collection.create_indexes(indexes)
+        except OperationFailure as e:
+            logger.error(f"Index creation failed on {collection_name}: {e}")
+
+        existing = set((await collection.index_information()).keys()) - {"_id_"}
+        missing = sorted(declared - existing)
+        unexpected = sorted(existing - declared)
+        if missing or unexpected:
+            drift[collection_name] = {"missing": missing, "unexpected": unexpected}
+            logger.warning(f"Index drift on {collection_name}: missing={missing} unexpected={unexpected}")
+    return drift
+
+def _plan_stages(plan: dict) -> List[str]:
+    """جمع أسماء مراحل خطة التنفيذ بشكل متكرر"""
+    stages = [plan.get("stage", "")]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages.extend(_plan_stages(plan[key]))
+    for child in plan.get("inputStages", []):
+        stages.extend(_plan_stages(child))
+    return stages
+
+async def explain_hot_queries() -> List[Dict[str, Any]]:
+    """طباعة الخطة الفائزة لكل استعلام ساخن والتحقق من عدم وجود COLLSCAN"""
+    report = []
+    for collection_name, query, sort in HOT_QUERIES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+        winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+        stages = _plan_stages(winning_plan)
+        report.append({
+            "collection": collection_name,
+            "query": query,
+            "sort": sort,
+            "stages": stages,
+            "collection_scan": "COLLSCAN" in stages,
+            "winning_plan": winning_plan,
+        })
+    return report
+
+@app.on_event("startup")
+async def create_db_indexes():
+    await ensure_indexes()
 
 # Include router
 app.include_router(api_router)
@@ -4312,8 +6585,64 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Has-More", "ETag", "Server-Timing", "Content-Disposition"],
 )
 
+@app.on_event("startup")
+async def start_user_cache_invalidation():
+    if USER_CACHE_CHANGE_STREAM:
+        start_background_task(watch_user_changes())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
     client.close()
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Ask Yazo API maintenance commands")
+    parser.add_argument("--ensure-indexes", action="store_true", help="create registered indexes and report drift")
+    parser.add_argument("--explain", action="store_true", help="print the winning plan of every registered hot query")
+    parser.add_argument("--rebuild-conversations", action="store_true", help="rebuild the conversations index and unread totals from messages")
+    parser.add_argument("--rebuild-revenue-rollup", action="store_true", help="recompute the revenue_daily rollup from payments")
+    parser.add_argument("--rebuild-coach-ratings", action="store_true", help="recompute coach rating aggregates from reviews")
+    parser.add_argument("--reconcile-counters", action="store_true", help="recompute the platform counters from their collections")
+    parser.add_argument("--migrate-habit-bitsets", action="store_true", help="convert habit completed_dates arrays to per-year bitsets")
+    parser.add_argument("--migrate-attachments", action="store_true", help="move inline base64 message attachments to the attachment store")
+    parser.add_argument("--collect-attachments", action="store_true", help="delete attachments no message references")
+    parser.add_argument("--migrate-profile-images", action="store_true", help="move inline profile images to the thumbnail store")
+    args = parser.parse_args()
+    
+    async def run_maintenance():
+        if args.rebuild_conversations:
+            await rebuild_conversations()
+            await rebuild_unread_counts()
+        if args.rebuild_revenue_rollup:
+            await refresh_revenue_rollup()
+        if args.rebuild_coach_ratings:
+            await rebuild_coach_ratings()
+        if args.reconcile_counters:
+            await reconcile_counters()
+        if args.migrate_habit_bitsets:
+            await migrate_habit_bitsets()
+        if args.migrate_attachments:
+            await migrate_message_attachments()
+        if args.collect_attachments:
+            await collect_unreferenced_attachments()
+        if args.migrate_profile_images:
+            await migrate_profile_images()
+        if args.ensure_indexes:
+            drift = await ensure_indexes()
+            print(json.dumps({"drift": drift}, ensure_ascii=False, indent=2))
+        if args.explain:
+            report = await explain_hot_queries()
+            for entry in report:
+                status_label = "COLLSCAN" if entry["collection_scan"] else "OK"
+                print(f"[{status_label}] {entry['collection']} {entry['query']} sort={entry['sort']}")
+                print(f"    stages: {' -> '.join(entry['stages'])}")
+            if any(entry["collection_scan"] for entry in report):
+                raise SystemExit(1)
+    
+    asyncio.run(run_maintenance())
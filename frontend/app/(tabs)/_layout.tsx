@@ -4,6 +4,7 @@ import { Ionicons } from '@expo/vector-icons';
 import AsyncStorage from '@react-native-async-storage/async-storage';
 import { View, ActivityIndicator, Text, StyleSheet } from 'react-native';
 import { useNotificationSound } from '../../src/hooks/useNotificationSound';
+import { useUnreadCountSocket } from '../../src/hooks/useUnreadCountSocket';
 
 const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL || '';
 
@@ -55,11 +56,20 @@ export default function TabsLayout() {
   useEffect(() => {
     loadUserRole();
     fetchUnreadCount();
-    
-    const interval = setInterval(fetchUnreadCount, 30000);
-    return () => clearInterval(interval);
   }, []);
 
+  useUnreadCountSocket((count) => updateUnreadCount(count), () => fetchUnreadCount());
+
+  const updateUnreadCount = (newCount: number) => {
+    if (!isFirstLoad.current) {
+      checkAndPlaySound(newCount);
+    } else {
+      isFirstLoad.current = false;
+    }
+    
+    setUnreadCount(newCount);
+  };
+
   const loadUserRole = async () => {
     try {
       const userData = await AsyncStorage.getItem('user');
@@ -85,15 +95,7 @@ export default function TabsLayout() {
 
       if (response.ok) {
         const data = await response.json();
-        const newCount = data.unread_count;
-        
-        if (!isFirstLoad.current) {
-          checkAndPlaySound(newCount);
-        } else {
-          isFirstLoad.current = false;
-        }
-        
-        setUnreadCount(newCount);
+        updateUnreadCount(data.unread_count);
       }
     } catch (error) {
       console.error('Error fetching unread count:', error);
@@ -22,6 +22,7 @@ import { format } from 'date-fns';
 import { ar } from 'date-fns/locale';
 import { useLocalSearchParams, useRouter } from 'expo-router';
 import { COLORS, FONTS, SPACING, RADIUS, SHADOWS } from '../../src/constants/theme';
+import { resolveImageUrl } from '../../src/utils/imageUrl';
 
 const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL || '';
 
@@ -263,7 +264,7 @@ export default function ChatScreen() {
     if (contact.profile_image) {
       return (
         <Image 
-          source={{ uri: contact.profile_image }}
+          source={{ uri: resolveImageUrl(contact.profile_image) }}
           style={{ width: size, height: size, borderRadius: size / 2 }}
         />
       );
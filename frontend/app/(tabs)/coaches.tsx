@@ -13,6 +13,7 @@ import { useSafeAreaInsets } from 'react-native-safe-area-context';
 import { Ionicons } from '@expo/vector-icons';
 import { useRouter } from 'expo-router';
 import { useFonts, Cairo_400Regular, Cairo_700Bold } from '@expo-google-fonts/cairo';
+import { resolveImageUrl } from '../../src/utils/imageUrl';
 
 const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL || '';
 
@@ -104,7 +105,7 @@ export default function CoachesScreen() {
       <View style={styles.coachHeader}>
         <View style={[styles.avatar, !item.profile_image && { backgroundColor: getLetterColor(item.full_name) }]}>
           {item.profile_image ? (
-            <Image source={{ uri: item.profile_image }} style={styles.avatarImage} />
+            <Image source={{ uri: resolveImageUrl(item.profile_image) }} style={styles.avatarImage} />
           ) : (
             <Text style={styles.avatarLetter}>
               {item.full_name?.trim().charAt(0).toUpperCase() || '?'}
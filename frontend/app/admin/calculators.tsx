@@ -28,7 +28,7 @@ interface CustomCalculator {
   description: string;
   category: string;
   icon: string;
-  html_content: string;
+  html_content?: string;
   is_active: boolean;
   created_at?: string;
 }
@@ -336,15 +336,26 @@ export default function AdminCalculatorsScreen() {
     setShowModal(true);
   };
 
-  const openEditModal = (calc: CustomCalculator) => {
+  const openEditModal = async (calc: CustomCalculator) => {
     setEditingCalc(calc);
     setTitle(calc.title);
     setDescription(calc.description);
     setCategory(calc.category);
     setIcon(calc.icon);
-    setHtmlContent(calc.html_content || '');
+    setHtmlContent('');
     setIsActive(calc.is_active);
     setShowModal(true);
+
+    // كود HTML لا يأتي مع القائمة، نجلبه من صفحة التفاصيل
+    try {
+      const response = await fetch(`${API_URL}/api/custom-calculators/${calc.id}`);
+      if (response.ok) {
+        const data = await response.json();
+        setHtmlContent(data.html_content || '');
+      }
+    } catch (error) {
+      console.error('Error loading calculator code:', error);
+    }
   };
 
   const useTemplate = (template: typeof TEMPLATES[0]) => {
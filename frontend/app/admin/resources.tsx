@@ -29,6 +29,7 @@ interface Resource {
   category: string;
   content_type: string;
   content?: string;
+  has_content?: boolean;
   external_url?: string;
   internal_route?: string;
   duration?: string;
@@ -120,19 +121,32 @@ export default function AdminResourcesScreen() {
     setShowModal(true);
   };
 
-  const openEditModal = (resource: Resource) => {
+  const openEditModal = async (resource: Resource) => {
     setEditingResource(resource);
     setTitle(resource.title);
     setDescription(resource.description);
     setCategory(resource.category);
     setContentType(resource.content_type);
-    setContent(resource.content || '');
+    setContent('');
     setExternalUrl(resource.external_url || '');
     setInternalRoute(resource.internal_route || '');
     setDuration(resource.duration || '');
     setIcon(resource.icon);
     setIsActive(resource.is_active);
     setShowModal(true);
+
+    // القائمة لا تحمل نص المقال، نجلبه من صفحة التفاصيل
+    if (resource.has_content) {
+      try {
+        const response = await fetch(`${API_URL}/api/resources/${resource.id}`);
+        if (response.ok) {
+          const data = await response.json();
+          setContent(data.content || '');
+        }
+      } catch (error) {
+        console.error('Error loading resource content:', error);
+      }
+    }
   };
 
   const handleSave = async () => {
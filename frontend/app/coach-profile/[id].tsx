@@ -15,6 +15,7 @@ import { Ionicons } from '@expo/vector-icons';
 import { useRouter, useLocalSearchParams } from 'expo-router';
 import { useFonts, Cairo_400Regular, Cairo_700Bold } from '@expo-google-fonts/cairo';
 import AsyncStorage from '@react-native-async-storage/async-storage';
+import { resolveImageUrl } from '../../src/utils/imageUrl';
 
 const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL || '';
 
@@ -198,7 +199,7 @@ export default function CoachProfileScreen() {
         <View style={styles.profileSection}>
           <View style={[styles.avatar, !coach.profile_image && { backgroundColor: getLetterColor(coach.full_name) }]}>
             {coach.profile_image ? (
-              <Image source={{ uri: coach.profile_image }} style={styles.avatarImage} />
+              <Image source={{ uri: resolveImageUrl(coach.profile_image) }} style={styles.avatarImage} />
             ) : (
               <Text style={styles.avatarLetter}>
                 {coach.full_name?.trim().charAt(0).toUpperCase() || '?'}
@@ -18,6 +18,7 @@ import { useRouter } from 'expo-router';
 import { useFonts, Cairo_400Regular, Cairo_700Bold } from '@expo-google-fonts/cairo';
 import AsyncStorage from '@react-native-async-storage/async-storage';
 import * as ImagePicker from 'expo-image-picker';
+import { resolveImageUrl } from '../../src/utils/imageUrl';
 
 const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL || '';
 
@@ -228,7 +229,7 @@ export default function CoachProfileEdit() {
               {profile.profile_image ? (
                 <View style={styles.imageWrapper}>
                   <Image 
-                    source={{ uri: profile.profile_image }} 
+                    source={{ uri: resolveImageUrl(profile.profile_image) }} 
                     style={styles.profileImage}
                   />
                   <TouchableOpacity style={styles.removeImageBtn} onPress={removeImage}>
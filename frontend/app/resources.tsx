@@ -24,6 +24,7 @@ interface Resource {
   category: string;
   content_type: string;
   content?: string;
+  has_content?: boolean;
   external_url?: string;
   duration?: string;
   icon: string;
@@ -175,13 +176,13 @@ export default function ResourcesScreen() {
     }
     
     // إذا كان هناك محتوى نصي، انتقل لصفحة العرض
-    if (resource.content) {
+    if (resource.has_content || resource.content) {
       router.push(`/resource-content/${resource.id}` as any);
     }
   };
 
   const hasLink = (resource: Resource) => {
-    return resource.external_url || resource.content;
+    return resource.external_url || resource.has_content || resource.content;
   };
 
   if (!fontsLoaded) return null;
@@ -1,5 +1,6 @@
 import React from 'react';
 import { View, Text, Image, StyleSheet } from 'react-native';
+import { resolveImageUrl } from '../utils/imageUrl';
 
 // ألوان مختلفة لكل حرف
 const LETTER_COLORS: { [key: string]: string } = {
@@ -43,7 +44,7 @@ export default function Avatar({ name, imageUrl, size = 50, isCoach = false }: A
     return (
       <View style={[styles.container, { width: size, height: size, borderRadius: size / 2 }]}>
         <Image
-          source={{ uri: imageUrl }}
+          source={{ uri: resolveImageUrl(imageUrl) }}
           style={[styles.image, { width: size, height: size, borderRadius: size / 2 }]}
         />
       </View>
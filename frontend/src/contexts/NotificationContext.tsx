@@ -1,5 +1,6 @@
 import React, { createContext, useContext, useState, useEffect, useCallback } from 'react';
 import AsyncStorage from '@react-native-async-storage/async-storage';
+import { useUnreadCountSocket } from '../hooks/useUnreadCountSocket';
 
 const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL || '';
 
@@ -54,15 +55,12 @@ export function NotificationProvider({ children }: { children: React.ReactNode }
   }, [refreshUnreadCount]);
 
   useEffect(() => {
-    // Initial fetch
+    // Initial fetch; later changes arrive as Socket.IO unread_count events
     refreshUnreadCount();
-
-    // Poll every 30 seconds
-    const interval = setInterval(refreshUnreadCount, 30000);
-
-    return () => clearInterval(interval);
   }, [refreshUnreadCount]);
 
+  useUnreadCountSocket(setUnreadMessages, refreshUnreadCount);
+
   return (
     <NotificationContext.Provider value={{ unreadMessages, refreshUnreadCount, markMessagesRead }}>
       {children}
@@ -0,0 +1,49 @@
+import { useEffect, useRef } from 'react';
+import AsyncStorage from '@react-native-async-storage/async-storage';
+import { io, Socket } from 'socket.io-client';
+
+const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL || '';
+// أقل من مهلة الخمول في الخادم (SOCKET_IDLE_TIMEOUT_SECONDS)
+const HEARTBEAT_INTERVAL_MS = 5 * 60 * 1000;
+
+// عدد الرسائل غير المقروءة يُدفع من الخادم عبر Socket.IO بدل الاستطلاع الدوري
+export function useUnreadCountSocket(onCount: (count: number) => void, onConnect?: () => void) {
+  const onCountRef = useRef(onCount);
+  const onConnectRef = useRef(onConnect);
+  onCountRef.current = onCount;
+  onConnectRef.current = onConnect;
+
+  useEffect(() => {
+    let socket: Socket | null = null;
+    let heartbeat: ReturnType<typeof setInterval> | undefined;
+    let cancelled = false;
+
+    AsyncStorage.getItem('token').then((token) => {
+      if (!token || cancelled) return;
+      socket = io(API_URL, { auth: { token }, transports: ['websocket'] });
+      // بعد إعادة الاتصال قد تكون فاتتنا تحديثات، فنجلب العدد من جديد
+      socket.on('connect', () => onConnectRef.current?.());
+      socket.on('unread_count', (data: { unread_count: number }) => {
+        onCountRef.current(data.unread_count);
+      });
+      // تجاوز حد الاتصالات لكل مستخدم: اتصال أحدث حل محل هذا، فلا نعيد الاتصال حتى لا يتبادلا الطرد
+      let replaced = false;
+      socket.on('evicted', (data: { reason: string }) => {
+        replaced = data.reason === 'connection_limit';
+      });
+      // الخادم يقطع الاتصالات الخاملة، والعميل لا يعيد الاتصال تلقائياً بعد قطع من الخادم
+      socket.on('disconnect', (reason) => {
+        if (reason === 'io server disconnect' && !replaced) {
+          socket?.connect();
+        }
+      });
+      heartbeat = setInterval(() => socket?.emit('heartbeat'), HEARTBEAT_INTERVAL_MS);
+    });
+
+    return () => {
+      cancelled = true;
+      clearInterval(heartbeat);
+      socket?.disconnect();
+    };
+  }, []);
+}
@@ -0,0 +1,7 @@
+const API_URL = process.env.EXPO_PUBLIC_BACKEND_URL || '';
+
+// الخادم يعيد روابط صور نسبية (/api/images/...) ما لم يُضبط PUBLIC_BASE_URL
+export function resolveImageUrl(uri?: string | null): string | undefined {
+  if (!uri) return undefined;
+  return uri.startsWith('/') ? `${API_URL}${uri}` : uri;
+}
@@ -0,0 +1,13 @@
+import os
+import sys
+from pathlib import Path
+
+# server.py يقرأ هذه المتغيرات عند الاستيراد؛ عميل Mongo لا يتصل قبل أول استعلام
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "ask_yazo_test")
+os.environ.setdefault("JWT_SECRET", "test-secret")
+os.environ.setdefault("JWT_ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "60")
+os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_dummy")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
@@ -0,0 +1,108 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(doc, q) for q in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, q) for q in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = doc.get(key)
+            if "$lt" in condition and not value < condition["$lt"]:
+                return False
+            if "$gt" in condition and not value > condition["$gt"]:
+                return False
+        elif doc.get(key) != condition:
+            return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, keys):
+        for field, direction in reversed(keys):
+            self.docs.sort(key=lambda d: d[field], reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        self.docs = self.docs[:n]
+        return self
+
+    async def to_list(self, length):
+        return self.docs[:length]
+
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection=None):
+        return FakeCursor([dict(d) for d in self.docs if matches(d, query)])
+
+
+def make_docs(count):
+    start = datetime(2024, 1, 1)
+    # كل ثلاثة مستندات تشترك في نفس الوقت لاختبار كسر التعادل بـ _id
+    return [{"_id": f"id-{i:04d}", "created_at": start + timedelta(minutes=i // 3)} for i in range(count)]
+
+
+def walk(collection, limit, direction=server.DESCENDING):
+    seen, cursor = [], None
+    while True:
+        docs, cursor, has_more = asyncio.run(
+            server.paginate(collection, {}, "created_at", direction=direction, limit=limit, cursor=cursor)
+        )
+        seen.extend(d["_id"] for d in docs)
+        assert has_more == (cursor is not None)
+        if not has_more:
+            return seen
+
+
+@pytest.mark.parametrize("sort_value", [datetime(2024, 5, 17, 8, 30, 15, 123000), 42, 3.5, "abc", None])
+def test_cursor_round_trip(sort_value):
+    cursor = server.encode_cursor(sort_value, "doc-1")
+    assert "=" not in cursor
+    assert server.decode_cursor(cursor) == (sort_value, "doc-1")
+
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "", "W10", server.encode_cursor(1, "x")[:-3]])
+def test_decode_cursor_rejects_garbage(cursor):
+    with pytest.raises(HTTPException) as e:
+        server.decode_cursor(cursor)
+    assert e.value.status_code == 400
+
+
+@pytest.mark.parametrize("direction", [server.DESCENDING, server.ASCENDING])
+def test_paginate_walks_every_document_once(direction):
+    docs = make_docs(25)
+    seen = walk(FakeCollection(docs), limit=4, direction=direction)
+    expected = sorted(docs, key=lambda d: (d["created_at"], d["_id"]), reverse=direction < 0)
+    assert seen == [d["_id"] for d in expected]
+
+
+def test_paginate_without_limit_or_cursor_keeps_the_unpaged_cap():
+    collection = FakeCollection(make_docs(150))
+    docs, next_cursor, has_more = asyncio.run(server.paginate(collection, {}, "created_at"))
+    assert len(docs) == 150 and not has_more and next_cursor is None
+
+    docs, next_cursor, has_more = asyncio.run(server.paginate(collection, {}, "created_at", unpaged_limit=100))
+    assert len(docs) == 100 and has_more
+
+    docs, _, _ = asyncio.run(server.paginate(collection, {}, "created_at", cursor=next_cursor))
+    assert len(docs) == 50
+
+
+def test_paginate_exact_page_has_no_more():
+    docs, next_cursor, has_more = asyncio.run(server.paginate(FakeCollection(make_docs(5)), {}, "created_at", limit=5))
+    assert len(docs) == 5 and not has_more and next_cursor is None
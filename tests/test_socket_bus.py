@@ -0,0 +1,169 @@
+import asyncio
+import itertools
+import json
+
+import socketio
+
+import server
+
+
+class FakeCappedStorage:
+    """مجموعة capped في الذاكرة: ترتيب الإدراج محفوظ، و_id يولّده كل عامل بنفسه"""
+
+    def __init__(self):
+        self.docs = [{"_id": 0, "message": None}]
+        self.inserted = asyncio.Event()
+
+    def view(self, ids):
+        return FakeCollection(self, ids)
+
+
+class FakeCollection:
+    def __init__(self, storage, ids):
+        self.storage = storage
+        self.ids = ids
+
+    async def insert_one(self, doc):
+        self.storage.docs.append({"_id": next(self.ids), **doc})
+        self.storage.inserted.set()
+
+    async def find_one(self, query, projection=None):
+        return next((d for d in self.storage.docs if d["_id"] == query["_id"]), None)
+
+    def find(self, query, projection=None, cursor_type=None):
+        if cursor_type is not None:
+            return FakeTailableCursor(self.storage)
+        return FakeQuery(self.storage.docs)
+
+
+class FakeQuery:
+    def __init__(self, docs):
+        self.docs = list(docs)
+
+    def sort(self, field, direction):
+        if direction < 0:
+            self.docs.reverse()
+        return self
+
+    def limit(self, n):
+        self.docs = self.docs[:n]
+        return self
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class FakeTailableCursor:
+    """يعيد المستندات بترتيب الإدراج، وينهي التكرار بعد مهلة الانتظار دون أن يموت"""
+
+    alive = True
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.position = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            if self.position >= len(self.storage.docs):
+                self.storage.inserted.clear()
+                try:
+                    await asyncio.wait_for(self.storage.inserted.wait(), 0.05)
+                except asyncio.TimeoutError:
+                    raise StopAsyncIteration
+                continue
+            doc = self.storage.docs[self.position]
+            self.position += 1
+            return doc
+
+
+async def publish_from_two_workers():
+    storage = FakeCappedStorage()
+    # معرفات العامل A أكبر دائماً من معرفات العامل B كما يحدث مع ObjectId خلال الثانية نفسها
+    worker_a = server.MongoPubSubManager(channel="test")
+    worker_a._collection = storage.view(itertools.count(1000))
+    worker_b = server.MongoPubSubManager(channel="test")
+    worker_b._collection = storage.view(itertools.count(1))
+    listener = server.MongoPubSubManager(channel="test")
+    listener._collection = storage.view(itertools.count(10 ** 6))
+
+    await worker_a._publish({"n": "before-listen"})
+
+    received = []
+
+    async def consume():
+        async for message in listener._listen():
+            received.append(json.loads(message)["n"])
+
+    task = asyncio.create_task(consume())
+    await asyncio.sleep(0.01)
+
+    expected = []
+    for n in range(20):
+        await (worker_a if n % 2 == 0 else worker_b)._publish({"n": n})
+        expected.append(n)
+        if n % 5 == 4:
+            # يترك المؤشر يبلغ مهلة الانتظار بين الدفعات
+            await asyncio.sleep(0.1)
+
+    for _ in range(100):
+        if len(received) >= len(expected):
+            break
+        await asyncio.sleep(0.02)
+    task.cancel()
+    return received, expected
+
+
+def test_mongo_bus_delivers_every_message_from_two_workers():
+    received, expected = asyncio.run(publish_from_two_workers())
+    assert received == expected
+
+
+def local_worker(channel):
+    manager_cls = type("InstrumentedLocalPubSubManager", (server.InstrumentedManagerMixin, server.LocalPubSubManager), {})
+    worker = socketio.AsyncServer(async_mode="asgi", client_manager=manager_cls(channel=channel))
+    worker.manager_initialized = True
+    worker.manager.initialize()
+    return worker
+
+
+async def emit_across_local_workers():
+    worker_a = local_worker("test-local")
+    worker_b = local_worker("test-local")
+    await asyncio.sleep(0)
+
+    # عميل متصل بالعامل B فقط، في غرفة المستخدم
+    sent = []
+
+    async def send_eio_packet(eio_sid, pkt):
+        sent.append((eio_sid, pkt.data))
+
+    worker_b._send_eio_packet = send_eio_packet
+    sid = await worker_b.manager.connect("eio-1", "/")
+    await worker_b.manager.enter_room(sid, "/", "user-1")
+
+    await worker_a.emit("unread_count", {"unread_count": 3}, room="user-1")
+    for _ in range(50):
+        if sent:
+            break
+        await asyncio.sleep(0.01)
+    for worker in (worker_a, worker_b):
+        worker.manager.thread.cancel()
+    return sent
+
+
+def test_local_bus_delivers_room_emit_across_workers_and_records_latency(monkeypatch):
+    monkeypatch.setattr(server, "socket_metrics", server.SocketMetrics())
+    sent = asyncio.run(emit_across_local_workers())
+
+    assert len(sent) == 1
+    eio_sid, data = sent[0]
+    assert eio_sid == "eio-1"
+    assert json.loads(data[1:]) == ["unread_count", {"unread_count": 3}]
+
+    metrics = server.socket_metrics
+    assert metrics.published == 1 and metrics.received == 1
+    assert metrics.emit_latency["unread_count"].count == 1
+    assert metrics.delivery_latency["unread_count"].count == 1